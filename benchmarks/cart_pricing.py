@@ -0,0 +1,138 @@
+"""
+Цена корзины из 100 позиций: цикл get_product_by_id (по запросу на товар)
+против одного WHERE id IN, прогретого catalog_cache и проверки подписанной
+котировки (/checkout/create с quote из /checkout/quote).
+
+Работает на временной БД с --products товарами, без сети:
+
+    python benchmarks/cart_pricing.py --products 20000 --cart 100 --rounds 200
+
+Дополнительно считает, на скольких ценах каталога int(price * 100) —
+прежний перевод в тиыны в forte_service — теряет тиын.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+
+import database  # noqa: E402
+from services.catalog_cache import catalog_cache  # noqa: E402
+from services.pricing import price_cart, to_tiyn, verify_quote  # noqa: E402
+
+
+class _Item:
+    def __init__(self, product_id: int, quantity: int):
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+async def _seed(count: int) -> list[int]:
+    rows = [
+        (f"Товар {i}", "Прочее", round(random.uniform(50, 5000), 2), f"2{i:012d}")
+        for i in range(count)
+    ]
+    async with database._write() as db:
+        await db.executemany(
+            "INSERT INTO products (name, category, price, barcode) VALUES (?, ?, ?, ?)", rows
+        )
+        await db.commit()
+    return [p["id"] for p in await database.get_all_products()]
+
+
+async def _loop(items: list[_Item]) -> int:
+    total = 0
+    for item in items:
+        product = await database.get_product_by_id(item.product_id)
+        total += to_tiyn(product["price"]) * item.quantity
+    return total
+
+
+async def _in_query(items: list[_Item]) -> int:
+    products = {p["id"]: p for p in await database.get_products_by_ids([i.product_id for i in items])}
+    return sum(to_tiyn(products[i.product_id]["price"]) * i.quantity for i in items)
+
+
+async def _cached(items: list[_Item]) -> int:
+    return (await price_cart(items))["total_tiyn"]
+
+
+def _percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(0, int(-(-len(values) * p // 100)) - 1)]
+
+
+async def _measure(name: str, fn, carts: list[list[_Item]], rows: list[dict]) -> None:
+    timings = []
+    for items in carts:
+        started = time.perf_counter()
+        result = fn(items)
+        if asyncio.iscoroutine(result):
+            await result
+        timings.append(time.perf_counter() - started)
+    rows.append({
+        "mode":   name,
+        "p50_ms": round(_percentile(timings, 50) * 1000, 3),
+        "p95_ms": round(_percentile(timings, 95) * 1000, 3),
+        "carts":  len(timings),
+    })
+
+
+async def run(args) -> dict:
+    await database.init_db()
+    await database.open_pool()
+    try:
+        ids = await _seed(args.products)
+        carts = [
+            [_Item(pid, random.randint(1, 3)) for pid in random.sample(ids, args.cart)]
+            for _ in range(args.rounds)
+        ]
+        rows: list[dict] = []
+        await _measure("loop get_product_by_id", _loop, carts, rows)
+        await _measure("single WHERE id IN", _in_query, carts, rows)
+
+        catalog_cache.clear()
+        await _measure("price_cart, cold cache", _cached, carts, rows)
+        await _measure("price_cart, warm cache", _cached, carts, rows)
+
+        quotes = [(await price_cart(items))["token"] for items in carts]
+        tokens = iter(quotes)
+        await _measure("verify_quote", lambda items: verify_quote(next(tokens), items), carts, rows)
+
+        prices = [p["price"] for p in await database.get_all_products()]
+        truncated = sum(1 for price in prices if int(price * 100) != to_tiyn(price))
+        return {"results": rows, "prices": len(prices), "int_truncated": truncated}
+    finally:
+        await database.close_pool()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--cart", type=int, default=100, help="distinct products per cart")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+
+    print(f"{'mode':<26} {'p50 ms':>9} {'p95 ms':>9}")
+    for r in report["results"]:
+        print(f"{r['mode']:<26} {r['p50_ms']:>9} {r['p95_ms']:>9}")
+    print(f"\nint(price * 100) loses a tiyn on {report['int_truncated']} of {report['prices']} prices")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Нагрузочный бенчмарк API: /products, /recognize и поток оплаты
+/checkout/create → /checkout/callback → /checkout/status.
+
+Для каждой операции печатает p50/p95/p99 задержки, пропускную способность и
+число ошибок. С --spawn сам поднимает mock OpenAI, mock Forte и приложение
+на временной БД — сеть не нужна, подходит для CI:
+
+    python benchmarks/load_test.py --spawn --concurrency 20 --requests 200
+    python benchmarks/load_test.py --base-url http://127.0.0.1:8000 --scenarios products
+
+Код выхода 1, если доля ошибок больше --max-error-rate.
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import httpx
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SCENARIOS = ("products", "recognize", "checkout")
+
+
+# ── Статистика ────────────────────────────────────────────────────────────────
+class Recorder:
+    """Задержки и ошибки по именам операций."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.wall: dict[str, float] = {}
+
+    async def timed(self, name: str, call):
+        started = time.perf_counter()
+        try:
+            resp = await call
+            resp.raise_for_status()
+            return resp
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+
+    def report(self) -> list[dict]:
+        rows = []
+        for name, values in self.latencies.items():
+            values = sorted(values)
+            wall = self.wall.get(name.split(" ", 1)[0], 0) or sum(values)
+            rows.append({
+                "operation":  name,
+                "count":      len(values),
+                "errors":     self.errors.get(name, 0),
+                "p50_ms":     round(_percentile(values, 50) * 1000, 1),
+                "p95_ms":     round(_percentile(values, 95) * 1000, 1),
+                "p99_ms":     round(_percentile(values, 99) * 1000, 1),
+                "throughput": round(len(values) / wall, 1) if wall else 0.0,
+            })
+        return rows
+
+
+def _percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank перцентиль по отсортированному списку."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+# ── Сценарии ──────────────────────────────────────────────────────────────────
+def _images(count: int, size: int) -> list[str]:
+    """Разные картинки, чтобы кэш распознавания не подменял вызов модели."""
+    images = []
+    for _ in range(count):
+        img = Image.effect_noise((size, size), random.uniform(20, 80)).convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=80)
+        images.append(base64.b64encode(out.getvalue()).decode("ascii"))
+    return images
+
+
+async def _products(client: httpx.AsyncClient, rec: Recorder, i: int, ctx: dict) -> None:
+    await rec.timed("products GET /products", client.get("/products"))
+    product_id = random.choice(ctx["product_ids"])
+    await rec.timed("products GET /products/{id}", client.get(f"/products/{product_id}"))
+
+
+async def _recognize(client: httpx.AsyncClient, rec: Recorder, i: int, ctx: dict) -> None:
+    image = ctx["images"][i % len(ctx["images"])]
+    await rec.timed("recognize POST /recognize", client.post("/recognize", json={"image_base64": image}))
+
+
+async def _checkout(client: httpx.AsyncClient, rec: Recorder, i: int, ctx: dict) -> None:
+    product = random.choice(ctx["products"])
+    cart = {
+        "items": [{"product_id": product["id"], "name": product["name"], "price": product["price"], "quantity": 1}],
+        "total": product["price"],
+    }
+    started = time.perf_counter()
+    try:
+        created = (await rec.timed("checkout POST /checkout/create", client.post("/checkout/create", json=cart))).json()
+        order_id = created["our_order_id"]
+        await rec.timed(
+            "checkout GET /checkout/callback",
+            client.get("/checkout/callback", params={"our_order_id": order_id, "STATUS": "FullyPaid"}),
+        )
+        status = (await rec.timed("checkout GET /checkout/status", client.get(f"/checkout/status/{order_id}"))).json()
+        if status["status"] != "paid":
+            raise RuntimeError(f"order {order_id} is {status['status']}")
+    except Exception:
+        rec.errors["checkout flow"] = rec.errors.get("checkout flow", 0) + 1
+    finally:
+        rec.latencies.setdefault("checkout flow", []).append(time.perf_counter() - started)
+
+
+_RUNNERS = {"products": _products, "recognize": _recognize, "checkout": _checkout}
+
+
+async def _run_scenario(name: str, client: httpx.AsyncClient, rec: Recorder, args, ctx: dict) -> None:
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            try:
+                await _RUNNERS[name](client, rec, i, ctx)
+            except Exception:
+                pass   # уже посчитано в Recorder
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    rec.wall[name] = time.perf_counter() - started
+
+
+async def run(args) -> list[dict]:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        products = (await client.get("/products")).raise_for_status().json()["products"]
+        ctx = {
+            "products":    products,
+            "product_ids": [p["id"] for p in products],
+            "images":      _images(args.image_pool or args.requests, args.image_size)
+                           if "recognize" in args.scenarios else [],
+        }
+        rec = Recorder()
+        for name in args.scenarios:
+            await _run_scenario(name, client, rec, args, ctx)
+        return rec.report()
+
+
+# ── Окружение для --spawn ─────────────────────────────────────────────────────
+def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url}: process exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start in {timeout}s")
+
+
+@contextmanager
+def spawned(args):
+    """mock OpenAI + mock Forte + приложение на временной БД."""
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    env = {
+        **os.environ,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.openai_port}/v1",
+        "OPENAI_API_KEY":  "sk-mock",
+        "FORTE_BASE_URL":  f"http://127.0.0.1:{args.forte_port}",
+        "DB_PATH":         os.path.join(tmp, "bench.db"),
+    }
+    commands = [
+        (f"http://127.0.0.1:{args.openai_port}/_mock/stats",
+         [sys.executable, "benchmarks/mock_openai.py", "--port", str(args.openai_port),
+          "--latency", str(args.openai_latency), "--jitter", str(args.openai_latency / 4)]),
+        (f"http://127.0.0.1:{args.forte_port}/_mock/stats",
+         [sys.executable, "benchmarks/mock_forte.py", "--port", str(args.forte_port)]),
+        (f"http://127.0.0.1:{args.app_port}/health",
+         [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.app_port),
+          "--workers", str(args.workers), "--log-level", "warning"]),
+    ]
+    procs = []
+    try:
+        for url, cmd in commands:
+            proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+            procs.append(proc)
+            _wait_ready(url, proc)
+        args.base_url = f"http://127.0.0.1:{args.app_port}"
+        yield
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def _print_report(rows: list[dict]) -> None:
+    print(f"{'operation':<36} {'count':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8}")
+    for r in rows:
+        print(f"{r['operation']:<36} {r['count']:>6} {r['errors']:>5} {r['p50_ms']:>9} "
+              f"{r['p95_ms']:>9} {r['p99_ms']:>9} {r['throughput']:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100, help="iterations per scenario")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--image-size", type=int, default=640, help="px, square noise JPEG")
+    parser.add_argument("--image-pool", type=int, default=0, help="distinct images (0 = one per request)")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--max-error-rate", type=float, default=0.0)
+    spawn = parser.add_argument_group("--spawn: start mocks and the app locally")
+    spawn.add_argument("--spawn", action="store_true")
+    spawn.add_argument("--app-port", type=int, default=18000)
+    spawn.add_argument("--openai-port", type=int, default=18081)
+    spawn.add_argument("--forte-port", type=int, default=18082)
+    spawn.add_argument("--workers", type=int, default=1)
+    spawn.add_argument("--openai-latency", type=float, default=0.5, help="mock model latency, seconds")
+    args = parser.parse_args()
+
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if args.spawn:
+        with spawned(args):
+            rows = asyncio.run(run(args))
+    else:
+        rows = asyncio.run(run(args))
+
+    _print_report(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"concurrency": args.concurrency, "requests": args.requests, "results": rows}, f, indent=2)
+
+    total = sum(r["count"] for r in rows)
+    errors = sum(r["errors"] for r in rows)
+    if total and errors / total > args.max_error_rate:
+        print(f"error rate {errors / total:.2%} > {args.max_error_rate:.2%}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Локальная замена Forte /order API для бенчмарков и CI без сети.
+
+  POST /order                      → {"order": {"id", "password", "hppUrl", "status"}}
+  GET  /order/{id}?password=...    → {"order": {"id", "status"}}
+  POST /_mock/orders/{id}/status   → выставить статус вручную ({"status": "FullyPaid"})
+
+С --auto-pay-after N заказ сам становится FullyPaid через N секунд — так
+можно проверить фоновую сверку без callback.
+
+    python benchmarks/mock_forte.py --port 8082 --latency 0.1
+    FORTE_BASE_URL=http://127.0.0.1:8082 uvicorn main:app
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import secrets
+import time
+
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Request
+
+MOCK_FORTE_LATENCY        = float(os.getenv("MOCK_FORTE_LATENCY", "0.05"))    # сек
+MOCK_FORTE_JITTER         = float(os.getenv("MOCK_FORTE_JITTER", "0.02"))     # сек
+MOCK_FORTE_AUTO_PAY_AFTER = float(os.getenv("MOCK_FORTE_AUTO_PAY_AFTER", "-1"))   # сек, <0 — выкл
+
+app = FastAPI(title="Mock Forte")
+config = {
+    "latency":        MOCK_FORTE_LATENCY,
+    "jitter":         MOCK_FORTE_JITTER,
+    "auto_pay_after": MOCK_FORTE_AUTO_PAY_AFTER,
+}
+orders: dict[int, dict] = {}
+_ids = itertools.count(100000)
+
+
+async def _delay() -> None:
+    await asyncio.sleep(max(0.0, config["latency"] + random.uniform(-config["jitter"], config["jitter"])))
+
+
+def _status(order: dict) -> str:
+    if (
+        order["status"] == "Preparing"
+        and config["auto_pay_after"] >= 0
+        and time.monotonic() - order["created"] >= config["auto_pay_after"]
+    ):
+        order["status"] = "FullyPaid"
+    return order["status"]
+
+
+@app.post("/order")
+async def create_order(request: Request, authorization: str | None = Header(None)):
+    if not authorization or not authorization.startswith("Basic "):
+        raise HTTPException(401, "Unauthorized")
+    payload = (await request.json())["order"]
+    await _delay()
+
+    order_id = next(_ids)
+    orders[order_id] = {
+        "id":       order_id,
+        "password": secrets.token_hex(6),
+        "amount":   payload["amount"],
+        "status":   "Preparing",
+        "created":  time.monotonic(),
+    }
+    base_url = str(request.base_url).rstrip("/")
+    return {
+        "order": {
+            "id":       order_id,
+            "password": orders[order_id]["password"],
+            "hppUrl":   f"{base_url}/flex",
+            "status":   "Preparing",
+        }
+    }
+
+
+@app.get("/order/{order_id}")
+async def get_order(order_id: int, password: str):
+    await _delay()
+    order = orders.get(order_id)
+    if order is None or order["password"] != password:
+        return {"errorCode": "ORDER_NOT_FOUND", "errorDescription": "Order not found"}
+    return {"order": {"id": order_id, "status": _status(order), "amount": order["amount"]}}
+
+
+@app.post("/_mock/orders/{order_id}/status")
+async def set_order_status(order_id: int, body: dict):
+    order = orders.get(order_id)
+    if order is None:
+        raise HTTPException(404, "Order not found")
+    order["status"] = body["status"]
+    return {"order": {"id": order_id, "status": order["status"]}}
+
+
+@app.get("/_mock/stats")
+async def mock_stats():
+    by_status: dict[str, int] = {}
+    for order in orders.values():
+        status = _status(order)
+        by_status[status] = by_status.get(status, 0) + 1
+    return {"orders": len(orders), "by_status": by_status, "config": config}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=config["latency"], help="seconds")
+    parser.add_argument("--jitter", type=float, default=config["jitter"], help="seconds")
+    parser.add_argument("--auto-pay-after", type=float, default=config["auto_pay_after"], help="seconds, <0 disables")
+    args = parser.parse_args()
+
+    config.update(latency=args.latency, jitter=args.jitter, auto_pay_after=args.auto_pay_after)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
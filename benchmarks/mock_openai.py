@@ -0,0 +1,264 @@
+"""
+Локальная замена OpenAI chat-completions для бенчмарков и CI без сети.
+
+Отвечает на POST /v1/chat/completions так, как этого ждёт openai_service:
+  - response_format=json_schema  → {"items": [...]} (single-call режим, в т.ч. stream=true)
+  - tools                         → tool call search_products с названиями товаров
+  - response_format=json_object   → итоговый JSON legacy-режима из результата tool
+
+usage считается по частям запроса (текст ~4 символа на токен, картинка — по
+detail) и с кэшем префикса, как у OpenAI: общий с прошлыми запросами префикс
+от 1024 токенов идёт в prompt_tokens_details.cached_tokens (с точностью до
+границы сообщения), а незакэшированные токены добавляют --prefill-ms задержки
+на каждую тысячу.
+
+Приложение направляется сюда через переменную окружения SDK:
+
+    python benchmarks/mock_openai.py --port 8081 --latency 0.8 --jitter 0.3
+    OPENAI_BASE_URL=http://127.0.0.1:8081/v1 OPENAI_API_KEY=sk-mock uvicorn main:app
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# "название:количество" через запятую — товары, которые модель «видит» на каждом фото
+MOCK_OPENAI_ITEMS      = os.getenv("MOCK_OPENAI_ITEMS", "Coca-Cola:2,Lay's:1,Snickers:1")
+MOCK_OPENAI_LATENCY    = float(os.getenv("MOCK_OPENAI_LATENCY", "0.5"))     # сек, медиана ответа
+MOCK_OPENAI_JITTER     = float(os.getenv("MOCK_OPENAI_JITTER", "0.2"))      # сек, ± к задержке
+MOCK_OPENAI_ERROR_RATE = float(os.getenv("MOCK_OPENAI_ERROR_RATE", "0"))    # доля ответов 429
+MOCK_OPENAI_CHUNK      = int(os.getenv("MOCK_OPENAI_CHUNK", "16"))          # символов в stream-чанке
+MOCK_OPENAI_PREFILL_MS = float(os.getenv("MOCK_OPENAI_PREFILL_MS", "0"))    # мс на 1000 незакэшированных токенов
+
+# Как у OpenAI: кэшируется префикс от 1024 токенов, шагами по 128
+_CACHE_MIN_TOKENS = 1024
+_CACHE_STEP = 128
+_IMAGE_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+app = FastAPI(title="Mock OpenAI")
+config = {
+    "items":      MOCK_OPENAI_ITEMS,
+    "latency":    MOCK_OPENAI_LATENCY,
+    "jitter":     MOCK_OPENAI_JITTER,
+    "error_rate": MOCK_OPENAI_ERROR_RATE,
+    "prefill_ms": MOCK_OPENAI_PREFILL_MS,
+}
+stats = {"requests": 0, "rate_limited": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+_prefix_cache: set[str] = set()
+
+
+def _items() -> list[dict]:
+    items = []
+    for part in config["items"].split(","):
+        name, _, quantity = part.strip().partition(":")
+        if name:
+            items.append({"name": name, "query": name, "quantity": int(quantity or 1), "confidence": 0.9})
+    return items
+
+
+def _delay() -> float:
+    return max(0.0, config["latency"] + random.uniform(-config["jitter"], config["jitter"]))
+
+
+def _prompt_parts(body: dict) -> list[tuple[str, int]]:
+    """(содержимое для хэша, токены) по порядку: tools и схема ответа, затем сообщения."""
+    parts = []
+    head = json.dumps([body.get("tools"), body.get("response_format")], sort_keys=True)
+    parts.append((head, len(head) // 4))
+    for m in body.get("messages", []):
+        content = m.get("content")
+        if isinstance(content, str) or content is None:
+            text = json.dumps([m.get("role"), content, m.get("tool_calls")])
+            parts.append((text, len(text) // 4))
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                image = part["image_url"]
+                parts.append((image["url"], _IMAGE_TOKENS.get(image.get("detail", "auto"), 765)))
+            else:
+                parts.append((part.get("text", ""), len(part.get("text", "")) // 4))
+    return parts
+
+
+def _cached_tokens(model: str, parts: list[tuple[str, int]]) -> int:
+    """Самый длинный уже виденный префикс (по границам частей); запоминает префиксы запроса."""
+    digest = hashlib.sha256(model.encode())   # кэш у каждой модели свой
+    tokens = cached = 0
+    for content, count in parts:
+        digest.update(content.encode())
+        tokens += count
+        key = digest.hexdigest()
+        if key in _prefix_cache and tokens >= _CACHE_MIN_TOKENS:
+            cached = tokens // _CACHE_STEP * _CACHE_STEP
+        _prefix_cache.add(key)
+    return cached
+
+
+def _usage(body: dict, completion: str) -> dict:
+    parts = _prompt_parts(body)
+    prompt = sum(count for _, count in parts)
+    cached = _cached_tokens(body.get("model", ""), parts)
+    completion_tokens = max(1, len(completion) // 4)
+    stats["prompt_tokens"] += prompt
+    stats["cached_tokens"] += cached
+    stats["completion_tokens"] += completion_tokens
+    return {
+        "prompt_tokens":         prompt,
+        "completion_tokens":     completion_tokens,
+        "total_tokens":          prompt + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def _prefill(usage: dict) -> float:
+    """Задержка на обработку незакэшированной части промпта, сек."""
+    uncached = usage["prompt_tokens"] - usage["prompt_tokens_details"]["cached_tokens"]
+    return config["prefill_ms"] * uncached / 1000 / 1000
+
+
+def _completion(model: str, message: dict, usage: dict, finish_reason: str = "stop") -> dict:
+    return {
+        "id":      f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object":  "chat.completion",
+        "created": int(time.time()),
+        "model":   model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason, "logprobs": None}],
+        "usage":   usage,
+    }
+
+
+def _legacy_result(messages: list) -> dict:
+    """Второй вызов legacy-режима: каждый найденный tool'ом товар — одна позиция."""
+    products = []
+    for m in messages:
+        if m.get("role") == "tool":
+            products = json.loads(m["content"])
+    items = [
+        {"product_id": p["id"], "name": p["name"], "price": p["price"], "quantity": 1, "confidence": 0.9}
+        for p in products
+    ]
+    return {"recognized_items": items, "unrecognized": [], "total": sum(p["price"] for p in products)}
+
+
+async def _stream(model: str, content: str, usage: dict | None, delay: float):
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    parts = [content[i:i + MOCK_OPENAI_CHUNK] for i in range(0, len(content), MOCK_OPENAI_CHUNK)]
+    # Половина задержки — до первого токена, остальное размазано по чанкам
+    await asyncio.sleep(delay / 2)
+    for i, part in enumerate(parts):
+        chunk = {
+            "id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{
+                "index": 0,
+                "delta": {"role": "assistant", "content": part} if i == 0 else {"content": part},
+                "finish_reason": None,
+            }],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(delay / 2 / len(parts))
+    final = {
+        "id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+    }
+    yield f"data: {json.dumps(final)}\n\n"
+    if usage is not None:
+        tail = {
+            "id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [], "usage": usage,
+        }
+        yield f"data: {json.dumps(tail)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    model = body.get("model", "mock")
+    messages = body.get("messages", [])
+
+    if random.random() < config["error_rate"]:
+        stats["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+
+    delay = _delay()
+    response_format = (body.get("response_format") or {}).get("type")
+
+    if body.get("tools") and not any(m.get("role") == "tool" for m in messages):
+        arguments = json.dumps({"queries": [i["query"] for i in _items()]})
+        message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": "search_products", "arguments": arguments},
+            }],
+        }
+        usage = _usage(body, arguments)
+        await asyncio.sleep(delay + _prefill(usage))
+        return _completion(model, message, usage, "tool_calls")
+
+    if response_format == "json_object":
+        content = json.dumps(_legacy_result(messages), ensure_ascii=False)
+    else:
+        content = json.dumps({"items": _items()}, ensure_ascii=False)
+    usage = _usage(body, content)
+    delay += _prefill(usage)
+
+    if body.get("stream"):
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+        return StreamingResponse(
+            _stream(model, content, usage if include_usage else None, delay),
+            media_type="text/event-stream",
+        )
+
+    await asyncio.sleep(delay)
+    return _completion(model, {"role": "assistant", "content": content}, usage)
+
+
+@app.get("/_mock/stats")
+async def mock_stats():
+    return {**stats, "config": config}
+
+
+@app.post("/_mock/reset")
+async def mock_reset():
+    """Обнуляет счётчики и кэш префиксов — между прогонами бенчмарка."""
+    for key in stats:
+        stats[key] = 0
+    _prefix_cache.clear()
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--items", default=config["items"], help='e.g. "Coca-Cola:2,Snickers:1"')
+    parser.add_argument("--latency", type=float, default=config["latency"], help="seconds")
+    parser.add_argument("--jitter", type=float, default=config["jitter"], help="seconds")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"], help="share of 429 responses")
+    parser.add_argument("--prefill-ms", type=float, default=config["prefill_ms"],
+                        help="extra latency per 1000 uncached prompt tokens, ms")
+    args = parser.parse_args()
+
+    config.update(items=args.items, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                  prefill_ms=args.prefill_ms)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
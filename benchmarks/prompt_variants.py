@@ -0,0 +1,204 @@
+"""
+Токены и задержка вызова модели для разных раскладок промпта
+(PROMPT_VARIANT: baseline, prefix, hint) — против mock OpenAI, без сети.
+
+Сам поднимает benchmarks/mock_openai.py (usage с кэшем префикса, задержка
+растёт с числом незакэшированных токенов) и временную БД с --products
+товарами, затем для каждого варианта гоняет --requests вызовов detect_items
+(или recognize_from_image с --mode legacy) на разных картинках:
+
+    python benchmarks/prompt_variants.py --requests 100 --concurrency 4
+    python benchmarks/prompt_variants.py --mode legacy --detail high --prefill-ms 60
+    python benchmarks/prompt_variants.py --variants prefix,hint --prefix-tokens 1152
+
+effective — входные токены с учётом скидки на закэшированные (--cached-price,
+доля от полной цены).
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from PIL import Image
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+_BRANDS = [
+    "Coca-Cola", "Pepsi", "Fanta", "Sprite", "Red Bull", "Lipton", "Nestle", "Milka", "Snickers",
+    "Mars", "Twix", "Bounty", "KitKat", "Lay's", "Pringles", "Cheetos", "Orbit", "Bonaqua",
+    "Danone", "Activia", "Ariel", "Tide", "Colgate", "Head&Shoulders", "Rakhat", "Maxwell",
+    "Jacobs", "Nescafe", "Alpen Gold", "Oreo", "Barilla", "Heinz", "Hochland", "President",
+]
+_CATEGORIES = ["Напитки", "Снеки", "Сладости", "Продукты", "Молочное", "Бытовая химия", "Гигиена", "Бакалея"]
+
+
+def _image(size: int) -> bytes:
+    buf = io.BytesIO()
+    Image.effect_noise((size, size), random.randint(10, 90)).convert("RGB").save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def _brands(count: int) -> list[str]:
+    """Известные бренды и до count вымышленных (у реального магазина их сотни)."""
+    brands = list(_BRANDS)
+    while len(brands) < count:
+        brands.append("".join(random.choice("bcdfgklmnprstvz") + random.choice("aeiou") for _ in range(3)).title())
+    return brands[:count]
+
+
+async def _seed(count: int, brands: list[str]) -> None:
+    import database
+
+    rows = [
+        (f"{random.choice(brands)} {i}", random.choice(_CATEGORIES), round(random.uniform(100, 3000), 2), f"3{i:012d}")
+        for i in range(count)
+    ]
+    async with database._write() as db:
+        await db.executemany("INSERT INTO products (name, category, price, barcode) VALUES (?, ?, ?, ?)", rows)
+        await db.commit()
+
+
+def _percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[max(0, int(-(-len(values) * p // 100)) - 1)]
+
+
+async def _run_variant(variant: str, images: list, args, mock: httpx.AsyncClient) -> dict:
+    from services import openai_service
+    from services.openai_service import PromptBuilder, detect_items, recognize_from_image
+
+    openai_service.prompt_builder = PromptBuilder(variant)
+    await mock.post("/_mock/reset")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+
+    async def one(prepared, known):
+        async with semaphore:
+            started = time.perf_counter()
+            if args.mode == "legacy":
+                await recognize_from_image(prepared.base64, known, prepared.detail)
+            else:
+                await detect_items(prepared.base64, known, prepared.detail)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        one(prepared, ["Coca-Cola 1L"] if i % 4 == 0 else None) for i, prepared in enumerate(images)
+    ))
+    elapsed = time.perf_counter() - started
+
+    stats = (await mock.get("/_mock/stats")).json()
+    calls = max(1, stats["requests"])
+    prompt, cached = stats["prompt_tokens"], stats["cached_tokens"]
+    return {
+        "variant":         variant,
+        "calls":           stats["requests"],
+        "prompt_per_call": round(prompt / calls),
+        "cached_per_call": round(cached / calls),
+        "cached_share":    round(cached / prompt, 3) if prompt else 0.0,
+        "effective":       round((prompt - cached + cached * args.cached_price) / calls),
+        "completion":      round(stats["completion_tokens"] / calls),
+        "p50_ms":          round(_percentile(latencies, 50) * 1000, 1),
+        "p95_ms":          round(_percentile(latencies, 95) * 1000, 1),
+        "req_per_s":       round(len(latencies) / elapsed, 2),
+    }
+
+
+async def run(args) -> list[dict]:
+    import database
+    from services.http_clients import close_clients
+    from services.image_service import preprocess_image
+
+    await database.init_db()
+    await database.open_pool()
+    try:
+        await _seed(args.products, _brands(args.brands))
+        images = [await preprocess_image(_image(args.image_size)) for _ in range(args.requests)]
+        if args.detail != "auto":
+            for prepared in images:
+                prepared.detail = args.detail
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.openai_port}") as mock:
+            return [await _run_variant(v, images, args, mock) for v in args.variants.split(",")]
+    finally:
+        await close_clients()
+        await database.close_pool()
+
+
+def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url}: process exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start in {timeout}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", default="baseline,prefix,hint")
+    parser.add_argument("--mode", choices=("single", "legacy"), default="single")
+    parser.add_argument("--requests", type=int, default=100, help="calls per variant")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--brands", type=int, default=500, help="distinct brands in the seeded catalogue")
+    parser.add_argument("--image-size", type=int, default=1024, help="px, square noise JPEG")
+    parser.add_argument("--detail", choices=("auto", "low", "high"), default="auto")
+    parser.add_argument("--openai-port", type=int, default=18091)
+    parser.add_argument("--latency", type=float, default=0.3, help="mock model base latency, seconds")
+    parser.add_argument("--prefill-ms", type=float, default=40, help="mock latency per 1000 uncached prompt tokens")
+    parser.add_argument("--prefix-tokens", type=int, default=0, help="PROMPT_PREFIX_TOKENS, 0 = no brand padding")
+    parser.add_argument("--cached-price", type=float, default=0.1, help="price of a cached input token vs uncached")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    os.environ.update({
+        "DB_PATH":          os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db"),
+        "OPENAI_BASE_URL":  f"http://127.0.0.1:{args.openai_port}/v1",
+        "OPENAI_API_KEY":   "sk-mock",
+        "RECOGNITION_MODE": args.mode,
+        "PROMPT_PREFIX_TOKENS": str(args.prefix_tokens),
+        # вёдра допуска общие для всех вариантов — последний упирался бы в TPM
+        "OPENAI_RPM":       "0",
+        "OPENAI_TPM":       "0",
+        "OPENAI_MAX_CONCURRENCY": str(args.concurrency),
+    })
+    mock = subprocess.Popen(
+        [sys.executable, "benchmarks/mock_openai.py", "--port", str(args.openai_port),
+         "--latency", str(args.latency), "--jitter", str(args.latency / 4), "--prefill-ms", str(args.prefill_ms)],
+        cwd=ROOT,
+    )
+    try:
+        _wait_ready(f"http://127.0.0.1:{args.openai_port}/_mock/stats", mock)
+        rows = asyncio.run(run(args))
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+
+    print(f"{'variant':<10} {'calls':>6} {'prompt':>7} {'cached':>7} {'share':>6} {'effective':>9} "
+          f"{'compl':>6} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>7}")
+    for r in rows:
+        print(f"{r['variant']:<10} {r['calls']:>6} {r['prompt_per_call']:>7} {r['cached_per_call']:>7} "
+              f"{r['cached_share']:>6} {r['effective']:>9} {r['completion']:>6} {r['p50_ms']:>8} "
+              f"{r['p95_ms']:>8} {r['req_per_s']:>7}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Пиковая память на запрос: загрузка, прочитанная целиком (прежний /recognize/file),
+против загрузки, которая хэшируется и декодируется прямо из spooled-файла.
+
+Каждый режим запускается в отдельном процессе; печатается прирост пикового RSS
+относительно процесса после импорта и подготовки входных файлов.
+
+    python benchmarks/upload_memory.py --size 4000x3000 --concurrency 4 --requests 16
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PIL import Image  # noqa: E402
+
+from services.image_service import file_sha256, preprocess_image_bytes, preprocess_image_file  # noqa: E402
+
+# Starlette сбрасывает загрузку на диск после 1 МБ
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def _peak_rss() -> int:
+    """Пиковый RSS процесса в байтах (ru_maxrss: КБ на Linux, байты на macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _photo(width: int, height: int) -> bytes:
+    """JPEG, похожий по размеру на фото с телефона: градиент + шум."""
+    img = Image.merge("RGB", [
+        Image.linear_gradient("L").resize((width, height)),
+        Image.effect_noise((width, height), 60),
+        Image.radial_gradient("L").resize((width, height)),
+    ])
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=92)
+    return out.getvalue()
+
+
+def _spooled(data: bytes) -> tempfile.SpooledTemporaryFile:
+    f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    f.write(data)
+    f.seek(0)
+    return f
+
+
+def _buffered(upload) -> int:
+    data = upload.read()
+    hashlib.sha256(data).hexdigest()
+    return len(preprocess_image_bytes(data).base64)
+
+
+def _streaming(upload) -> int:
+    file_sha256(upload)
+    return len(preprocess_image_file(upload).base64)
+
+
+def _run_mode(mode: str, path: str, concurrency: int, requests: int) -> dict:
+    with open(path, "rb") as f:
+        data = f.read()
+    uploads = [_spooled(data) for _ in range(requests)]
+    del data
+    handler = _buffered if mode == "buffered" else _streaming
+
+    baseline = _peak_rss()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(handler, uploads))
+    peak = _peak_rss()
+    return {
+        "mode":              mode,
+        "peak_delta_mb":     round((peak - baseline) / 2**20, 1),
+        "per_request_mb":    round((peak - baseline) / 2**20 / concurrency, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="4000x3000", help="photo size, WxH")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--mode", choices=("buffered", "streaming"), help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(_run_mode(args.mode, args.input, args.concurrency, args.requests)))
+        return
+
+    width, height = (int(v) for v in args.size.split("x"))
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        f.write(_photo(width, height))
+        path = f.name
+    try:
+        print(f"photo {args.size}, {os.path.getsize(path) / 2**20:.1f} MB, "
+              f"concurrency {args.concurrency}, {args.requests} requests")
+        for mode in ("buffered", "streaming"):
+            out = subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--input", path,
+                 "--concurrency", str(args.concurrency), "--requests", str(args.requests)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            r = json.loads(out)
+            print(f"{r['mode']:<10} peak +{r['peak_delta_mb']:>7.1f} MB   ~{r['per_request_mb']:>6.1f} MB/request")
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,368 @@
+import asyncio
 import aiosqlite
+import json
+import logging
 import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterable, AsyncIterator, Callable
+
+from services.metrics import timed
 
 DB_PATH = os.getenv("DB_PATH", "shop.db")
 
+logger = logging.getLogger(__name__)
+
+# ── Настройки пула соединений ─────────────────────────────────────────────────
+DB_POOL_SIZE  = int(os.getenv("DB_POOL_SIZE", "4"))                  # число read-only соединений
+DB_MMAP_SIZE  = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # байт
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", "-65536"))            # <0 — KiB, >0 — страницы
+
+# ── Массовый импорт ───────────────────────────────────────────────────────────
+BULK_CHUNK_ROWS  = int(os.getenv("BULK_CHUNK_ROWS", "500"))     # строк на транзакцию
+BULK_MAX_ERRORS  = int(os.getenv("BULK_MAX_ERRORS", "1000"))    # строк ошибок в отчёте
+
+
+class _Pool:
+    """
+    Долгоживущие соединения к SQLite:
+      - один writer (все записи сериализуются через lock)
+      - DB_POOL_SIZE reader'ов в режиме read-only (WAL позволяет читать параллельно с записью)
+    """
+
+    def __init__(self):
+        self.writer: aiosqlite.Connection | None = None
+        self.readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self.all_readers: list[aiosqlite.Connection] = []
+        self.write_lock = asyncio.Lock()
+
+
+_pool: _Pool | None = None
+
+
+async def _apply_pragmas(db: aiosqlite.Connection, *, readonly: bool) -> None:
+    if not readonly:
+        # journal_mode хранится в файле БД — достаточно выставить с writer'а
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    await db.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA busy_timeout=5000")
+
+
+async def _connect(*, readonly: bool) -> aiosqlite.Connection:
+    if readonly:
+        db = await aiosqlite.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    else:
+        db = await aiosqlite.connect(DB_PATH)
+    db.row_factory = aiosqlite.Row  # доступ по имени колонки
+    await _apply_pragmas(db, readonly=readonly)
+    return db
+
+
+async def open_pool(size: int = DB_POOL_SIZE) -> None:
+    """Открывает writer и пул reader'ов. Вызывается из lifespan после init_db()."""
+    global _pool
+    if _pool is not None:
+        return
+
+    pool = _Pool()
+    pool.writer = await _connect(readonly=False)
+    for _ in range(max(1, size)):
+        reader = await _connect(readonly=True)
+        pool.all_readers.append(reader)
+        pool.readers.put_nowait(reader)
+    _pool = pool
+
+
+async def close_pool() -> None:
+    """Закрывает все соединения пула. Вызывается из lifespan при остановке."""
+    global _pool
+    if _pool is None:
+        return
+
+    pool, _pool = _pool, None
+    async with pool.write_lock:
+        for reader in pool.all_readers:
+            await reader.close()
+        if pool.writer is not None:
+            # Сливаем WAL в основной файл, чтобы не оставлять его после остановки
+            await pool.writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await pool.writer.close()
+
+
+@asynccontextmanager
+async def _read():
+    """Соединение на чтение: из пула, либо временное, если пул не открыт (скрипты, тесты)."""
+    pool = _pool
+    if pool is None:
+        async with aiosqlite.connect(DB_PATH) as db:
+            db.row_factory = aiosqlite.Row
+            yield db
+        return
+
+    db = await pool.readers.get()
+    try:
+        yield db
+    finally:
+        pool.readers.put_nowait(db)
+
+
+@asynccontextmanager
+async def _write():
+    """Соединение на запись: единственный writer под lock'ом, либо временное."""
+    pool = _pool
+    if pool is None:
+        async with aiosqlite.connect(DB_PATH) as db:
+            db.row_factory = aiosqlite.Row
+            yield db
+        return
+
+    async with pool.write_lock:
+        try:
+            yield pool.writer
+        except BaseException:
+            await pool.writer.rollback()
+            raise
+
+
+# ── Подписчики на изменения товаров ───────────────────────────────────────────
+# Кэши и индексы в памяти патчатся после каждой записи через эти колбэки:
+#   listener("upsert", product_id, row)  — row: полная строка товара
+#   listener("delete", product_id, None)
+#   listener("reload", 0, None)          — массовое изменение: перечитать всё
+ProductListener = Callable[[str, int, dict | None], None]
+
+_listeners: list[ProductListener] = []
+
+
+def add_product_listener(listener: ProductListener) -> None:
+    """Подписывает колбэк на изменения товаров (вызывается после commit)."""
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_product_listener(listener: ProductListener) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def _notify(kind: str, product_id: int, row: dict | None) -> None:
+    # Запись уже закоммичена: упавший кэш не должен превращать её в 500
+    # и оставлять без уведомления остальных подписчиков
+    for listener in list(_listeners):
+        try:
+            listener(kind, product_id, row)
+        except Exception:
+            logger.exception("Product listener %r failed on %s %s", listener, kind, product_id)
+
+
+# ── Полнотекстовый индекс ─────────────────────────────────────────────────────
+# FTS5 с триграммным токенайзером находит подстроки (как LIKE '%q%'), но по индексу.
+# Контент не дублируется: external content таблица поверх products + триггеры.
+FTS_MIN_QUERY_LEN   = 3    # trigram не ищет подстроки короче 3 символов
+_MAX_UNION_BRANCHES = 400
+_SEARCH_COLUMNS = "p.id, p.name, p.category, p.description, p.price, p.image_url, p.barcode"
+
+_fts_enabled = False
+
+
+async def _migrate_products(db: aiosqlite.Connection) -> None:
+    """Колонки, добавленные после создания таблицы в существующих БД."""
+    cursor = await db.execute("PRAGMA table_info(products)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if "name_kz" not in columns:
+        await db.execute("ALTER TABLE products ADD COLUMN name_kz TEXT")
+
+
+async def _init_fts(db: aiosqlite.Connection) -> None:
+    """Создаёт products_fts и триггеры синхронизации; при первом создании заполняет индекс."""
+    global _fts_enabled
+
+    cursor = await db.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+    )
+    row = await cursor.fetchone()
+    existed = row is not None
+    if existed and "name_kz" not in row[0]:
+        # Индекс прежней версии без name_kz — пересоздаём с триггерами
+        await db.executescript("""
+            DROP TRIGGER IF EXISTS products_fts_ai;
+            DROP TRIGGER IF EXISTS products_fts_ad;
+            DROP TRIGGER IF EXISTS products_fts_au;
+            DROP TABLE products_fts;
+        """)
+        existed = False
+
+    try:
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                name, name_kz, description, barcode,
+                content='products', content_rowid='id',
+                tokenize='trigram'
+            )
+        """)
+    except aiosqlite.OperationalError:
+        # SQLite < 3.34 без trigram — остаёмся на LIKE
+        _fts_enabled = False
+        return
+
+    await db.executescript("""
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts(rowid, name, name_kz, description, barcode)
+            VALUES (new.id, new.name, new.name_kz, new.description, new.barcode);
+        END;
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, name_kz, description, barcode)
+            VALUES ('delete', old.id, old.name, old.name_kz, old.description, old.barcode);
+        END;
+        CREATE TRIGGER IF NOT EXISTS products_fts_au
+        AFTER UPDATE OF name, name_kz, description, barcode ON products BEGIN
+            INSERT INTO products_fts(products_fts, rowid, name, name_kz, description, barcode)
+            VALUES ('delete', old.id, old.name, old.name_kz, old.description, old.barcode);
+            INSERT INTO products_fts(rowid, name, name_kz, description, barcode)
+            VALUES (new.id, new.name, new.name_kz, new.description, new.barcode);
+        END;
+    """)
+
+    if not existed:
+        await db.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+    _fts_enabled = True
+
+
+# Индекс по штрихкоду частичный: планировщик SQLite берёт его, только если
+# в запросе есть то же условие, — без него `barcode = ?` сканирует таблицу.
+# '' и строка 'null' (мусор старых импортов) — «штрихкода нет»
+EMPTY_BARCODES = ("", "null")
+_BARCODE_INDEXED = "barcode IS NOT NULL AND barcode NOT IN ('', 'null')"
+
+
+def normalize_barcode(barcode: str | None) -> str | None:
+    """Штрихкод для записи: без пробелов по краям; '' и 'null' (любой регистр) → None."""
+    if barcode is None:
+        return None
+    barcode = barcode.strip()
+    return None if barcode.lower() in EMPTY_BARCODES else barcode
+
+
+async def _init_barcode_index(db: aiosqlite.Connection) -> None:
+    """Уникальный индекс по штрихкоду (NULL, пустые и 'null' не участвуют)."""
+    # Миграция: пустые и 'null' штрихкоды → NULL, иначе они ломают уникальность
+    cursor = await db.execute(
+        "SELECT id FROM products WHERE barcode IS NOT NULL AND LOWER(TRIM(barcode)) IN ('', 'null')"
+    )
+    empty_ids = [row[0] for row in await cursor.fetchall()]
+    if empty_ids:
+        await db.executemany("UPDATE products SET barcode = NULL WHERE id = ?", [(i,) for i in empty_ids])
+        for product_id in empty_ids:
+            await _log_change(db, product_id, "upsert")
+        logger.info("Cleared %d empty or 'null' barcodes", len(empty_ids))
+
+    # Индекс прежней версии с другим условием — пересоздаём
+    cursor = await db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_products_barcode%'"
+    )
+    for name, sql in await cursor.fetchall():
+        if _BARCODE_INDEXED not in (sql or ""):
+            await db.execute(f"DROP INDEX {name}")
+
+    try:
+        await db.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_products_barcode
+            ON products (barcode) WHERE {_BARCODE_INDEXED}
+        """)
+    except aiosqlite.IntegrityError:
+        # В старой базе есть дубликаты — индексируем без уникальности, чтобы
+        # поиск по штрихкоду работал быстро. Но 409 на дубликат и upsert
+        # массового импорта по штрихкоду держатся только на уникальном индексе
+        cursor = await db.execute(f"""
+            SELECT barcode FROM products WHERE {_BARCODE_INDEXED}
+            GROUP BY barcode HAVING COUNT(*) > 1 LIMIT 5
+        """)
+        duplicates = [row[0] for row in await cursor.fetchall()]
+        logger.warning(
+            "Duplicate barcodes in products (e.g. %s): barcode uniqueness is NOT enforced, "
+            "fix the duplicates and restart",
+            ", ".join(duplicates),
+        )
+        await db.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_products_barcode_nonunique
+            ON products (barcode) WHERE {_BARCODE_INDEXED}
+        """)
+    else:
+        await db.execute("DROP INDEX IF EXISTS idx_products_barcode_nonunique")
+
+
+async def _init_orders(db: aiosqlite.Connection) -> None:
+    """Таблицы заказов: рабочие orders/order_items и архив завершённых."""
+    await db.executescript("""
+        CREATE TABLE IF NOT EXISTS orders (
+            our_order_id    TEXT PRIMARY KEY,
+            forte_order_id  INTEGER,
+            forte_password  TEXT,
+            status          TEXT NOT NULL DEFAULT 'pending',   -- pending | paid | failed
+            total           REAL NOT NULL,
+            created_at      TEXT DEFAULT (datetime('now')),
+            updated_at      TEXT DEFAULT (datetime('now'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at);
+        CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at);
+
+        CREATE TABLE IF NOT EXISTS order_items (
+            our_order_id  TEXT NOT NULL,
+            line          INTEGER NOT NULL,
+            product_id    INTEGER,
+            name          TEXT,
+            price         REAL,
+            quantity      INTEGER,
+            PRIMARY KEY (our_order_id, line)
+        ) WITHOUT ROWID;
+
+        -- Лизы фоновых задач: одну задачу выполняет один воркер из нескольких
+        CREATE TABLE IF NOT EXISTS leases (
+            name        TEXT PRIMARY KEY,
+            owner       TEXT NOT NULL,
+            expires_at  REAL NOT NULL                 -- unix time
+        );
+
+        -- Idempotency-Key: ответы на повторы POST /checkout/create и /recognize
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key          TEXT PRIMARY KEY,         -- scope:ключ клиента
+            fingerprint  TEXT NOT NULL,            -- SHA-256 тела запроса
+            status       INTEGER,                  -- NULL — запрос ещё выполняется
+            response     TEXT,                     -- JSON-тело ответа
+            expires_at   REAL NOT NULL             -- unix time
+        );
+        CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            our_order_id    TEXT PRIMARY KEY,
+            forte_order_id  INTEGER,
+            forte_password  TEXT,
+            status          TEXT NOT NULL,
+            total           REAL NOT NULL,
+            items           TEXT NOT NULL,            -- JSON
+            created_at      TEXT,
+            updated_at      TEXT,
+            archived_at     TEXT DEFAULT (datetime('now'))
+        );
+    """)
+
 
 async def init_db():
     """Создаёт таблицу и наполняет тестовыми данными при первом запуске."""
     async with aiosqlite.connect(DB_PATH) as db:
+        # Воркеры uvicorn стартуют одновременно — ждём чужую блокировку схемы
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute("PRAGMA journal_mode=WAL")
         await db.execute("""
             CREATE TABLE IF NOT EXISTS products (
                 id          INTEGER PRIMARY KEY AUTOINCREMENT,
                 name        TEXT NOT NULL,
+                name_kz     TEXT,
                 category    TEXT,
                 description TEXT,
                 price       REAL NOT NULL,
@@ -20,6 +372,26 @@ async def init_db():
                 created_at  TEXT DEFAULT (datetime('now'))
             )
         """)
+        await _migrate_products(db)
+        await _init_fts(db)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS product_changes (
+                version     INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id  INTEGER NOT NULL,
+                op          TEXT NOT NULL,              -- upsert | delete
+                changed_at  TEXT DEFAULT (datetime('now'))
+            )
+        """)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_product_changes_product ON product_changes (product_id)"
+        )
+        # Keyset-пагинация: ORDER BY name, id и фильтр по категории идут по индексу
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_products_name_id ON products (name, id)")
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_products_category_name_id ON products (category, name, id)"
+        )
+        await _init_barcode_index(db)
+        await _init_orders(db)
         await db.commit()
 
         # Наполняем только если таблица пустая
@@ -28,64 +400,135 @@ async def init_db():
         if count == 0:
             await db.executemany(
                 """INSERT INTO products
-                   (name, category, description, price, barcode)
-                   VALUES (?, ?, ?, ?, ?)""",
+                   (name, name_kz, category, description, price, barcode)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
                 [
-                    ("Coca-Cola 1L",         "Напитки",  "Газированный напиток Coca-Cola 1 литр",       450,  "4870200013834"),
-                    ("Lay's Сметана 150г",   "Снеки",    "Чипсы картофельные со вкусом сметаны",        350,  "4823063107456"),
-                    ("Sprite 0.5L",          "Напитки",  "Газированный напиток Sprite 500 мл",           320,  "5449000014238"),
-                    ("Шоколад Milka 90г",    "Сладости", "Молочный шоколад с альпийским молоком",        520,  "7622300441937"),
-                    ("Чай Lipton 25 пак",    "Продукты", "Чай чёрный в пакетиках",                       680,  "8712100851637"),
-                    ("Red Bull 250мл",       "Напитки",  "Энергетический напиток Red Bull",              750,  "9002490100070"),
-                    ("Snickers 50г",         "Сладости", "Шоколадный батончик Snickers",                 280,  "4600831012501"),
-                    ("Orbit Spearmint",      "Прочее",   "Жевательная резинка Orbit мята",               250,  "4009900476003"),
-                    ("Вода Bonaqua 1L",      "Напитки",  "Питьевая вода без газа",                       200,  "4870200011502"),
-                    ("Pringles Original",    "Снеки",    "Чипсы Pringles в тубе оригинальные",           890,  "0038000845598"),
+                    ("Coca-Cola 1L",         None,                  "Напитки",  "Газированный напиток Coca-Cola 1 литр",       450,  "4870200013834"),
+                    ("Lay's Сметана 150г",   "Lay's Қаймақ 150г",   "Снеки",    "Чипсы картофельные со вкусом сметаны",        350,  "4823063107456"),
+                    ("Sprite 0.5L",          None,                  "Напитки",  "Газированный напиток Sprite 500 мл",           320,  "5449000014238"),
+                    ("Шоколад Milka 90г",    "Milka шоколады 90г",  "Сладости", "Молочный шоколад с альпийским молоком",        520,  "7622300441937"),
+                    ("Чай Lipton 25 пак",    "Lipton шайы 25 пак",  "Продукты", "Чай чёрный в пакетиках",                       680,  "8712100851637"),
+                    ("Red Bull 250мл",       None,                  "Напитки",  "Энергетический напиток Red Bull",              750,  "9002490100070"),
+                    ("Snickers 50г",         None,                  "Сладости", "Шоколадный батончик Snickers",                 280,  "4600831012501"),
+                    ("Orbit Spearmint",      None,                  "Прочее",   "Жевательная резинка Orbit мята",               250,  "4009900476003"),
+                    ("Вода Bonaqua 1L",      "Bonaqua суы 1L",      "Напитки",  "Питьевая вода без газа",                       200,  "4870200011502"),
+                    ("Pringles Original",    None,                  "Снеки",    "Чипсы Pringles в тубе оригинальные",           890,  "0038000845598"),
                 ],
             )
             await db.commit()
 
+        # Журнал пуст (новая БД или БД до появления журнала) — фиксируем текущий
+        # каталог как базовую версию, чтобы /products/changes?since=0 вернул всё
+        cursor = await db.execute("SELECT COUNT(*) FROM product_changes")
+        (changes,) = await cursor.fetchone()
+        if changes == 0:
+            await db.execute(
+                "INSERT INTO product_changes (product_id, op) SELECT id, 'upsert' FROM products ORDER BY id"
+            )
+            await db.commit()
+
+
+def _fts_phrase(q: str) -> str:
+    """Экранирует запрос как FTS5-фразу: подстрока целиком, как и в LIKE '%q%'."""
+    return '"' + q.replace('"', '""') + '"'
+
+
+def _search_branch(qi: int, q: str, limit: int) -> tuple[str, list]:
+    """Одна ветка UNION ALL: FTS5 MATCH, либо LIKE для коротких запросов."""
+    if _fts_enabled and len(q) >= FTS_MIN_QUERY_LEN:
+        sql = f"""
+            SELECT * FROM (
+                SELECT ? AS query_index, {_SEARCH_COLUMNS}, bm25(products_fts) AS score
+                FROM products_fts
+                JOIN products p ON p.id = products_fts.rowid
+                WHERE products_fts MATCH ? AND p.in_stock = 1
+                ORDER BY score
+                LIMIT ?
+            )
+        """
+        return sql, [qi, "{name name_kz description barcode} : " + _fts_phrase(q), limit]
+
+    pattern = f"%{q}%"
+    sql = f"""
+        SELECT * FROM (
+            SELECT ? AS query_index, {_SEARCH_COLUMNS}, 0.0 AS score
+            FROM products p
+            WHERE p.in_stock = 1
+              AND (p.name LIKE ? OR p.name_kz LIKE ? OR p.description LIKE ?)
+            LIMIT ?
+        )
+    """
+    return sql, [qi, pattern, pattern, pattern, limit]
+
+
+@timed("db.rank_search")
+async def rank_search(queries: list[str], limit_per_query: int = 2) -> list[dict]:
+    """
+    Ранжированный поиск по всем запросам за один round trip.
+
+    Каждый запрос — отдельная ветка UNION ALL со своим LIMIT; строки идут
+    по порядку запросов, внутри — по релевантности (bm25, меньше — лучше).
+    К колонкам товара добавляются query_index и score.
+    """
+    branches = [
+        _search_branch(qi, q.strip(), limit_per_query)
+        for qi, q in enumerate(queries)
+        if q and q.strip()
+    ]
+    if not branches:
+        return []
+
+    results: list[dict] = []
+    async with _read() as db:
+        # SQLite ограничивает число веток compound SELECT (по умолчанию 500)
+        for i in range(0, len(branches), _MAX_UNION_BRANCHES):
+            chunk = branches[i:i + _MAX_UNION_BRANCHES]
+            sql = " UNION ALL ".join(b[0] for b in chunk) + " ORDER BY query_index, score"
+            params = [p for b in chunk for p in b[1]]
+            cursor = await db.execute(sql, params)
+            results.extend(dict(row) for row in await cursor.fetchall())
+
+    return results
 
+
+@timed("db.search_products")
 async def search_products(queries: list[str]) -> list[dict]:
     """
-    LIKE-поиск по имени и описанию.
+    Поиск по имени, описанию и штрихкоду (FTS5 trigram).
     Для каждого запроса берём топ-2 результата, дедуплицируем по id.
     """
     results = []
     seen_ids: set[int] = set()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row  # доступ по имени колонки
-
-        for q in queries:
-            pattern = f"%{q}%"
-            cursor = await db.execute(
-                """
-                SELECT id, name, category, description, price, image_url, barcode
-                FROM products
-                WHERE in_stock = 1
-                  AND (name LIKE ? OR description LIKE ?)
-                LIMIT 2
-                """,
-                (pattern, pattern),
-            )
-            rows = await cursor.fetchall()
-            for row in rows:
-                if row["id"] not in seen_ids:
-                    seen_ids.add(row["id"])
-                    results.append(dict(row))
+    for row in await rank_search(queries, limit_per_query=2):
+        if row["id"] not in seen_ids:
+            seen_ids.add(row["id"])
+            row.pop("query_index")
+            row.pop("score")
+            results.append(row)
 
     return results
 
 
+_PRODUCT_COLUMNS = "id, name, name_kz, category, description, price, image_url, barcode, in_stock, created_at"
+
+
+async def _fetch_product(db: aiosqlite.Connection, product_id: int) -> dict | None:
+    cursor = await db.execute(
+        f"SELECT {_PRODUCT_COLUMNS} FROM products WHERE id = ?",
+        (product_id,)
+    )
+    row = await cursor.fetchone()
+    return dict(row) if row else None
+
+
+@timed("db.get_all_products")
 async def get_all_products() -> list[dict]:
     """Возвращает все товары из базы данных."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row  # доступ по имени колонки
-
+    async with _read() as db:
         cursor = await db.execute(
-            """
-            SELECT id, name, category, description, price, image_url, barcode, in_stock, created_at
+            f"""
+            SELECT {_PRODUCT_COLUMNS}
             FROM products
             ORDER BY name
             """
@@ -94,23 +537,249 @@ async def get_all_products() -> list[dict]:
         return [dict(row) for row in rows]
 
 
+PRODUCT_FIELDS = _PRODUCT_COLUMNS.split(", ")
+
+
+@timed("db.list_products_page")
+async def list_products_page(
+    after: tuple[str, int] | None = None,
+    limit: int = 100,
+    fields: list[str] | None = None,
+    category: str | None = None,
+) -> list[dict]:
+    """
+    Страница каталога в порядке (name, id) — keyset-пагинация без OFFSET.
+
+    after    — (name, id) последнего товара предыдущей страницы
+    fields   — проекция: выбираются только эти колонки; id и name выбираются
+               всегда, они нужны для курсора следующей страницы
+    category — точное совпадение категории
+    """
+    requested = [f for f in (fields or PRODUCT_FIELDS) if f in PRODUCT_FIELDS]
+    selected = list(dict.fromkeys(["id", "name", *requested]))
+
+    where = []
+    params: list = []
+    if category is not None:
+        where.append("category = ?")
+        params.append(category)
+    if after is not None:
+        where.append("(name, id) > (?, ?)")
+        params += list(after)
+
+    sql = f"SELECT {', '.join(selected)} FROM products"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY name, id LIMIT ?"
+    params.append(limit)
+
+    async with _read() as db:
+        cursor = await db.execute(sql, params)
+        rows = await cursor.fetchall()
+
+    return [dict(row) for row in rows]
+
+
+async def iter_products(
+    after: tuple[str, int] | None = None,
+    fields: list[str] | None = None,
+    category: str | None = None,
+    page_size: int = 500,
+) -> AsyncIterator[dict]:
+    """
+    Потоково отдаёт товары страницами по page_size.
+    Соединение берётся из пула только на время одной страницы, поэтому
+    медленный клиент не держит reader и длинную read-транзакцию.
+    """
+    while True:
+        page = await list_products_page(after, page_size, fields, category)
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        after = (page[-1]["name"], page[-1]["id"])
+
+
+@timed("db.get_product_by_id")
 async def get_product_by_id(product_id: int) -> dict | None:
     """Возвращает товар по ID или None, если не найден."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        
+    async with _read() as db:
+        return await _fetch_product(db, product_id)
+
+
+# ── Версия каталога и журнал изменений ────────────────────────────────────────
+# Каждая запись в products добавляет строку в product_changes в той же транзакции;
+# version (AUTOINCREMENT, не переиспользуется) — монотонная версия каталога.
+# На товар хранится только последняя запись: upsert либо tombstone (delete).
+async def _log_change(db: aiosqlite.Connection, product_id: int, op: str) -> int:
+    await db.execute("DELETE FROM product_changes WHERE product_id = ?", (product_id,))
+    cursor = await db.execute(
+        "INSERT INTO product_changes (product_id, op) VALUES (?, ?)",
+        (product_id, op)
+    )
+    return cursor.lastrowid
+
+
+async def _catalog_version(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM product_changes")
+    (version,) = await cursor.fetchone()
+    return version
+
+
+@timed("db.get_catalog_version")
+async def get_catalog_version() -> int:
+    """Текущая версия каталога (растёт при каждой записи)."""
+    async with _read() as db:
+        return await _catalog_version(db)
+
+
+@timed("db.get_catalog_snapshot")
+async def get_catalog_snapshot() -> tuple[int, list[dict]]:
+    """Версия и все товары, прочитанные в одной транзакции (согласованный снимок)."""
+    async with _read() as db:
+        await db.execute("BEGIN")
+        try:
+            version = await _catalog_version(db)
+            cursor = await db.execute(f"SELECT {_PRODUCT_COLUMNS} FROM products ORDER BY name")
+            products = [dict(row) for row in await cursor.fetchall()]
+        finally:
+            await db.execute("COMMIT")
+    return version, products
+
+
+# Бренд в названии: первое слово латиницей («Шоколад Milka 90г» → «Milka»),
+# а если его нет — первое слово («Рахат 200г» → «Рахат»)
+_LATIN_WORD = re.compile(r"[A-Za-z][\w'’&.-]*")
+
+
+def _brand_of(name: str) -> str:
+    match = _LATIN_WORD.search(name)
+    if match:
+        return match.group().rstrip(".-")
+    words = name.split()
+    return words[0] if words else ""
+
+
+@timed("db.get_catalog_summary")
+async def get_catalog_summary(categories: int = 20, brands: int = 80) -> dict:
+    """
+    Самые частые категории и бренды товаров в наличии (по числу товаров):
+    {"categories": [...], "brands": [...]}. Порядок детерминирован — при
+    неизменном каталоге текст подсказки модели не меняется.
+    """
+    async with _read() as db:
         cursor = await db.execute(
             """
-            SELECT id, name, category, description, price, image_url, barcode, in_stock, created_at
-            FROM products
-            WHERE id = ?
+            SELECT category FROM products
+            WHERE in_stock = 1 AND category IS NOT NULL AND category != ''
+            GROUP BY category ORDER BY COUNT(*) DESC, category LIMIT ?
             """,
-            (product_id,)
+            (categories,),
         )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        top_categories = [row[0] for row in await cursor.fetchall()]
+        counts: dict[str, int] = {}
+        if brands > 0:
+            cursor = await db.execute("SELECT name FROM products WHERE in_stock = 1")
+            for (name,) in await cursor.fetchall():
+                brand = _brand_of(name or "")
+                if len(brand) > 1:
+                    counts[brand] = counts.get(brand, 0) + 1
+    top_brands = sorted(counts, key=lambda b: (-counts[b], b))[:brands]
+    return {"categories": top_categories, "brands": top_brands}
+
+
+@timed("db.get_changes_since")
+async def get_changes_since(since: int) -> dict:
+    """
+    Дельта каталога после версии since:
+      {"version": текущая, "full_resync": bool, "upserted": [товары], "deleted": [id]}
+    full_resync — since из будущего (например, БД пересоздана): отдаём всё с нуля.
+    """
+    async with _read() as db:
+        await db.execute("BEGIN")
+        try:
+            version = await _catalog_version(db)
+            full_resync = since > version
+            if full_resync:
+                since = 0
+
+            cursor = await db.execute(
+                f"""
+                SELECT c.product_id AS change_product_id, c.op, {_SEARCH_COLUMNS}, p.name_kz, p.in_stock, p.created_at
+                FROM product_changes c
+                LEFT JOIN products p ON p.id = c.product_id
+                WHERE c.version > ?
+                ORDER BY c.version
+                """,
+                (since,)
+            )
+            rows = await cursor.fetchall()
+        finally:
+            await db.execute("COMMIT")
+
+    upserted: list[dict] = []
+    deleted: list[int] = []
+    for row in rows:
+        if row["op"] == "delete" or row["id"] is None:
+            deleted.append(row["change_product_id"])
+        else:
+            product = dict(row)
+            product.pop("change_product_id")
+            product.pop("op")
+            upserted.append(product)
+
+    return {
+        "version":     version,
+        "full_resync": full_resync,
+        "upserted":    upserted,
+        "deleted":     deleted,
+    }
+
+
+@timed("db.get_products_by_barcodes")
+async def get_products_by_barcodes(barcodes: list[str]) -> list[dict]:
+    """Товары по списку штрихкодов одним запросом (WHERE barcode IN (...))."""
+    barcodes = list(dict.fromkeys(b for b in barcodes if b))
+    if not barcodes:
+        return []
+
+    results: list[dict] = []
+    async with _read() as db:
+        # Лимит числа параметров в SQLite — режем на куски
+        for i in range(0, len(barcodes), 500):
+            chunk = barcodes[i:i + 500]
+            cursor = await db.execute(
+                f"""
+                SELECT {_PRODUCT_COLUMNS}
+                FROM products
+                WHERE barcode IN ({', '.join('?' * len(chunk))}) AND {_BARCODE_INDEXED}
+                """,
+                chunk
+            )
+            results.extend(dict(row) for row in await cursor.fetchall())
+    return results
+
+
+@timed("db.get_products_by_ids")
+async def get_products_by_ids(product_ids: list[int]) -> list[dict]:
+    """Товары по списку id одним запросом (WHERE id IN (...)); порядок не гарантирован."""
+    product_ids = list(dict.fromkeys(product_ids))
+    if not product_ids:
+        return []
+
+    results: list[dict] = []
+    async with _read() as db:
+        for i in range(0, len(product_ids), 500):
+            chunk = product_ids[i:i + 500]
+            cursor = await db.execute(
+                f"SELECT {_PRODUCT_COLUMNS} FROM products WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )
+            results.extend(dict(row) for row in await cursor.fetchall())
+    return results
 
 
+@timed("db.create_product")
 async def create_product(
     name: str,
     category: str | None = None,
@@ -118,21 +787,29 @@ async def create_product(
     price: float = 0.0,
     image_url: str | None = None,
     barcode: str | None = None,
-    in_stock: int = 1
+    in_stock: int = 1,
+    name_kz: str | None = None
 ) -> int:
     """Создаёт новый товар и возвращает его ID."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    barcode = normalize_barcode(barcode)
+    async with _write() as db:
         cursor = await db.execute(
             """
-            INSERT INTO products (name, category, description, price, image_url, barcode, in_stock)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO products (name, name_kz, category, description, price, image_url, barcode, in_stock)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
             """,
-            (name, category, description, price, image_url, barcode, in_stock)
+            (name, name_kz, category, description, price, image_url, barcode, in_stock)
         )
+        product_id = cursor.lastrowid
+        await _log_change(db, product_id, "upsert")
         await db.commit()
-        return cursor.lastrowid
+        row = await _fetch_product(db, product_id)
+
+    _notify("upsert", product_id, row)
+    return product_id
 
 
+@timed("db.update_product")
 async def update_product(
     product_id: int,
     name: str | None = None,
@@ -141,10 +818,11 @@ async def update_product(
     price: float | None = None,
     image_url: str | None = None,
     barcode: str | None = None,
-    in_stock: int | None = None
+    in_stock: int | None = None,
+    name_kz: str | None = None
 ) -> bool:
     """Обновляет товар. Возвращает True, если товар найден и обновлён."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         # Сначала проверяем существование товара
         cursor = await db.execute("SELECT id FROM products WHERE id = ?", (product_id,))
         if not await cursor.fetchone():
@@ -157,6 +835,9 @@ async def update_product(
         if name is not None:
             updates.append("name = ?")
             params.append(name)
+        if name_kz is not None:
+            updates.append("name_kz = ?")
+            params.append(name_kz)
         if category is not None:
             updates.append("category = ?")
             params.append(category)
@@ -170,8 +851,9 @@ async def update_product(
             updates.append("image_url = ?")
             params.append(image_url)
         if barcode is not None:
+            # '' или 'null' — снять штрихкод
             updates.append("barcode = ?")
-            params.append(barcode)
+            params.append(normalize_barcode(barcode))
         if in_stock is not None:
             updates.append("in_stock = ?")
             params.append(in_stock)
@@ -183,13 +865,436 @@ async def update_product(
         sql = f"UPDATE products SET {', '.join(updates)} WHERE id = ?"
         
         await db.execute(sql, params)
+        await _log_change(db, product_id, "upsert")
         await db.commit()
-        return True
+        row = await _fetch_product(db, product_id)
+
+    _notify("upsert", product_id, row)
+    return True
 
 
+@timed("db.delete_product")
 async def delete_product(product_id: int) -> bool:
     """Удаляет товар. Возвращает True, если товар найден и удалён."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         cursor = await db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        deleted = cursor.rowcount > 0
+        if deleted:
+            await _log_change(db, product_id, "delete")
+        await db.commit()
+
+    if deleted:
+        _notify("delete", product_id, None)
+    return deleted
+
+
+BULK_FIELDS = ("barcode", "name", "name_kz", "category", "description", "price", "image_url", "in_stock")
+
+
+def _bulk_write_sql(columns: tuple[str, ...], is_new: bool) -> str:
+    """INSERT нового товара или UPDATE по штрихкоду — только переданные колонки."""
+    if is_new:
+        # Без ON CONFLICT: он требует уникального индекса, а в базе с дубликатами
+        # штрихкодов индекс не уникальный. Новизна уже проверена в
+        # _bulk_upsert_chunk; штрихкод, вставленный другим воркером после
+        # проверки, даст IntegrityError — строка уйдёт в отчёт об ошибках
+        return f"INSERT INTO products ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    # Не upsert: SQLite проверяет NOT NULL (name) до разрешения конфликта,
+    # и файл только с barcode,price не прошёл бы
+    updates = ", ".join(f"{c} = ?" for c in columns if c != "barcode")
+    return f"UPDATE products SET {updates} WHERE barcode = ? AND {_BARCODE_INDEXED}"
+
+
+async def _bulk_upsert_chunk(
+    db: aiosqlite.Connection,
+    chunk: list[tuple[int, dict]],
+    report: dict,
+) -> None:
+    """Одна транзакция: executemany на группу строк с одинаковым набором колонок."""
+    barcodes = list(dict.fromkeys(fields["barcode"] for _, fields in chunk))
+    marks = ", ".join("?" * len(barcodes))
+    cursor = await db.execute(
+        f"SELECT barcode FROM products WHERE barcode IN ({marks}) AND {_BARCODE_INDEXED}", barcodes
+    )
+    existing = {row[0] for row in await cursor.fetchall()}
+
+    groups: dict[tuple[bool, tuple[str, ...]], list[tuple[int, dict]]] = {}
+    for row_no, fields in chunk:
+        is_new = fields["barcode"] not in existing
+        if is_new and (fields.get("name") is None or fields.get("price") is None):
+            bulk_report_error(report, row_no, fields["barcode"], "name and price are required for a new product")
+            continue
+        existing.add(fields["barcode"])
+        columns = tuple(c for c in BULK_FIELDS if c in fields)
+        groups.setdefault((is_new, columns), []).append((row_no, fields))
+
+    changed: list[str] = []
+    # Сначала вставки: повтор штрихкода в том же чанке — уже обновление
+    for (is_new, columns), rows in sorted(groups.items(), key=lambda g: not g[0][0]):
+        if not is_new and columns == ("barcode",):
+            report["updated"] += len(rows)    # обновлять нечего
+            continue
+        sql = _bulk_write_sql(columns, is_new)
+        order = columns if is_new else tuple(c for c in columns if c != "barcode") + ("barcode",)
+        params = [tuple(fields[c] for c in order) for _, fields in rows]
+        # executemany не откатывает уже выполненные строки группы — savepoint
+        await db.execute("SAVEPOINT bulk_group")
+        try:
+            cursor = await db.executemany(sql, params)
+            batched = is_new or cursor.rowcount == len(rows)
+        except aiosqlite.Error:
+            batched = False
+        if batched:
+            await db.execute("RELEASE bulk_group")
+            ok, affected = rows, len(rows)
+        else:
+            # Кто-то в группе нарушил ограничение или UPDATE не нашёл товар
+            # (удалён после проверки) — группа откатывается, выясняем построчно
+            await db.execute("ROLLBACK TO bulk_group")
+            await db.execute("RELEASE bulk_group")
+            ok, affected = [], 0
+            for row, values in zip(rows, params):
+                try:
+                    cursor = await db.execute(sql, values)
+                except aiosqlite.IntegrityError as e:
+                    error = "barcode already exists, retry the row" if is_new and "UNIQUE" in str(e) else str(e)
+                    bulk_report_error(report, row[0], row[1]["barcode"], error)
+                    continue
+                except aiosqlite.Error as e:
+                    bulk_report_error(report, row[0], row[1]["barcode"], str(e))
+                    continue
+                if cursor.rowcount == 0:
+                    bulk_report_error(report, row[0], row[1]["barcode"], "product with this barcode no longer exists")
+                    continue
+                ok.append(row)
+                affected += cursor.rowcount
+        report["inserted" if is_new else "updated"] += affected
+        changed.extend(fields["barcode"] for _, fields in ok)
+
+    if changed:
+        # Журнал изменений — двумя запросами на чанк, а не _log_change на строку
+        marks = ", ".join("?" * len(changed))
+        await db.execute(
+            f"DELETE FROM product_changes WHERE product_id IN "
+            f"(SELECT id FROM products WHERE barcode IN ({marks}) AND {_BARCODE_INDEXED})",
+            changed
+        )
+        await db.execute(
+            f"INSERT INTO product_changes (product_id, op) "
+            f"SELECT id, 'upsert' FROM products WHERE barcode IN ({marks}) AND {_BARCODE_INDEXED}",
+            changed
+        )
+    await db.commit()
+
+
+def bulk_report_error(report: dict, row_no: int, barcode: str | None, error: str) -> None:
+    """Строка с ошибкой в отчёт импорта (не больше BULK_MAX_ERRORS строк)."""
+    report["failed"] += 1
+    if len(report["errors"]) < BULK_MAX_ERRORS:
+        report["errors"].append({"row": row_no, "barcode": barcode, "error": error})
+    else:
+        report["errors_truncated"] = True
+
+
+@timed("db.bulk_upsert_products")
+async def bulk_upsert_products(
+    rows: AsyncIterable[tuple[int, dict]],
+    report: dict | None = None,
+    chunk_size: int = BULK_CHUNK_ROWS,
+) -> dict:
+    """
+    Upsert товаров по штрихкоду из потока (номер строки, поля).
+
+    Поля — подмножество BULK_FIELDS, barcode обязателен: существующий товар
+    обновляется только по переданным колонкам, новый требует name и price.
+    Строки пишутся чанками по chunk_size в отдельных транзакциях (lock на
+    запись берётся на чанк, а не на весь импорт). Кэши получают одно
+    событие "reload" в конце вместо колбэка на каждую строку.
+
+    report — отчёт, в который уже записаны ошибки разбора (дополняется):
+      {"inserted", "updated", "failed", "errors": [{"row", "barcode", "error"}]}
+    """
+    if report is None:
+        report = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+
+    chunk: list[tuple[int, dict]] = []
+    try:
+        async for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                async with _write() as db:
+                    await _bulk_upsert_chunk(db, chunk, report)
+                chunk = []
+        if chunk:
+            async with _write() as db:
+                await _bulk_upsert_chunk(db, chunk, report)
+    finally:
+        # Записанные чанки уже закоммичены — даже если поток оборвался
+        if report["inserted"] or report["updated"]:
+            _notify("reload", 0, None)
+
+    return report
+
+
+# ── Заказы ────────────────────────────────────────────────────────────────────
+# Заказы живут в SQLite, а не в памяти процесса: callback от Forte и поллинг
+# статуса могут попасть в разные воркеры uvicorn.
+_ORDER_COLUMNS = "our_order_id, forte_order_id, forte_password, status, total, created_at, updated_at"
+ORDER_FINAL_STATUSES = ("paid", "failed")
+
+
+@timed("db.create_order_record")
+async def create_order_record(order: dict, items: list[dict]) -> None:
+    """Сохраняет новый заказ и его позиции в одной транзакции."""
+    async with _write() as db:
+        await db.execute(
+            """
+            INSERT INTO orders (our_order_id, forte_order_id, forte_password, status, total)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (
+                order["our_order_id"],
+                order["forte_order_id"],
+                order["forte_password"],
+                order.get("status", "pending"),
+                order["total"],
+            )
+        )
+        await db.executemany(
+            """
+            INSERT INTO order_items (our_order_id, line, product_id, name, price, quantity)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (order["our_order_id"], line, i["product_id"], i["name"], i["price"], i["quantity"])
+                for line, i in enumerate(items)
+            ]
+        )
+        await db.commit()
+
+
+@timed("db.get_order")
+async def get_order(our_order_id: str) -> dict | None:
+    """Заказ с позициями (items) или None. Ищет и в архиве."""
+    async with _read() as db:
+        cursor = await db.execute(
+            f"SELECT {_ORDER_COLUMNS} FROM orders WHERE our_order_id = ?",
+            (our_order_id,)
+        )
+        row = await cursor.fetchone()
+        if row is not None:
+            order = dict(row)
+            cursor = await db.execute(
+                """
+                SELECT product_id, name, price, quantity
+                FROM order_items
+                WHERE our_order_id = ?
+                ORDER BY line
+                """,
+                (our_order_id,)
+            )
+            order["items"] = [dict(r) for r in await cursor.fetchall()]
+            return order
+
+        cursor = await db.execute(
+            f"SELECT {_ORDER_COLUMNS}, items FROM orders_archive WHERE our_order_id = ?",
+            (our_order_id,)
+        )
+        row = await cursor.fetchone()
+        if row is None:
+            return None
+        order = dict(row)
+        order["items"] = json.loads(order["items"])
+        return order
+
+
+@timed("db.get_order_status_value")
+async def get_order_status_value(our_order_id: str) -> str | None:
+    """Только статус заказа — дешёвый lookup по первичному ключу."""
+    async with _read() as db:
+        cursor = await db.execute(
+            "SELECT status FROM orders WHERE our_order_id = ?", (our_order_id,)
+        )
+        row = await cursor.fetchone()
+        if row is None:
+            cursor = await db.execute(
+                "SELECT status FROM orders_archive WHERE our_order_id = ?", (our_order_id,)
+            )
+            row = await cursor.fetchone()
+        return row["status"] if row else None
+
+
+@timed("db.update_order_status")
+async def update_order_status(our_order_id: str, status: str) -> bool:
+    """
+    Меняет статус заказа. Финальный статус (paid/failed) не перезаписывается:
+    callback и поллинг из разных воркеров не могут «откатить» оплату.
+    Возвращает True, если статус изменился.
+    """
+    async with _write() as db:
+        cursor = await db.execute(
+            f"""
+            UPDATE orders
+            SET status = ?, updated_at = datetime('now')
+            WHERE our_order_id = ? AND status != ? AND status NOT IN ({', '.join('?' * len(ORDER_FINAL_STATUSES))})
+            """,
+            (status, our_order_id, status, *ORDER_FINAL_STATUSES)
+        )
+        await db.commit()
+        return cursor.rowcount > 0
+
+
+@timed("db.list_orders_by_status")
+async def list_orders_by_status(status: str, limit: int = 1000) -> list[dict]:
+    """Заказы (без позиций) с данным статусом, старые первыми."""
+    async with _read() as db:
+        cursor = await db.execute(
+            f"""
+            SELECT {_ORDER_COLUMNS}
+            FROM orders
+            WHERE status = ?
+            ORDER BY created_at
+            LIMIT ?
+            """,
+            (status, limit)
+        )
+        return [dict(row) for row in await cursor.fetchall()]
+
+
+@timed("db.archive_orders")
+async def archive_orders(older_than_seconds: float, batch: int = 500) -> int:
+    """
+    Переносит завершённые (paid/failed) заказы старше older_than_seconds
+    в orders_archive вместе с позициями. Возвращает число перенесённых.
+    """
+    archived = 0
+    placeholders = ", ".join("?" * len(ORDER_FINAL_STATUSES))
+    while True:
+        async with _write() as db:
+            cursor = await db.execute(
+                f"""
+                SELECT our_order_id
+                FROM orders
+                WHERE status IN ({placeholders})
+                  AND updated_at < datetime('now', ?)
+                LIMIT ?
+                """,
+                (*ORDER_FINAL_STATUSES, f"-{max(0, int(older_than_seconds))} seconds", batch)
+            )
+            ids = [row[0] for row in await cursor.fetchall()]
+            if not ids:
+                return archived
+
+            marks = ", ".join("?" * len(ids))
+            await db.execute(
+                f"""
+                INSERT OR REPLACE INTO orders_archive
+                    (our_order_id, forte_order_id, forte_password, status, total, items, created_at, updated_at)
+                SELECT o.our_order_id, o.forte_order_id, o.forte_password, o.status, o.total,
+                       COALESCE((
+                           SELECT json_group_array(json_object(
+                               'product_id', i.product_id, 'name', i.name,
+                               'price', i.price, 'quantity', i.quantity))
+                           FROM (SELECT * FROM order_items WHERE our_order_id = o.our_order_id ORDER BY line) i
+                       ), '[]'),
+                       o.created_at, o.updated_at
+                FROM orders o
+                WHERE o.our_order_id IN ({marks})
+                """,
+                ids
+            )
+            await db.execute(f"DELETE FROM order_items WHERE our_order_id IN ({marks})", ids)
+            await db.execute(f"DELETE FROM orders WHERE our_order_id IN ({marks})", ids)
+            await db.commit()
+            archived += len(ids)
+        if len(ids) < batch:
+            return archived
+
+
+@timed("db.acquire_lease")
+async def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    """
+    Захватывает или продлевает лизу name на ttl секунд.
+    True — лиза наша (свободна, просрочена или уже принадлежит owner).
+    """
+    now = time.time()
+    async with _write() as db:
+        cursor = await db.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            """,
+            (name, owner, now + ttl, now)
+        )
+        await db.commit()
+        return cursor.rowcount > 0
+
+
+@timed("db.release_lease")
+async def release_lease(name: str, owner: str) -> None:
+    async with _write() as db:
+        await db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+        await db.commit()
+
+
+# ── Idempotency-Key ───────────────────────────────────────────────────────────
+# Строка с status = NULL — «захват»: запрос с этим ключом выполняется (возможно,
+# в другом воркере) до expires_at; потом ключ можно захватить заново.
+@timed("db.claim_idempotency_key")
+async def claim_idempotency_key(key: str, fingerprint: str, lock_ttl: float) -> dict | None:
+    """
+    Захватывает ключ на lock_ttl секунд. None — захвачен нами (ключ новый или
+    истёк), иначе существующая запись {fingerprint, status, response, expires_at}.
+    """
+    now = time.time()
+    async with _write() as db:
+        cursor = await db.execute(
+            """
+            INSERT INTO idempotency_keys (key, fingerprint, status, response, expires_at)
+            VALUES (?, ?, NULL, NULL, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                fingerprint = excluded.fingerprint, status = NULL, response = NULL,
+                expires_at = excluded.expires_at
+            WHERE idempotency_keys.expires_at < ?
+            """,
+            (key, fingerprint, now + lock_ttl, now)
+        )
+        claimed = cursor.rowcount > 0
+        row = None
+        if not claimed:
+            cursor = await db.execute(
+                "SELECT fingerprint, status, response, expires_at FROM idempotency_keys WHERE key = ?",
+                (key,)
+            )
+            row = await cursor.fetchone()
+        await db.commit()
+    return None if claimed else dict(row)
+
+
+@timed("db.complete_idempotency_key")
+async def complete_idempotency_key(key: str, status: int, response: str, ttl: float) -> None:
+    """Сохраняет ответ для повторов на ttl секунд."""
+    async with _write() as db:
+        await db.execute(
+            "UPDATE idempotency_keys SET status = ?, response = ?, expires_at = ? WHERE key = ?",
+            (status, response, time.time() + ttl, key)
+        )
+        await db.commit()
+
+
+@timed("db.release_idempotency_key")
+async def release_idempotency_key(key: str) -> None:
+    """Снимает захват без ответа (запрос упал) — повтор выполнится заново."""
+    async with _write() as db:
+        await db.execute("DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL", (key,))
+        await db.commit()
+
+
+@timed("db.purge_idempotency_keys")
+async def purge_idempotency_keys() -> int:
+    """Удаляет истёкшие ключи. Возвращает число удалённых."""
+    async with _write() as db:
+        cursor = await db.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (time.time(),))
         await db.commit()
-        return cursor.rowcount > 0
\ No newline at end of file
+        return cursor.rowcount
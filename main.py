@@ -1,18 +1,63 @@
+import time
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from database import init_db
+from database import init_db, open_pool, close_pool, add_product_listener, remove_product_listener
 from routers import recognize, checkout, products
+from services.catalog_cache import catalog_cache, barcode_index
+from services.recognition_cache import recognition_cache
+from services.product_matcher import product_matcher
+from services import http_clients, metrics
+from services.order_store import order_store
+from services.order_reconciler import order_reconciler
+from services.idempotency import idempotency_store
+from services.admission import openai_admission
+from services.openai_service import SEARCH_BACKEND
+from services.vector_index import vector_index
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await init_db()   
-    yield
+    await init_db()
+    await open_pool()
+    add_product_listener(catalog_cache.on_product_change)
+    add_product_listener(barcode_index.on_product_change)
+    add_product_listener(recognition_cache.on_product_change)
+    add_product_listener(product_matcher.on_product_change)
+    if SEARCH_BACKEND != "fts":
+        add_product_listener(vector_index.on_product_change)
+    await catalog_cache.warm()
+    await barcode_index.warm()
+    await product_matcher.warm()
+    if SEARCH_BACKEND != "fts":
+        await vector_index.warm()
+    await http_clients.open_clients()
+    order_store.start_archiver()
+    order_reconciler.start()
+    try:
+        yield
+    finally:
+        await order_reconciler.stop()
+        await order_store.stop_archiver()
+        order_store.clear()
+        idempotency_store.clear()
+        remove_product_listener(catalog_cache.on_product_change)
+        remove_product_listener(barcode_index.on_product_change)
+        remove_product_listener(recognition_cache.on_product_change)
+        remove_product_listener(product_matcher.on_product_change)
+        remove_product_listener(vector_index.on_product_change)
+        catalog_cache.clear()
+        barcode_index.clear()
+        recognition_cache.clear()
+        product_matcher.clear()
+        vector_index.clear()
+        await http_clients.close_clients()
+        await close_pool()
 
 
 app = FastAPI(title="Cashierless API", lifespan=lifespan)
@@ -24,6 +69,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """
+    Длительность запроса по маршруту + заголовок Server-Timing с разбивкой
+    по этапам (спаны services.metrics, записанные за время запроса).
+    """
+    timings = metrics.start_request()
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+
+    route = request.scope.get("route")
+    metrics.http_request_seconds.observe(
+        request.method, getattr(route, "path", "unmatched"), str(response.status_code), value=elapsed
+    )
+    if metrics.SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(timings, elapsed)
+    return response
+
+
 app.include_router(recognize.router)
 app.include_router(checkout.router)
 app.include_router(products.router)
@@ -31,4 +97,22 @@ app.include_router(products.router)
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+
+@app.get("/health/http")
+async def health_http():
+    """Загрузка пулов HTTP-клиентов (Forte, OpenAI)."""
+    return http_clients.pool_stats()
+
+
+@app.get("/health/openai")
+async def health_openai():
+    """Допуск вызовов модели: окно AIMD, вызовы в полёте, очередь."""
+    return openai_admission.snapshot()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Метрики в формате Prometheus: этапы, запросы, токены OpenAI, пулы HTTP."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
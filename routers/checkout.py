@@ -1,32 +1,108 @@
-import uuid
 import asyncio
-from fastapi import APIRouter, HTTPException, Request
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
-from services.forte_service import create_order, get_order_status
+import json
+import logging
+import time
+import uuid
+from fastapi import APIRouter, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from services.forte_service import create_order
+from services.pricing import price_cart, to_tiyn, verify_quote
+from services.idempotency import CommittedFailure, IdempotencyError, fingerprint, idempotency_store
+from services.order_store import order_store
+from services.order_reconciler import order_reconciler
+from services.order_events import (
+    ORDER_EVENTS_HEARTBEAT,
+    ORDER_EVENTS_MAX_AGE,
+    TooManySubscribers,
+    order_events,
+)
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/checkout", tags=["checkout"])
 
-# ── In-memory хранилище ордеров (для демо достаточно) ─────────────────────────
-# { our_order_id: { forte_order_id, forte_password, status, items, total } }
-_orders: dict[str, dict] = {}
+# Ордера хранятся в SQLite (services/order_store.py), поэтому callback и поллинг
+# статуса могут обслуживаться разными воркерами:
+# { our_order_id, forte_order_id, forte_password, status, items, total }
 
 
 class CartItem(BaseModel):
     product_id: int
     name: str
     price: float
-    quantity: int
+    quantity: int = Field(ge=1)
 
 
 class CheckoutRequest(BaseModel):
-    items: list[CartItem]
-    total: float
+    items: list[CartItem] = Field(min_length=1)
+    # Сумма, которую видел пользователь; если цены успели измениться — 409
+    total: float | None = None
+    # token из POST /checkout/quote: цены не перечитываются
+    quote: str | None = None
+
+
+class QuoteRequest(BaseModel):
+    items: list[CartItem] = Field(min_length=1)
+
+
+# ── 0. Котировка корзины ──────────────────────────────────────────────────────
+@router.post("/quote")
+async def quote_cart(req: QuoteRequest):
+    """
+    Серверная цена корзины по каталогу (цены и названия клиента не используются).
+
+    lines — позиции с ценами в тиынах, total — в тенге, unavailable — id
+    товаров, которых нет или нет в наличии. token (только если unavailable
+    пуст) передаётся в /checkout/create как quote до expires_at.
+    """
+    return await price_cart(req.items)
+
+
+async def _checkout_quote(req: CheckoutRequest) -> dict:
+    """Котировка из токена клиента или пересчёт; 422/409, если платить нельзя."""
+    quote = verify_quote(req.quote, req.items) if req.quote else None
+    if quote is None:
+        quote = await price_cart(req.items)
+    if quote["unavailable"]:
+        raise HTTPException(422, {
+            "message":     "Some products are unavailable",
+            "unavailable": quote["unavailable"],
+        })
+    if req.total is not None and to_tiyn(req.total) != quote["total_tiyn"]:
+        raise HTTPException(409, {"message": "Cart total changed", "quote": quote})
+    return quote
 
 
 # ── 1. Создать ордер и получить HPP-ссылку ────────────────────────────────────
 @router.post("/create")
-async def create_checkout(req: CheckoutRequest, request: Request):
+async def create_checkout(
+    req: CheckoutRequest,
+    request: Request,
+    idempotency_key: str | None = Header(None),
+):
+    """
+    Создаёт заказ на сумму, посчитанную сервером (см. /checkout/quote):
+    total клиента только сверяется, в Forte уходит серверная сумма в тиынах.
+
+    Idempotency-Key: повтор с тем же ключом и телом не создаёт второй ордер
+    в Forte, а получает ответ первого запроса (заголовок Idempotent-Replayed).
+    """
+    if idempotency_key is None:
+        return await _create_checkout(req, request)
+    try:
+        status, body, replayed = await idempotency_store.run(
+            "checkout.create", idempotency_key, fingerprint(await request.body()),
+            lambda: _create_checkout(req, request),
+        )
+    except IdempotencyError as e:
+        raise HTTPException(e.status_code, e.detail)
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(body, status_code=status, media_type="application/json", headers=headers)
+
+
+async def _create_checkout(req: CheckoutRequest, request: Request) -> dict:
+    quote = await _checkout_quote(req)
     our_order_id = f"ORD-{uuid.uuid4().hex[:8].upper()}"
 
     # callback URL — Forte редиректнёт сюда после оплаты
@@ -34,30 +110,51 @@ async def create_checkout(req: CheckoutRequest, request: Request):
     base_url = str(request.base_url).rstrip("/")
     callback_url = f"{base_url}/checkout/callback"
 
-    item_names = ", ".join(i.name for i in req.items[:3])
+    item_names = ", ".join(line["name"] for line in quote["lines"][:3])
     description = f"Покупка: {item_names}"
 
     try:
         forte_data = await create_order(
-            amount=req.total,
+            amount_tiyn=quote["total_tiyn"],
             description=description,
             redirect_url=f"{callback_url}?our_order_id={our_order_id}",
         )
     except Exception as e:
         raise HTTPException(502, f"Forte error: {e}")
 
-    _orders[our_order_id] = {
+    order = {
+        "our_order_id":   our_order_id,
         "forte_order_id": forte_data["forte_order_id"],
         "forte_password": forte_data["forte_password"],
         "status":         "pending",   # наш внутренний статус
-        "items":          [i.model_dump() for i in req.items],
-        "total":          req.total,
+        "items":          [
+            {
+                "product_id": line["product_id"],
+                "name":       line["name"],
+                "price":      line["unit_price_tiyn"] / 100,
+                "quantity":   line["quantity"],
+            }
+            for line in quote["lines"]
+        ],
+        "total":          quote["total"],
     }
+    try:
+        await order_store.create(order)
+    except Exception as e:
+        # Ордер в Forte уже есть: повтор с тем же Idempotency-Key не должен
+        # создать второй — ключ остаётся за этой ошибкой
+        logger.exception(
+            "Forte order %s created, but order %s was not saved", forte_data["forte_order_id"], our_order_id
+        )
+        raise CommittedFailure(
+            500, f"Order {our_order_id} was not saved after the payment was created, contact support"
+        ) from e
 
     return {
         "our_order_id": our_order_id,
         "hpp_url":      forte_data["hpp_url"],
-        "total":        req.total,
+        "total":        quote["total"],
+        "total_tiyn":   quote["total_tiyn"],
     }
 
 
@@ -68,25 +165,25 @@ async def payment_callback(our_order_id: str, ID: int | None = None, STATUS: str
     Forte редиректит сюда с параметрами:
       ?our_order_id=ORD-xxx&ID=<forte_id>&STATUS=FullyPaid|Declined
     """
-    if our_order_id not in _orders:
+    order = await order_store.get(our_order_id)
+    if order is None:
         return HTMLResponse("<h1>Order not found</h1>", status_code=404)
 
-    order = _orders[our_order_id]
-
     if STATUS == "FullyPaid":
-        order["status"] = "paid"
+        status = "paid"
     elif STATUS in ("Declined", "Expired", "Cancelled", "Refused"):
-        order["status"] = "failed"
+        status = "failed"
     else:
-        # Если статус не пришёл — запрашиваем у Forte напрямую
+        # Если статус не пришёл — запрашиваем у Forte (общий запрос с фоновой сверкой)
         try:
-            forte_status = await get_order_status(
-                order["forte_order_id"],
-                order["forte_password"],
-            )
-            order["status"] = "paid" if forte_status == "FullyPaid" else "failed"
+            forte_status = await order_reconciler.fetch_forte_status(order)
+            status = "paid" if forte_status == "FullyPaid" else "failed"
         except Exception:
-            order["status"] = "failed"
+            status = "failed"
+
+    await order_store.set_status(our_order_id, status)
+    # Финальный статус не перезаписывается — перечитываем, что в итоге сохранено
+    order = await order_store.get(our_order_id)
 
     # Показываем красивую страницу-заглушку (браузер закроют вручную)
     if order["status"] == "paid":
@@ -113,29 +210,105 @@ async def payment_callback(our_order_id: str, ID: int | None = None, STATUS: str
 # ── 3. Поллинг статуса из мобильного приложения ───────────────────────────────
 @router.get("/status/{our_order_id}")
 async def get_status(our_order_id: str):
-    if our_order_id not in _orders:
+    # Отдаём только локальное состояние: pending-заказы сверяет с Forte
+    # фоновый services/order_reconciler.py (на случай потери callback)
+    order = await order_store.get(our_order_id)
+    if order is None:
         raise HTTPException(404, "Order not found")
 
-    order = _orders[our_order_id]
-
-    # Если ещё pending — дополнительно спросим Forte (на случай потери callback)
-    if order["status"] == "pending":
-        try:
-            forte_status = await get_order_status(
-                order["forte_order_id"],
-                order["forte_password"],
-            )
-            if forte_status == "FullyPaid":
-                order["status"] = "paid"
-            elif forte_status in ("Declined", "Expired", "Cancelled"):
-                order["status"] = "failed"
-        except Exception:
-            pass  # оставляем pending, приложение попробует ещё раз
-
     return {
         "our_order_id":    our_order_id,
         "status":          order["status"],   # pending | paid | failed
         "forte_order_id":  order["forte_order_id"],
         "items":           order["items"],
         "total":           order["total"],
-    }
\ No newline at end of file
+    }
+
+
+# ── 4. Push-уведомления о статусе (SSE / WebSocket) ───────────────────────────
+async def _status_events(our_order_id: str, queue: asyncio.Queue, status: str):
+    """
+    События статуса заказа: сначала текущий, затем каждое изменение.
+    None — heartbeat. Поток заканчивается на финальном статусе или через
+    ORDER_EVENTS_MAX_AGE (клиент переподключится).
+    """
+    yield {"our_order_id": our_order_id, "status": status}
+    deadline = time.monotonic() + ORDER_EVENTS_MAX_AGE
+
+    while status == "pending" and time.monotonic() < deadline:
+        try:
+            event = await asyncio.wait_for(queue.get(), timeout=ORDER_EVENTS_HEARTBEAT)
+        except asyncio.TimeoutError:
+            # Callback мог обработать другой воркер — его publish сюда не дойдёт
+            order = await order_store.get(our_order_id)
+            if order is None or order["status"] == status:
+                yield None
+                continue
+            event = {"our_order_id": our_order_id, "status": order["status"]}
+
+        status = event["status"]
+        yield event
+
+
+async def _subscribe(our_order_id: str) -> tuple[asyncio.Queue, str]:
+    """Подписка до чтения статуса — изменение между ними не потеряется."""
+    try:
+        queue = order_events.subscribe(our_order_id)
+    except TooManySubscribers:
+        raise HTTPException(503, "Too many status subscribers", headers={"Retry-After": "5"})
+
+    order = await order_store.get(our_order_id)
+    if order is None:
+        order_events.unsubscribe(our_order_id, queue)
+        raise HTTPException(404, "Order not found")
+    return queue, order["status"]
+
+
+@router.get("/events/{our_order_id}")
+async def order_status_events(our_order_id: str):
+    """
+    Server-Sent Events со статусом заказа вместо поллинга /status.
+
+    event: status, data: {"our_order_id", "status"}; раз в
+    ORDER_EVENTS_HEARTBEAT секунд — комментарий-heartbeat.
+    """
+    queue, status = await _subscribe(our_order_id)
+
+    async def stream():
+        try:
+            async for event in _status_events(our_order_id, queue, status):
+                if event is None:
+                    yield ": ping\n\n"
+                else:
+                    yield f"event: status\ndata: {json.dumps(event)}\n\n"
+        finally:
+            order_events.unsubscribe(our_order_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/ws/{our_order_id}")
+async def order_status_websocket(websocket: WebSocket, our_order_id: str):
+    """То же, что /events, по WebSocket: {"type": "status", ...} и {"type": "ping"}."""
+    try:
+        queue, status = await _subscribe(our_order_id)
+    except HTTPException as e:
+        await websocket.close(code=1013 if e.status_code == 503 else 1008, reason=e.detail)
+        return
+
+    await websocket.accept()
+    try:
+        async for event in _status_events(our_order_id, queue, status):
+            if event is None:
+                await websocket.send_json({"type": "ping"})
+            else:
+                await websocket.send_json({"type": "status", **event})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        order_events.unsubscribe(our_order_id, queue)
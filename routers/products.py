@@ -1,13 +1,26 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from typing import Optional
+import aiosqlite
+import base64
+import codecs
+import csv
+import io
+import json
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from typing import AsyncIterator, Literal, Optional
 from database import (
-    get_all_products,
-    get_product_by_id,
+    EMPTY_BARCODES,
+    PRODUCT_FIELDS,
+    bulk_report_error,
+    bulk_upsert_products,
     create_product,
     update_product,
-    delete_product
+    delete_product,
+    get_changes_since,
+    iter_products,
+    list_products_page
 )
+from services.catalog_cache import catalog_cache, barcode_index
 
 router = APIRouter(prefix="/products", tags=["products"])
 
@@ -15,6 +28,7 @@ router = APIRouter(prefix="/products", tags=["products"])
 # ── Pydantic модели для валидации ───────────────────────────────────────────────
 class ProductCreate(BaseModel):
     name: str
+    name_kz: Optional[str] = None
     category: Optional[str] = None
     description: Optional[str] = None
     price: float
@@ -25,6 +39,7 @@ class ProductCreate(BaseModel):
 
 class ProductUpdate(BaseModel):
     name: Optional[str] = None
+    name_kz: Optional[str] = None
     category: Optional[str] = None
     description: Optional[str] = None
     price: Optional[float] = None
@@ -36,6 +51,7 @@ class ProductUpdate(BaseModel):
 class ProductResponse(BaseModel):
     id: int
     name: str
+    name_kz: Optional[str] = None
     category: Optional[str]
     description: Optional[str]
     price: float
@@ -45,30 +61,360 @@ class ProductResponse(BaseModel):
     created_at: str
 
 
+class BarcodeLookupRequest(BaseModel):
+    barcodes: list[str]
+
+
+class BarcodeLookupResponse(BaseModel):
+    found: list[ProductResponse]
+    missing: list[str]
+
+
+class ProductChangesResponse(BaseModel):
+    version: int
+    full_resync: bool
+    upserted: list[ProductResponse]
+    deleted: list[int]
+
+
+class ProductImport(BaseModel):
+    """Строка массового импорта: barcode — ключ upsert, остальные поля — только переданные."""
+    model_config = ConfigDict(extra="ignore", coerce_numbers_to_str=True)
+
+    barcode: str
+    name: Optional[str] = None
+    name_kz: Optional[str] = None
+    category: Optional[str] = None
+    description: Optional[str] = None
+    price: Optional[float] = Field(None, ge=0)
+    image_url: Optional[str] = None
+    in_stock: Optional[int] = Field(None, ge=0, le=1)
+
+
+class BulkRowError(BaseModel):
+    row: int
+    barcode: Optional[str] = None
+    error: str
+
+
+class BulkImportResponse(BaseModel):
+    inserted: int
+    updated: int
+    failed: int
+    errors: list[BulkRowError]
+    errors_truncated: bool = False
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+MAX_PAGE_SIZE = 1000
+
+
+def _encode_cursor(name: str, product_id: int) -> str:
+    raw = json.dumps([name, product_id], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        name, product_id = json.loads(raw)
+        if not isinstance(name, str) or not isinstance(product_id, int):
+            raise ValueError
+        return name, product_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _parse_fields(fields: str | None) -> list[str] | None:
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in PRODUCT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+
+def _project(row: dict, fields: list[str] | None) -> dict:
+    return row if fields is None else {f: row[f] for f in fields}
+
+
 # ── Endpoints ───────────────────────────────────────────────────────────────────
 @router.get("", response_model=dict)
-async def get_products():
+async def get_products(
+    request: Request,
+    limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: str | None = Query(None, description="next_cursor из предыдущей страницы"),
+    fields: str | None = Query(None, description="Колонки через запятую, например id,name,price"),
+    category: str | None = None,
+    format: Literal["json", "ndjson"] = "json",
+):
     """
     Получить список всех товаров.
     
     Возвращает все товары из базы данных, отсортированные по названию.
+    Без параметров ответ отдаётся из кэша каталога уже сериализованным;
+    ETag — версия каталога: при совпадении If-None-Match возвращается 304.
+
+    limit/after — keyset-пагинация по (name, id), в ответе next_cursor.
+    fields — проекция колонок, category — фильтр по категории.
+    format=ndjson — потоковая выдача, по товару на строку.
     """
-    products = await get_all_products()
+    if format == "ndjson":
+        return _stream_products(after, limit, _parse_fields(fields), category)
+    if limit is not None or after is not None or fields or category is not None:
+        return await _products_page(after, limit, _parse_fields(fields), category)
+
+    version, body = await catalog_cache.list_snapshot()
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def _products_page(
+    after: str | None,
+    limit: int | None,
+    fields: list[str] | None,
+    category: str | None,
+) -> dict:
+    limit = limit or 100
+    rows = await list_products_page(
+        _decode_cursor(after) if after else None, limit, fields, category
+    )
+    next_cursor = (
+        _encode_cursor(rows[-1]["name"], rows[-1]["id"]) if len(rows) == limit else None
+    )
     return {
-        "count": len(products),
-        "products": products
+        "count":       len(rows),
+        "products":    [_project(row, fields) for row in rows],
+        "next_cursor": next_cursor,
     }
 
 
+def _stream_products(
+    after: str | None,
+    limit: int | None,
+    fields: list[str] | None,
+    category: str | None,
+) -> StreamingResponse:
+    start = _decode_cursor(after) if after else None
+
+    async def lines():
+        sent = 0
+        async for row in iter_products(start, fields, category):
+            yield json.dumps(_project(row, fields), ensure_ascii=False, default=str) + "\n"
+            sent += 1
+            if limit is not None and sent >= limit:
+                return
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@router.get("/changes", response_model=ProductChangesResponse)
+async def get_product_changes(since: int = Query(0, ge=0)):
+    """
+    Дельта каталога для синхронизации мобильного приложения.
+
+    Возвращает товары, созданные/изменённые после версии since, и id удалённых.
+    Клиент сохраняет version из ответа (или ETag из GET /products) и передаёт
+    его в следующий запрос. full_resync=true — локальную копию нужно заменить.
+    """
+    return await get_changes_since(since)
+
+
+@router.post("/by-barcodes", response_model=BarcodeLookupResponse)
+async def get_products_by_barcodes_endpoint(req: BarcodeLookupRequest):
+    """
+    Найти товары по списку штрихкодов (из памяти, без запроса в БД).
+
+    Порядок found соответствует порядку запроса, повторы схлопываются.
+    """
+    barcodes = list(dict.fromkeys(b.strip() for b in req.barcodes if b.strip()))
+    found = await barcode_index.lookup(barcodes)
+    return {
+        "found":   [found[b] for b in barcodes if b in found],
+        "missing": [b for b in barcodes if b not in found],
+    }
+
+
+# ── Массовый импорт / экспорт ───────────────────────────────────────────────────
+async def _lines(request: Request) -> AsyncIterator[str]:
+    """Строки тела запроса по мере прихода, без чтения всего файла в память."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in request.stream():
+        lines = (tail + decoder.decode(chunk)).split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def _csv_records(request: Request) -> AsyncIterator[tuple[int, dict | str]]:
+    """(номер строки данных, {колонка: значение}); пустая ячейка — поле не передано."""
+    header: list[str] | None = None
+    record = ""
+    row_no = 0
+    async for line in _lines(request):
+        record += line
+        # Кавычка открыта — поле с переводом строки, ждём продолжения
+        if record.count('"') % 2:
+            continue
+        values = next(csv.reader([record]), [])
+        record = ""
+        if not values or values == [""]:
+            continue
+        if header is None:
+            header = [h.strip() for h in values]
+            if "barcode" not in header:
+                raise HTTPException(status_code=400, detail="CSV header must contain a barcode column")
+            continue
+        row_no += 1
+        if len(values) != len(header):
+            yield row_no, f"expected {len(header)} columns, got {len(values)}"
+            continue
+        yield row_no, {h: v for h, v in zip(header, values) if v != ""}
+
+
+async def _ndjson_records(request: Request) -> AsyncIterator[tuple[int, dict | str]]:
+    row_no = 0
+    async for line in _lines(request):
+        if not line.strip():
+            continue
+        row_no += 1
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield row_no, f"invalid JSON: {e.msg}"
+            continue
+        if not isinstance(record, dict):
+            yield row_no, "expected a JSON object"
+            continue
+        yield row_no, record
+
+
+def _validate_import(record: dict) -> dict | str:
+    """Поля для upsert (только переданные) или текст ошибки."""
+    try:
+        fields = ProductImport.model_validate(record).model_dump(exclude_unset=True)
+    except ValidationError as e:
+        return "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+    fields["barcode"] = fields["barcode"].strip()
+    if fields["barcode"].lower() in EMPTY_BARCODES:
+        # штрихкод — ключ upsert: без него строка вставлялась бы при каждом импорте
+        return "barcode: must not be empty or null"
+    for required in ("name", "price"):
+        if required in fields and fields[required] is None:
+            return f"{required}: must not be empty"
+    return fields
+
+
+def _import_format(request: Request, format: str | None) -> str:
+    if format is not None:
+        return format
+    content_type = request.headers.get("content-type", "")
+    if "csv" in content_type:
+        return "csv"
+    if "ndjson" in content_type or "jsonl" in content_type:
+        return "ndjson"
+    raise HTTPException(
+        status_code=415,
+        detail="Send text/csv or application/x-ndjson, or pass ?format=csv|ndjson",
+    )
+
+
+@router.post("/bulk", response_model=BulkImportResponse)
+async def bulk_import_products(
+    request: Request,
+    format: Literal["csv", "ndjson"] | None = None,
+):
+    """
+    Массовый upsert товаров по штрихкоду из CSV или NDJSON.
+
+    Тело читается потоком и пишется в БД чанками (executemany, одна
+    транзакция на чанк). Существующий товар обновляется только по
+    переданным колонкам — для переоценки достаточно файла barcode,price.
+    Пустая ячейка CSV оставляет поле как есть (очистить — null в NDJSON).
+    Новому товару нужны name и price. Колонки id и created_at (как в
+    GET /products/export) игнорируются.
+
+    Ошибочные строки не прерывают импорт: в ответе номер строки данных
+    (без заголовка CSV), штрихкод и причина.
+    """
+    records = _csv_records(request) if _import_format(request, format) == "csv" else _ndjson_records(request)
+    report = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+
+    async def valid_rows() -> AsyncIterator[tuple[int, dict]]:
+        async for row_no, record in records:
+            fields = record if isinstance(record, str) else _validate_import(record)
+            if isinstance(fields, str):
+                barcode = record.get("barcode") if isinstance(record, dict) else None
+                bulk_report_error(report, row_no, None if barcode is None else str(barcode), fields)
+                continue
+            yield row_no, fields
+
+    await bulk_upsert_products(valid_rows(), report)
+    report["errors"].sort(key=lambda e: e["row"])
+    return report
+
+
+@router.get("/export")
+async def export_products(format: Literal["csv", "ndjson"] = "csv"):
+    """
+    Весь каталог потоком: CSV (по умолчанию) или NDJSON.
+
+    Страницы читаются по одной (iter_products), так что память не зависит
+    от размера каталога. Файл подходит для POST /products/bulk.
+    """
+    if format == "ndjson":
+        async def body():
+            async for row in iter_products():
+                yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+        media_type = "application/x-ndjson"
+    else:
+        async def body():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(PRODUCT_FIELDS)
+            rows = 0
+            async for row in iter_products():
+                writer.writerow([row[f] for f in PRODUCT_FIELDS])
+                rows += 1
+                if rows % 500 == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        media_type = "text/csv; charset=utf-8"
+
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="products.{format}"'},
+    )
+
+
 @router.get("/{product_id}", response_model=ProductResponse)
 async def get_product(product_id: int):
     """
     Получить товар по ID.
     """
-    product = await get_product_by_id(product_id)
-    if not product:
+    body = await catalog_cache.get_json(product_id)
+    if body is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return product
+    return Response(content=body, media_type="application/json")
 
 
 @router.post("", response_model=ProductResponse, status_code=201)
@@ -76,17 +422,21 @@ async def create_new_product(product: ProductCreate):
     """
     Создать новый товар.
     """
-    product_id = await create_product(
-        name=product.name,
-        category=product.category,
-        description=product.description,
-        price=product.price,
-        image_url=product.image_url,
-        barcode=product.barcode,
-        in_stock=product.in_stock
-    )
+    try:
+        product_id = await create_product(
+            name=product.name,
+            category=product.category,
+            description=product.description,
+            price=product.price,
+            image_url=product.image_url,
+            barcode=product.barcode,
+            in_stock=product.in_stock,
+            name_kz=product.name_kz
+        )
+    except aiosqlite.IntegrityError:
+        raise HTTPException(status_code=409, detail="Product with this barcode already exists")
     
-    created_product = await get_product_by_id(product_id)
+    created_product = await catalog_cache.get(product_id)
     return created_product
 
 
@@ -97,21 +447,25 @@ async def update_product_endpoint(product_id: int, product: ProductUpdate):
     
     Обновляет только переданные поля. Если товар не найден, возвращает 404.
     """
-    updated = await update_product(
-        product_id=product_id,
-        name=product.name,
-        category=product.category,
-        description=product.description,
-        price=product.price,
-        image_url=product.image_url,
-        barcode=product.barcode,
-        in_stock=product.in_stock
-    )
+    try:
+        updated = await update_product(
+            product_id=product_id,
+            name=product.name,
+            category=product.category,
+            description=product.description,
+            price=product.price,
+            image_url=product.image_url,
+            barcode=product.barcode,
+            in_stock=product.in_stock,
+            name_kz=product.name_kz
+        )
+    except aiosqlite.IntegrityError:
+        raise HTTPException(status_code=409, detail="Product with this barcode already exists")
     
     if not updated:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    updated_product = await get_product_by_id(product_id)
+    updated_product = await catalog_cache.get(product_id)
     return updated_product
 
 
@@ -1,32 +1,482 @@
-from fastapi import APIRouter, HTTPException, UploadFile, File
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import BinaryIO
+from fastapi import APIRouter, Header, HTTPException, Request, Response, UploadFile, File, Form
+from fastapi.responses import StreamingResponse
+from fastapi.routing import APIRoute
 from pydantic import BaseModel
-from services.openai_service import recognize_from_image
-import base64
+from services.openai_service import (
+    ItemAssembler, detect_items, match_detected, recognize_from_image, stream_recognition,
+)
+from services.admission import Overloaded
+from services.catalog_cache import barcode_index
+from services.image_service import PreparedImage, decode_base64_image, preprocess_image, upload_sha256
+from services.recognition_cache import recognition_cache
+from services.idempotency import IdempotencyError, fingerprint, idempotency_store
+from services.metrics import record, span
 
-router = APIRouter(prefix="/recognize", tags=["recognize"])
+# Лимит тела запроса на одну картинку (для base64 в JSON считается закодированный размер)
+RECOGNIZE_MAX_UPLOAD_BYTES = int(os.getenv("RECOGNIZE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+RECOGNIZE_BATCH_MAX_IMAGES = int(os.getenv("RECOGNIZE_BATCH_MAX_IMAGES", "8"))
+# Как сводить quantity одного товара с разных фото корзины:
+# max — фото одной и той же корзины с разных ракурсов (товар виден на нескольких)
+# sum — фото разных частей корзины, которые не пересекаются
+RECOGNIZE_BATCH_QUANTITY = os.getenv("RECOGNIZE_BATCH_QUANTITY", "max")
+
+
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(413, f"Request body exceeds {limit} bytes")
+
+
+class _UploadLimitRoute(APIRoute):
+    """
+    Ограничение размера тела: по Content-Length — до чтения тела, иначе
+    (chunked) — на лету, как только прочитанное превысило лимит. Большая
+    загрузка отклоняется сразу, а не после того, как она целиком принята.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        batch = "/batch" in self.path
+
+        async def limited_handler(request: Request):
+            limit = RECOGNIZE_MAX_UPLOAD_BYTES * (RECOGNIZE_BATCH_MAX_IMAGES if batch else 1)
+            length = request.headers.get("content-length")
+            if length and length.isdigit() and int(length) > limit:
+                raise _too_large(limit)
+
+            receive, received, started = request.receive, 0, None
+
+            async def limited_receive():
+                nonlocal received, started
+                started = started or time.perf_counter()
+                message = await receive()
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise _too_large(limit)
+                if message["type"] == "http.request" and not message.get("more_body"):
+                    # Тело дочитано — сколько заняла загрузка от клиента
+                    record("recognize.upload", time.perf_counter() - started)
+                return message
+
+            return await handler(Request(request.scope, limited_receive))
+
+        return limited_handler
+
+
+router = APIRouter(prefix="/recognize", tags=["recognize"], route_class=_UploadLimitRoute)
 
 
 class RecognizeRequest(BaseModel):
-    image_base64: str  # base64-encoded JPEG/PNG
+    image_base64: str | None = None  # base64-encoded JPEG/PNG
+    barcodes: list[str] = []         # штрихкоды, уже декодированные на телефоне
+
+
+class RecognizeBatchRequest(BaseModel):
+    images_base64: list[str] = []    # несколько фото одной корзины
+    barcodes: list[str] = []
+
+
+async def _resolve_barcodes(barcodes: list[str]) -> tuple[list[dict], list[str]]:
+    """
+    Быстрый путь: товары по штрихкодам из памяти.
+    Возвращает (recognized_items, неизвестные штрихкоды); повторы → quantity.
+    """
+    barcodes = [b.strip() for b in barcodes if b and b.strip()]
+    found = await barcode_index.lookup(list(dict.fromkeys(barcodes)))
+
+    items: dict[int, dict] = {}
+    unknown: list[str] = []
+    for barcode in barcodes:
+        product = found.get(barcode)
+        if product is None:
+            unknown.append(barcode)
+        elif product["id"] in items:
+            items[product["id"]]["quantity"] += 1
+        else:
+            items[product["id"]] = {
+                "product_id": product["id"],
+                "name":       product["name"],
+                "price":      product["price"],
+                "quantity":   1,
+                "confidence": 1.0,
+                "source":     "barcode",
+            }
+    return list(items.values()), unknown
+
+
+def _merge_results(barcode_items: list[dict], unknown: list[str], model_result: dict | None) -> dict:
+    """Товары по штрихкодам + ответ модели (без повторов уже найденного), total пересчитан."""
+    items = list(barcode_items)
+    unrecognized = list(unknown)
+
+    if model_result:
+        known_ids = {i["product_id"] for i in barcode_items}
+        items += [
+            i for i in model_result.get("recognized_items", [])
+            if i.get("product_id") not in known_ids
+        ]
+        unrecognized += model_result.get("unrecognized", [])
+
+    total = sum(float(i.get("price") or 0) * int(i.get("quantity") or 1) for i in items)
+    return {
+        "recognized_items": items,
+        "unrecognized":     unrecognized,
+        "total":            round(total, 2),
+    }
+
+
+async def _digest(image: bytes | BinaryIO) -> str:
+    with span("recognize.hash"):
+        if isinstance(image, bytes):
+            return hashlib.sha256(image).hexdigest()
+        return await upload_sha256(image)
+
+
+async def _prepare(image: bytes | BinaryIO | None) -> PreparedImage | None:
+    """Предобработка картинки; битое изображение — 400, а не 500."""
+    if not image:
+        return None
+    try:
+        with span("recognize.preprocess"):
+            return await preprocess_image(image)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+async def _recognize_image(image: bytes | BinaryIO, known_items: list[str]) -> tuple[dict, dict]:
+    """
+    Распознавание картинки через кэш: SHA-256 исходных байт (ещё до предобработки),
+    затем dHash предобработанной картинки, и только потом модель.
+    Возвращает (результат модели, meta).
+    """
+    digest = await _digest(image)
+    cached = recognition_cache.get_exact(digest, known_items)
+    if cached is not None:
+        return cached, {"cache": "exact"}
+
+    prepared = await _prepare(image)
+    cached = recognition_cache.get_similar(prepared.dhash, known_items, prepared.signature)
+    if cached is not None:
+        return cached, {"image": prepared.meta(), "cache": "similar"}
+
+    result = await recognize_from_image(
+        prepared.base64, known_items=known_items or None, detail=prepared.detail
+    )
+    recognition_cache.put(digest, prepared.dhash, known_items, result, prepared.signature)
+    return result, {"image": prepared.meta(), "cache": "miss"}
+
+
+async def _recognize(image: bytes | BinaryIO | None, barcodes: list[str]) -> dict:
+    barcode_items, unknown = await _resolve_barcodes(barcodes) if barcodes else ([], [])
+
+    model_result, meta = None, None
+    if image:
+        model_result, meta = await _recognize_image(image, [i["name"] for i in barcode_items])
+
+    if barcodes:
+        result = _merge_results(barcode_items, unknown, model_result)
+    else:
+        result = dict(model_result)   # копия: объект из кэша не трогаем
+
+    if meta:
+        result["meta"] = meta
+    return result
 
 
 @router.post("")
-async def recognize(req: RecognizeRequest):
-    if not req.image_base64:
-        raise HTTPException(400, "image_base64 is required")
+async def recognize(
+    req: RecognizeRequest,
+    request: Request,
+    idempotency_key: str | None = Header(None),
+):
+    """
+    Recognize products from a base64 image and/or client-decoded barcodes.
+
+    Items with known barcodes are resolved locally; only the rest of the
+    photo goes to the model. Without an image only barcodes are resolved.
+
+    With an Idempotency-Key header a retried request does not call the
+    model again: it waits for the original or replays its response.
+    """
+    if idempotency_key is None:
+        return await _recognize_request(req)
     try:
-        result = await recognize_from_image(req.image_base64)
+        status, body, replayed = await idempotency_store.run(
+            "recognize", idempotency_key, fingerprint(await request.body()), lambda: _recognize_request(req)
+        )
+    except IdempotencyError as e:
+        raise HTTPException(e.status_code, e.detail)
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(body, status_code=status, media_type="application/json", headers=headers)
+
+
+async def _recognize_request(req: RecognizeRequest) -> dict:
+    if not req.image_base64 and not req.barcodes:
+        raise HTTPException(400, "image_base64 or barcodes is required")
+    try:
+        image = decode_base64_image(req.image_base64) if req.image_base64 else None
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    try:
+        result = await _recognize(image, req.barcodes)
         return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Recognition failed: {e}")
+
+
+# ── Пакетное распознавание ────────────────────────────────────────────────────
+async def _detect_image(image: bytes | BinaryIO, digest: str, known_items: list[str]) -> dict:
+    """
+    Одна картинка пакета: кэш → предобработка → модель (без сопоставления с БД).
+    Возвращает {"digest", "dhash", "signature", "result" | "detected", "meta"}.
+    """
+    cached = recognition_cache.get_exact(digest, known_items)
+    if cached is not None:
+        return {"digest": digest, "result": cached, "meta": {"cache": "exact"}}
+
+    prepared = await _prepare(image)
+    cached = recognition_cache.get_similar(prepared.dhash, known_items, prepared.signature)
+    if cached is not None:
+        return {"digest": digest, "result": cached, "meta": {"image": prepared.meta(), "cache": "similar"}}
+
+    detected = await detect_items(prepared.base64, known_items=known_items or None, detail=prepared.detail)
+    return {
+        "digest":    digest,
+        "dhash":     prepared.dhash,
+        "signature": prepared.signature,
+        "detected":  detected,
+        "meta":      {"image": prepared.meta(), "cache": "miss"},
+    }
+
+
+def _reconcile(results: list[dict], policy: str = RECOGNIZE_BATCH_QUANTITY) -> dict:
+    """Сводит результаты нескольких фото: товар один раз, quantity по политике (max | sum)."""
+    items: dict[int, dict] = {}
+    unrecognized: dict[str, None] = {}
+    for result in results:
+        for item in result.get("recognized_items", []):
+            current = items.get(item["product_id"])
+            if current is None:
+                items[item["product_id"]] = dict(item)
+                continue
+            if policy == "sum":
+                current["quantity"] += item["quantity"]
+            else:
+                current["quantity"] = max(current["quantity"], item["quantity"])
+            current["confidence"] = max(current["confidence"], item["confidence"])
+        unrecognized.update(dict.fromkeys(result.get("unrecognized", [])))
+
+    total = sum(i["price"] * i["quantity"] for i in items.values())
+    return {
+        "recognized_items": list(items.values()),
+        "unrecognized":     list(unrecognized),
+        "total":            round(total, 2),
+    }
+
+
+async def _recognize_batch(images: list[bytes | BinaryIO], barcodes: list[str]) -> dict:
+    """
+    Несколько фото одной корзины: предобработка и вызовы модели идут параллельно
+    (число одновременных вызовов ограничивает openai_admission), затем все
+    обнаруженные позиции сопоставляются с БД одним запросом.
+    """
+    barcode_items, unknown = await _resolve_barcodes(barcodes) if barcodes else ([], [])
+    known_items = [i["name"] for i in barcode_items]
+
+    # Одинаковые байты в пакете — одна предобработка и один вызов модели
+    digests = await asyncio.gather(*(_digest(image) for image in images))
+    first_of: dict[str, int] = {}
+    for i, digest in enumerate(digests):
+        first_of.setdefault(digest, i)
+    unique = await asyncio.gather(*(
+        _detect_image(images[i], digest, known_items) for digest, i in first_of.items()
+    ))
+    by_digest = dict(zip(first_of, unique))
+
+    misses = [r for r in unique if "detected" in r]
+    detected = [d for r in misses for d in r["detected"]]
+    with span("recognize.match"):
+        matches = iter(await match_detected(detected)) if detected else iter(())
+        for r in misses:
+            assembler = ItemAssembler()
+            for d in r["detected"]:
+                assembler.add(d, next(matches))
+            r["result"] = assembler.result()
+            recognition_cache.put(r["digest"], r["dhash"], known_items, r["result"], r["signature"])
+
+    per_image = [by_digest[digest] for digest in digests]
+    model_result = _reconcile([r["result"] for r in per_image])
+    result = _merge_results(barcode_items, unknown, model_result)
+    result["meta"] = {
+        "images": [
+            r["meta"] if first_of[digest] == i else {**r["meta"], "duplicate_of": first_of[digest]}
+            for i, (digest, r) in enumerate(zip(digests, per_image))
+        ],
+        "quantity_policy": RECOGNIZE_BATCH_QUANTITY,
+    }
+    return result
+
+
+def _check_batch_size(count: int) -> None:
+    if count == 0:
+        raise HTTPException(400, "At least one image is required")
+    if count > RECOGNIZE_BATCH_MAX_IMAGES:
+        raise HTTPException(400, f"At most {RECOGNIZE_BATCH_MAX_IMAGES} images per batch")
+
+
+@router.post("/batch")
+async def recognize_batch(req: RecognizeBatchRequest):
+    """
+    Recognize one basket from several base64 photos (top, side, shelf).
+
+    Items are merged by product_id: a product seen on several photos is
+    counted once, with quantity reconciled by RECOGNIZE_BATCH_QUANTITY.
+    """
+    _check_batch_size(len(req.images_base64))
+    try:
+        images = [decode_base64_image(b64) for b64 in req.images_base64]
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    try:
+        return await _recognize_batch(images, req.barcodes)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Recognition failed: {e}")
 
 
+@router.post("/batch/file")
+async def recognize_batch_file(
+    files: list[UploadFile] = File(...),
+    barcodes: str | None = Form(None, description="Comma-separated client-decoded barcodes"),
+):
+    """Multipart variant of POST /recognize/batch: several image files in `files`."""
+    _check_batch_size(len(files))
+    for file in files:
+        if not file.content_type or not file.content_type.startswith("image/"):
+            raise HTTPException(400, "Only image files are allowed (JPEG, PNG)")
+
+    try:
+        images = [file.file for file in files]
+        barcode_list = [b for b in (barcodes or "").split(",") if b.strip()]
+        return await _recognize_batch(images, barcode_list)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(500, f"Recognition failed: {e}")
+
+
+# ── Потоковое распознавание ───────────────────────────────────────────────────
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+
+async def _recognize_events(image: bytes | None, barcodes: list[str]):
+    """
+    События потокового распознавания: сначала товары по штрихкодам, затем
+    товары с фото по мере их сопоставления с БД, в конце — итог (done).
+    Результат модели, как и в _recognize_image, кладётся в кэш.
+    """
+    barcode_items, unknown = await _resolve_barcodes(barcodes) if barcodes else ([], [])
+    for item in barcode_items:
+        yield _sse("item", item)
+    for barcode in unknown:
+        yield _sse("unrecognized", {"name": barcode})
+
+    model_result, meta = None, None
+    if image:
+        known_ids = {i["product_id"] for i in barcode_items}
+        known_items = [i["name"] for i in barcode_items]
+        digest = await _digest(image)
+        model_result = recognition_cache.get_exact(digest, known_items)
+        meta = {"cache": "exact"}
+        if model_result is None:
+            prepared = await _prepare(image)
+            model_result = recognition_cache.get_similar(prepared.dhash, known_items, prepared.signature)
+            meta = {"image": prepared.meta(), "cache": "similar"}
+
+        if model_result is not None:
+            for item in model_result["recognized_items"]:
+                if item["product_id"] not in known_ids:
+                    yield _sse("item", item)
+            for name in model_result["unrecognized"]:
+                yield _sse("unrecognized", {"name": name})
+        else:
+            meta["cache"] = "miss"
+            async for event in stream_recognition(
+                prepared.base64, known_items=known_items or None, detail=prepared.detail
+            ):
+                if event["type"] == "item" and event["item"]["product_id"] not in known_ids:
+                    yield _sse("item", event["item"])
+                elif event["type"] == "unrecognized":
+                    yield _sse("unrecognized", {"name": event["name"]})
+                elif event["type"] == "result":
+                    model_result = event["result"]
+            recognition_cache.put(digest, prepared.dhash, known_items, model_result, prepared.signature)
+
+    result = _merge_results(barcode_items, unknown, model_result)
+    if meta:
+        result["meta"] = meta
+    yield _sse("done", result)
+
+
+async def _guarded_events(image: bytes | None, barcodes: list[str]):
+    """Ошибка посреди потока уходит клиенту событием error — статус 200 уже отправлен."""
+    try:
+        async for chunk in _recognize_events(image, barcodes):
+            yield chunk
+    except Overloaded as e:
+        yield _sse("error", {"detail": e.detail, "retry_after": e.retry_after})
+    except HTTPException as e:
+        yield _sse("error", {"detail": e.detail})
+    except Exception as e:
+        yield _sse("error", {"detail": f"Recognition failed: {e}"})
+
+
+@router.post("/stream")
+async def recognize_stream(req: RecognizeRequest):
+    """
+    Streaming variant of POST /recognize (Server-Sent Events).
+
+    Emits `item` as soon as a product is matched in the DB (a repeated
+    product is re-sent with the accumulated quantity), `unrecognized` for
+    names not found, and a final `done` event with the same body as
+    POST /recognize. Failures after the stream has started arrive as `error`.
+    """
+    if not req.image_base64 and not req.barcodes:
+        raise HTTPException(400, "image_base64 or barcodes is required")
+    try:
+        image = decode_base64_image(req.image_base64) if req.image_base64 else None
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    return StreamingResponse(
+        _guarded_events(image, req.barcodes),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.post("/file")
-async def recognize_file(file: UploadFile = File(...)):
+async def recognize_file(
+    file: UploadFile = File(...),
+    barcodes: str | None = Form(None, description="Comma-separated client-decoded barcodes"),
+):
     """
     Recognize products from an uploaded image file.
     
-    Accepts JPEG/PNG files directly and converts them to base64 internally.
+    Accepts JPEG/PNG files directly; the image is downscaled and re-encoded
+    before it is base64-encoded for the model. The upload is never read into
+    memory as a whole: it is hashed and decoded straight from the spooled file.
+    Bodies over RECOGNIZE_MAX_UPLOAD_BYTES are rejected with 413.
     This endpoint is more convenient for Swagger UI and file uploads.
     """
     # Validate file type
@@ -34,14 +484,11 @@ async def recognize_file(file: UploadFile = File(...)):
         raise HTTPException(400, "Only image files are allowed (JPEG, PNG)")
     
     try:
-        # Read file content
-        file_content = await file.read()
-        
-        # Convert to base64 (without data:image/...;base64, prefix)
-        image_base64 = base64.b64encode(file_content).decode("utf-8")
-        
-        # Call the existing recognition function
-        result = await recognize_from_image(image_base64)
+        # Call the existing recognition function on the spooled upload
+        barcode_list = [b for b in (barcodes or "").split(",") if b.strip()]
+        result = await _recognize(file.file, barcode_list)
         return result
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Recognition failed: {e}")
\ No newline at end of file
@@ -0,0 +1,328 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+
+from services import metrics
+
+# ── Лимиты OpenAI (на воркер: лимит аккаунта / число воркеров) ────────────────
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))          # запросов в минуту, 0 — без лимита
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))       # токенов в минуту, 0 — без лимита
+# Окно одновременных вызовов (AIMD): стартует с OPENAI_MAX_CONCURRENCY,
+# растёт на 1 за «окно» успешных вызовов, падает вдвое на 429 и на 10%,
+# если ответ медленнее OPENAI_TARGET_LATENCY
+OPENAI_MAX_CONCURRENCY   = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MIN_CONCURRENCY   = int(os.getenv("OPENAI_MIN_CONCURRENCY", "1"))
+OPENAI_CONCURRENCY_LIMIT = int(os.getenv("OPENAI_CONCURRENCY_LIMIT", str(OPENAI_MAX_CONCURRENCY * 4)))
+OPENAI_TARGET_LATENCY    = float(os.getenv("OPENAI_TARGET_LATENCY", "15"))   # сек
+# Очередь ожидания: сверх неё и дольше дедлайна — сразу 503 + Retry-After
+OPENAI_QUEUE_MAX     = int(os.getenv("OPENAI_QUEUE_MAX", "32"))
+OPENAI_QUEUE_TIMEOUT = float(os.getenv("OPENAI_QUEUE_TIMEOUT", "10"))     # сек
+
+_BACKOFF_429  = 0.5     # множитель окна при 429
+_BACKOFF_SLOW = 0.9     # множитель окна при медленном ответе
+_LATENCY_EWMA = 0.2     # вес нового замера в сглаженной задержке
+
+admission_queue_depth = metrics.Gauge(
+    "openai_admission_queue_depth", "Model calls waiting for admission", ("pool",)
+)
+admission_in_flight = metrics.Gauge(
+    "openai_admission_in_flight", "Admitted model calls in flight", ("pool",)
+)
+admission_limit = metrics.Gauge(
+    "openai_admission_concurrency_limit", "Current AIMD concurrency limit", ("pool",)
+)
+admission_rejections = metrics.Counter(
+    "openai_admission_rejections_total",
+    "Model calls shed with 503 by reason (queue_full, deadline, rate_limited)",
+    ("pool", "reason"),
+)
+admission_wait_seconds = metrics.Histogram(
+    "openai_admission_wait_seconds", "Time a model call waited for admission", ("pool",)
+)
+for _metric in (admission_queue_depth, admission_in_flight, admission_limit,
+                admission_rejections, admission_wait_seconds):
+    metrics.register(_metric)
+
+
+class Overloaded(HTTPException):
+    """Вызов модели не принят: 503 с Retry-After, а не 500 после 429 от OpenAI."""
+
+    def __init__(self, detail: str, retry_after: float):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(503, detail, headers={"Retry-After": str(self.retry_after)})
+
+
+class TokenBucket:
+    """Ведро на per_minute единиц, пополняется непрерывно; per_minute <= 0 — без лимита."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Через сколько секунд в ведре будет amount (0 — уже есть)."""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        # запрос дороже всего ведра ждёт полного ведра, а не вечно
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float) -> None:
+        if not self.unlimited:
+            self._refill()
+            self.tokens -= amount
+
+    def give(self, amount: float) -> None:
+        """Поправка по факту: usage меньше оценки — вернуть, больше — доплатить (уйти в минус)."""
+        if not self.unlimited:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self) -> None:
+        """После 429 от OpenAI: ведро пустое, следующие запросы ждут пополнения."""
+        if not self.unlimited:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+
+class Permit:
+    """Допуск одного вызова; usage из ответа уточняет списанные токены."""
+
+    def __init__(self, controller: "AdmissionController", estimated_tokens: int):
+        self._controller = controller
+        self.estimated_tokens = estimated_tokens
+        self.started = time.monotonic()
+
+    def record_usage(self, usage) -> None:
+        if usage is None:
+            return
+        total = usage.get("total_tokens") if isinstance(usage, dict) else getattr(usage, "total_tokens", None)
+        if total:
+            self._controller.tpm.give(self.estimated_tokens - total)
+            self.estimated_tokens = total
+
+
+class AdmissionController:
+    """
+    Допуск вызовов модели: ведро запросов (RPM) и токенов (TPM), окно
+    одновременных вызовов с AIMD и ограниченная очередь с дедлайном.
+
+    Вызов ждёт в очереди (FIFO), пока есть место в окне и в обоих вёдрах.
+    Если очередь полна или ждать дольше OPENAI_QUEUE_TIMEOUT — сразу
+    Overloaded (503 + Retry-After): клиент повторит позже, а не получит 500
+    после 429 от OpenAI. 429 всё же пришёл — окно вдвое меньше, ведро
+    запросов опустошается, вызывающий получает тот же 503.
+    """
+
+    def __init__(
+        self,
+        name: str = "openai",
+        rpm: int = OPENAI_RPM,
+        tpm: int = OPENAI_TPM,
+        initial_limit: int = OPENAI_MAX_CONCURRENCY,
+        min_limit: int = OPENAI_MIN_CONCURRENCY,
+        max_limit: int = OPENAI_CONCURRENCY_LIMIT,
+        target_latency: float = OPENAI_TARGET_LATENCY,
+        queue_max: int = OPENAI_QUEUE_MAX,
+        queue_timeout: float = OPENAI_QUEUE_TIMEOUT,
+    ):
+        self.name = name
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.target_latency = target_latency
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.latency = target_latency / 2     # сглаженная задержка вызова, сек
+        self._waiters: deque[tuple[asyncio.Future, int]] = deque()
+        self._timer: asyncio.TimerHandle | None = None
+        self._decreased_at = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def snapshot(self) -> dict:
+        return {
+            "limit":       int(self.limit),
+            "in_flight":   self.in_flight,
+            "queue_depth": self.queue_depth,
+            "latency":     round(self.latency, 3),
+        }
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int = 0):
+        """
+        async with admission.slot(tokens) as permit: — вызов модели внутри;
+        permit.record_usage(response.usage) уточняет списанные токены.
+        """
+        await self._acquire(estimated_tokens)
+        permit = Permit(self, estimated_tokens)
+        try:
+            yield permit
+        except Exception as e:
+            self._release(permit, failed=True)
+            if getattr(e, "status_code", None) == 429:
+                raise self._upstream_rate_limited(e) from e
+            raise
+        except BaseException:
+            self._release(permit, failed=True)
+            raise
+        else:
+            self._release(permit)
+
+    # ── Очередь ───────────────────────────────────────────────────────────────
+    async def _acquire(self, tokens: int) -> None:
+        if not self._waiters and self._admissible(tokens):
+            self._admit(tokens)
+            admission_wait_seconds.observe(self.name, value=0.0)
+            return
+
+        # Вёдра пропустят и всех, кто уже в очереди: ждать дольше дедлайна —
+        # отказ сразу, а не через queue_timeout
+        wait = max(
+            self.rpm.wait_time(len(self._waiters) + 1),
+            self.tpm.wait_time(tokens + sum(t for _, t in self._waiters)),
+        )
+        if wait > self.queue_timeout:
+            self._reject("deadline")
+            raise Overloaded("Model rate limit reached, retry later", wait)
+        if len(self._waiters) >= self.queue_max:
+            self._reject("queue_full")
+            raise Overloaded("Too many recognition requests, retry later", self._expected_wait())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, tokens)
+        self._waiters.append(entry)
+        self._dispatch()
+        started = time.monotonic()
+        try:
+            with metrics.span("recognize.queue"):
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            # допуск мог прийти одновременно с таймаутом — тогда он засчитан
+            if not future.done():
+                self._waiters.remove(entry)
+                self._reject("deadline")
+                raise Overloaded("Timed out waiting for a model slot, retry later", self._expected_wait())
+        except BaseException:
+            if not future.done():
+                self._waiters.remove(entry)
+            elif not future.cancelled():
+                self._release(Permit(self, 0), failed=True)   # допуск выдан, но уже не нужен
+            raise
+        finally:
+            admission_wait_seconds.observe(self.name, value=time.monotonic() - started)
+
+    def _admissible(self, tokens: int) -> bool:
+        return self.in_flight < int(self.limit) and self._bucket_wait(tokens) == 0
+
+    def _bucket_wait(self, tokens: int) -> float:
+        return max(self.rpm.wait_time(1), self.tpm.wait_time(tokens))
+
+    def _admit(self, tokens: int) -> None:
+        self.rpm.take(1)
+        self.tpm.take(tokens)
+        self.in_flight += 1
+
+    def _dispatch(self) -> None:
+        """Пропускает очередь по порядку, пока хватает окна и вёдер."""
+        while self._waiters and self.in_flight < int(self.limit):
+            future, tokens = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            wait = self._bucket_wait(tokens)
+            if wait > 0:
+                self._schedule(wait)
+                return
+            self._waiters.popleft()
+            self._admit(tokens)
+            future.set_result(None)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _expected_wait(self) -> float:
+        """
+        Оценка для Retry-After: очередь проходит окнами по сглаженной задержке,
+        но не дольше queue_timeout — к этому времени нынешняя очередь либо
+        обслужена, либо отвергнута.
+        """
+        rounds = (len(self._waiters) + 1) / max(1, int(self.limit))
+        return max(self._bucket_wait(0), min(rounds * self.latency, self.queue_timeout))
+
+    def _reject(self, reason: str) -> None:
+        admission_rejections.inc(self.name, reason)
+
+    # ── AIMD ──────────────────────────────────────────────────────────────────
+    def _release(self, permit: Permit, failed: bool = False) -> None:
+        self.in_flight -= 1
+        if not failed:
+            elapsed = time.monotonic() - permit.started
+            self.latency += _LATENCY_EWMA * (elapsed - self.latency)
+            if elapsed > self.target_latency:
+                self._decrease(_BACKOFF_SLOW)
+            elif self.in_flight + 1 >= int(self.limit):
+                # растём, только когда окно действительно было заполнено
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._dispatch()
+
+    def _decrease(self, factor: float) -> None:
+        # Одна перегрузка бьёт по всем вызовам в полёте — окно уменьшается
+        # не чаще раза за сглаженную задержку, а не по разу на каждый ответ
+        now = time.monotonic()
+        if now - self._decreased_at < self.latency:
+            return
+        self._decreased_at = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+    def _upstream_rate_limited(self, error: Exception) -> Overloaded:
+        self._decrease(_BACKOFF_429)
+        self.rpm.drain()
+        self._reject("rate_limited")
+        retry_after = 1.0
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after", retry_after))
+            except (TypeError, ValueError):
+                pass
+        return Overloaded("Model rate limit reached, retry later", max(retry_after, self._bucket_wait(1)))
+
+
+def _collect_admission_metrics() -> None:
+    for controller in (openai_admission,):
+        admission_queue_depth.set(controller.name, value=controller.queue_depth)
+        admission_in_flight.set(controller.name, value=controller.in_flight)
+        admission_limit.set(controller.name, value=int(controller.limit))
+
+
+openai_admission = AdmissionController()
+metrics.add_collector(_collect_admission_metrics)
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+
+import database
+
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "10000"))   # товаров в LRU по id
+# Страховка для нескольких воркеров uvicorn: запись в соседнем процессе
+# не патчит наш кэш, поэтому данные живут не дольше TTL (0 — без ограничения)
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "30"))
+
+
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=str).encode()
+
+
+class CatalogCache:
+    """
+    Кэш каталога в памяти процесса:
+      - полный список (GET /products) хранится уже сериализованным в JSON-байты
+      - товары по id — ограниченный LRU из (dict, JSON-байты)
+
+    Записи через database.py патчат LRU и сбрасывают список (пересобирается
+    одним запросом при следующем чтении). generation защищает от гонки, когда
+    чтение из БД началось до записи, а закончилось после неё.
+    """
+
+    def __init__(self, max_items: int = CATALOG_CACHE_SIZE, ttl: float = CATALOG_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._list_json: bytes | None = None
+        self._list_version = 0
+        self._list_loaded_at = 0.0
+        self._by_id: OrderedDict[int, tuple[dict, bytes, float]] = OrderedDict()
+        self._generation = 0
+        self._list_lock = asyncio.Lock()
+
+    # ── Чтение ────────────────────────────────────────────────────────────────
+    async def list_json(self) -> bytes:
+        """JSON-байты ответа GET /products: {"count": n, "products": [...]}."""
+        _, body = await self.list_snapshot()
+        return body
+
+    async def list_snapshot(self) -> tuple[int, bytes]:
+        """(версия каталога, JSON-байты списка) — версия идёт в ETag."""
+        if self._list_json is not None and self._fresh(self._list_loaded_at):
+            return self._list_version, self._list_json
+
+        async with self._list_lock:
+            # Пока ждали lock, список мог пересобрать другой запрос
+            if self._list_json is not None and self._fresh(self._list_loaded_at):
+                return self._list_version, self._list_json
+            return await self._load_list()
+
+    async def get(self, product_id: int) -> dict | None:
+        entry = self._lru_get(product_id) or await self._load_one(product_id)
+        return entry[0] if entry else None
+
+    async def get_json(self, product_id: int) -> bytes | None:
+        """JSON-байты ответа GET /products/{id} или None, если товара нет."""
+        entry = self._lru_get(product_id) or await self._load_one(product_id)
+        return entry[1] if entry else None
+
+    async def get_many(self, product_ids: list[int]) -> dict[int, dict]:
+        """{id: товар} для найденных: из LRU, недостающие — одним WHERE id IN."""
+        found: dict[int, dict] = {}
+        missing: list[int] = []
+        for product_id in dict.fromkeys(product_ids):
+            entry = self._lru_get(product_id)
+            if entry is not None:
+                found[product_id] = entry[0]
+            else:
+                missing.append(product_id)
+
+        if missing:
+            generation = self._generation
+            for row in await database.get_products_by_ids(missing):
+                found[row["id"]] = row
+                if generation == self._generation:
+                    self._lru_put(row["id"], row)
+        return found
+
+    # ── Прогрев и инвалидация ─────────────────────────────────────────────────
+    async def warm(self) -> None:
+        """Загружает весь каталог одним запросом. Вызывается из lifespan."""
+        await self._load_list(fill_lru=True)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._list_json = None
+        self._by_id.clear()
+
+    def on_product_change(self, kind: str, product_id: int, row: dict | None) -> None:
+        """Колбэк database.add_product_listener: патчит LRU, сбрасывает список."""
+        if kind == "reload":
+            self.clear()
+            return
+        self._generation += 1
+        self._list_json = None
+        if kind == "upsert" and row is not None:
+            self._lru_put(product_id, row)
+        else:
+            self._by_id.pop(product_id, None)
+
+    # ── Внутреннее ────────────────────────────────────────────────────────────
+    def _fresh(self, loaded_at: float) -> bool:
+        return self.ttl <= 0 or time.monotonic() - loaded_at < self.ttl
+
+    def _lru_get(self, product_id: int) -> tuple[dict, bytes, float] | None:
+        entry = self._by_id.get(product_id)
+        if entry is None:
+            return None
+        if not self._fresh(entry[2]):
+            del self._by_id[product_id]
+            return None
+        self._by_id.move_to_end(product_id)
+        return entry
+
+    def _lru_put(self, product_id: int, row: dict) -> tuple[dict, bytes, float]:
+        entry = (row, _dumps(row), time.monotonic())
+        self._by_id[product_id] = entry
+        self._by_id.move_to_end(product_id)
+        while len(self._by_id) > self.max_items:
+            self._by_id.popitem(last=False)
+        return entry
+
+    async def _load_one(self, product_id: int) -> tuple[dict, bytes, float] | None:
+        generation = self._generation
+        row = await database.get_product_by_id(product_id)
+        if row is None:
+            return None
+        if generation != self._generation:
+            # Во время чтения прошла запись — отдаём прочитанное, но не кэшируем
+            return (row, _dumps(row), 0.0)
+        return self._lru_put(product_id, row)
+
+    async def _load_list(self, fill_lru: bool = False) -> tuple[int, bytes]:
+        generation = self._generation
+        version, products = await database.get_catalog_snapshot()
+        body = _dumps({"count": len(products), "products": products})
+
+        if generation == self._generation:
+            self._list_json = body
+            self._list_version = version
+            self._list_loaded_at = time.monotonic()
+            if fill_lru:
+                for row in products[: self.max_items]:
+                    self._lru_put(row["id"], row)
+        return version, body
+
+
+class BarcodeIndex:
+    """
+    Полная карта штрихкод → товар в памяти процесса.
+    Нужна для быстрого пути распознавания: товары с известным штрихкодом
+    находятся за микросекунды, без модели и без запроса в БД.
+    """
+
+    def __init__(self, ttl: float = CATALOG_CACHE_TTL):
+        self.ttl = ttl
+        self._by_barcode: dict[str, dict] = {}
+        self._barcode_of: dict[int, str] = {}
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    async def warm(self) -> None:
+        """Загружает все штрихкоды. Вызывается из lifespan."""
+        async with self._lock:
+            await self._load()
+
+    def clear(self) -> None:
+        self._by_barcode.clear()
+        self._barcode_of.clear()
+        self._loaded_at = None
+
+    async def lookup(self, barcodes: list[str]) -> dict[str, dict]:
+        """{штрихкод: товар} для найденных штрихкодов; неизвестные отсутствуют."""
+        if self._stale():
+            async with self._lock:
+                if self._stale():
+                    await self._load()
+
+        found = {}
+        missing = []
+        for barcode in barcodes:
+            product = self._by_barcode.get(barcode)
+            if product is not None:
+                found[barcode] = product
+            else:
+                missing.append(barcode)
+
+        if missing:
+            # Товар мог появиться через другой воркер — добираем по индексу в БД
+            for row in await database.get_products_by_barcodes(missing):
+                self._put(row)
+                found[row["barcode"]] = row
+        return found
+
+    def on_product_change(self, kind: str, product_id: int, row: dict | None) -> None:
+        """Колбэк database.add_product_listener."""
+        if kind == "reload":
+            self._loaded_at = None    # перечитаем целиком при следующем lookup
+            return
+        old = self._barcode_of.pop(product_id, None)
+        if old is not None:
+            self._by_barcode.pop(old, None)
+        if kind == "upsert" and row is not None:
+            self._put(row)
+
+    def _stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        return self.ttl > 0 and time.monotonic() - self._loaded_at >= self.ttl
+
+    def _put(self, row: dict) -> None:
+        if row.get("barcode") and row["barcode"] not in database.EMPTY_BARCODES:
+            self._by_barcode[row["barcode"]] = row
+            self._barcode_of[row["id"]] = row["barcode"]
+
+    async def _load(self) -> None:
+        products = await database.get_all_products()
+        self.clear()
+        for row in products:
+            self._put(row)
+        self._loaded_at = time.monotonic()
+
+
+catalog_cache = CatalogCache()
+barcode_index = BarcodeIndex()
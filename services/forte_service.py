@@ -1,6 +1,13 @@
 import os
-import httpx
 import base64
+from services.http_clients import (
+    FORTE_CREATE_TIMEOUT,
+    FORTE_STATUS_RETRIES,
+    FORTE_STATUS_TIMEOUT,
+    forte_client,
+    request_with_retry,
+)
+from services.metrics import timed
 
 FORTE_BASE_URL = os.getenv("FORTE_BASE_URL", "http://localhost:8082")
 FORTE_LOGIN    = os.getenv("FORTE_LOGIN", "TerminalSys/Login1")
@@ -13,17 +20,18 @@ def _basic_auth_header() -> str:
     return f"Basic {encoded}"
 
 
-async def create_order(amount: float, description: str, redirect_url: str) -> dict:
+@timed("forte.create_order")
+async def create_order(amount_tiyn: int, description: str, redirect_url: str) -> dict:
     """
     Создаёт ордер в Forte и возвращает:
       - order_id   (int64)
       - password   (str)
       - hpp_url    (str) — ссылка для открытия в браузере
-    """
-    # Forte принимает сумму в тиынах (минимальных единицах).
-    # 1 тенге = 100 тиын → умножаем на 100
-    amount_tiyn = int(amount * 100)
 
+    amount_tiyn — сумма в тиынах (минимальных единицах, 1 тенге = 100 тиын),
+    уже посчитанная целыми числами (services/pricing.py): float-сумма при
+    int(amount * 100) теряла тиын.
+    """
     payload = {
         "order": {
             "typeRid":       "Order_RID",
@@ -41,12 +49,13 @@ async def create_order(amount: float, description: str, redirect_url: str) -> di
         "Content-Type":  "application/json",
     }
 
-    async with httpx.AsyncClient(timeout=15) as client:
-        resp = await client.post(
-            f"{FORTE_BASE_URL}/order",
-            json=payload,
-            headers=headers,
-        )
+    # POST не идемпотентен — без повторов, иначе рискуем создать два ордера
+    resp = await forte_client().post(
+        f"{FORTE_BASE_URL}/order",
+        json=payload,
+        headers=headers,
+        timeout=FORTE_CREATE_TIMEOUT,
+    )
 
     if resp.status_code not in (200, 201):
         raise RuntimeError(f"Forte create_order failed: {resp.status_code} {resp.text}")
@@ -69,16 +78,22 @@ async def create_order(amount: float, description: str, redirect_url: str) -> di
     }
 
 
+@timed("forte.get_order_status")
 async def get_order_status(forte_order_id: int, password: str) -> str:
     """Возвращает статус ордера: Preparing | FullyPaid | Declined | ..."""
     headers = {"Authorization": _basic_auth_header()}
 
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(
-            f"{FORTE_BASE_URL}/order/{forte_order_id}",
-            params={"password": password, "tranDetailLevel": "1"},
-            headers=headers,
-        )
+    # Чтение статуса идемпотентно — повторяем с джиттером при сбоях сети/5xx
+    resp = await request_with_retry(
+        forte_client(),
+        "GET",
+        f"{FORTE_BASE_URL}/order/{forte_order_id}",
+        pool="forte",
+        retries=FORTE_STATUS_RETRIES,
+        params={"password": password, "tranDetailLevel": "1"},
+        headers=headers,
+        timeout=FORTE_STATUS_TIMEOUT,
+    )
 
     if resp.status_code != 200:
         raise RuntimeError(f"Forte get_order failed: {resp.status_code}")
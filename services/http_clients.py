@@ -0,0 +1,214 @@
+import asyncio
+import importlib.util
+import os
+import random
+
+import httpx
+from openai import AsyncOpenAI
+
+from services import metrics
+
+# ── Настройки пулов соединений ────────────────────────────────────────────────
+HTTP_MAX_CONNECTIONS     = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE       = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY    = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT     = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+# HTTP/2 включается, только если установлен пакет h2 (pip install httpx[http2])
+HTTP2_ENABLED = os.getenv("HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+FORTE_CREATE_TIMEOUT = float(os.getenv("FORTE_CREATE_TIMEOUT", "15"))
+FORTE_STATUS_TIMEOUT = float(os.getenv("FORTE_STATUS_TIMEOUT", "10"))
+FORTE_STATUS_RETRIES = int(os.getenv("FORTE_STATUS_RETRIES", "3"))
+
+OPENAI_TIMEOUT     = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class PoolStats:
+    """Счётчики одного пула: сколько запросов в полёте и насколько пул забит."""
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.retries_total = 0
+
+    def started(self) -> None:
+        self.in_flight += 1
+        self.requests_total += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self, error: bool = False) -> None:
+        self.in_flight -= 1
+        if error:
+            self.errors_total += 1
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight":       self.in_flight,
+            "peak_in_flight":  self.peak_in_flight,
+            "max_connections": self.max_connections,
+            "saturation":      round(self.in_flight / self.max_connections, 3),
+            "requests_total":  self.requests_total,
+            "errors_total":    self.errors_total,
+            "retries_total":   self.retries_total,
+        }
+
+
+class _MeteredStream(httpx.AsyncByteStream):
+    """Тело ответа: запрос считается завершённым, когда тело дочитано и закрыто."""
+
+    def __init__(self, inner: httpx.AsyncByteStream, stats: PoolStats):
+        self._inner = inner
+        self._stats = stats
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._inner:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._stats.finished()
+        await self._inner.aclose()
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    def __init__(self, inner: httpx.AsyncBaseTransport, stats: PoolStats):
+        self._inner = inner
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._stats.started()
+        try:
+            response = await self._inner.handle_async_request(request)
+        except BaseException:
+            self._stats.finished(error=True)
+            raise
+        response.stream = _MeteredStream(response.stream, self._stats)
+        return response
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+def _new_client(stats: PoolStats, timeout: float) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    transport = httpx.AsyncHTTPTransport(limits=limits, http2=HTTP2_ENABLED)
+    return httpx.AsyncClient(
+        transport=_MeteredTransport(transport, stats),
+        timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+# ── Реестр клиентов уровня приложения ─────────────────────────────────────────
+# Открывается в lifespan; если модуль используется вне приложения (скрипты),
+# клиенты создаются лениво при первом обращении.
+_stats = {
+    "forte":  PoolStats(HTTP_MAX_CONNECTIONS),
+    "openai": PoolStats(HTTP_MAX_CONNECTIONS),
+}
+_forte: httpx.AsyncClient | None = None
+_openai: AsyncOpenAI | None = None
+
+
+def forte_client() -> httpx.AsyncClient:
+    """Общий keep-alive клиент для Forte API."""
+    global _forte
+    if _forte is None:
+        _forte = _new_client(_stats["forte"], FORTE_CREATE_TIMEOUT)
+    return _forte
+
+
+def openai_client() -> AsyncOpenAI:
+    """Общий клиент OpenAI поверх пула соединений с метриками."""
+    global _openai
+    if _openai is None:
+        _openai = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=OPENAI_TIMEOUT,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=_new_client(_stats["openai"], OPENAI_TIMEOUT),
+        )
+    return _openai
+
+
+async def open_clients() -> None:
+    """Создаёт клиенты заранее, чтобы первый запрос не платил за инициализацию."""
+    forte_client()
+    openai_client()
+
+
+async def close_clients() -> None:
+    """Закрывает пулы соединений. Вызывается из lifespan при остановке."""
+    global _forte, _openai
+    forte_http, _forte = _forte, None
+    openai_api, _openai = _openai, None
+    if forte_http is not None:
+        await forte_http.aclose()
+    if openai_api is not None:
+        await openai_api.close()
+
+
+def pool_stats() -> dict:
+    """Метрики загрузки пулов: {имя: {in_flight, saturation, ...}}."""
+    return {name: stats.snapshot() for name, stats in _stats.items()}
+
+
+_pool_in_flight = metrics.Gauge("http_pool_in_flight", "Requests in flight per outbound pool", ("pool",))
+_pool_requests  = metrics.Counter("http_pool_requests_total", "Outbound requests per pool", ("pool",))
+_pool_errors    = metrics.Counter("http_pool_errors_total", "Outbound transport errors per pool", ("pool",))
+_pool_retries   = metrics.Counter("http_pool_retries_total", "Outbound retries per pool", ("pool",))
+for _metric in (_pool_in_flight, _pool_requests, _pool_errors, _pool_retries):
+    metrics.register(_metric)
+
+
+def _collect_pool_metrics() -> None:
+    for name, stats in _stats.items():
+        _pool_in_flight.set(name, value=stats.in_flight)
+        _pool_requests.set(name, value=stats.requests_total)
+        _pool_errors.set(name, value=stats.errors_total)
+        _pool_retries.set(name, value=stats.retries_total)
+
+
+metrics.add_collector(_collect_pool_metrics)
+
+
+async def request_with_retry(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    *,
+    pool: str,
+    retries: int,
+    base_delay: float = 0.2,
+    max_delay: float = 2.0,
+    **kwargs,
+) -> httpx.Response:
+    """
+    Запрос с повторами для идемпотентных вызовов: экспоненциальная задержка
+    с полным джиттером (sleep ∈ [0, min(max_delay, base_delay·2^n)]).
+    Повторяются сетевые ошибки и статусы из RETRY_STATUSES.
+    """
+    for attempt in range(retries + 1):
+        try:
+            resp = await client.request(method, url, **kwargs)
+            if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                return resp
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+
+        _stats[pool].retries_total += 1
+        await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+    raise AssertionError("unreachable")
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from fastapi import HTTPException
+
+import database
+from services import metrics
+
+IDEMPOTENCY_TTL         = float(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))   # сек, сколько помним ответ
+IDEMPOTENCY_LOCK_TTL    = float(os.getenv("IDEMPOTENCY_LOCK_TTL", "120"))       # сек, захват выполняющегося запроса
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))    # ответов в памяти процесса
+IDEMPOTENCY_KEY_MAX_LEN = 255
+
+idempotency_requests = metrics.Counter(
+    "idempotency_requests_total",
+    "Requests with an Idempotency-Key by outcome (executed, replayed, coalesced, conflict)",
+    ("scope", "outcome"),
+)
+metrics.register(idempotency_requests)
+
+
+class IdempotencyError(Exception):
+    """Повтор нельзя ни выполнить, ни воспроизвести; status_code — для HTTP-ответа."""
+    status_code = 409
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class InvalidKey(IdempotencyError):
+    status_code = 400
+
+
+class KeyReused(IdempotencyError):
+    """Тот же ключ с другим телом запроса."""
+    status_code = 422
+
+
+class RequestInProgress(IdempotencyError):
+    """Запрос с этим ключом ещё выполняется в другом воркере."""
+    status_code = 409
+
+
+class CommittedFailure(HTTPException):
+    """
+    Обработчик упал после необратимого шага (ордер в Forte уже создан).
+    Ответ сохраняется, как 4xx: повтор с тем же ключом получит эту ошибку,
+    а не выполнит запрос заново и не создаст второй ордер.
+    """
+
+
+def fingerprint(body: str | bytes) -> str:
+    return hashlib.sha256(body.encode() if isinstance(body, str) else body).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Выполняет запрос с Idempotency-Key не больше одного раза.
+
+      - одновременные дубли в процессе ждут тот же Future (один вызов модели
+        или Forte на всех)
+      - поздние дубли получают сохранённый ответ: из LRU в памяти, а после
+        рестарта или из другого воркера — из таблицы idempotency_keys
+      - дубль, пока оригинал выполняется в другом воркере, — 409 (ждать
+        Future чужого процесса нельзя, повторите позже)
+
+    Сохраняются успешные ответы, 4xx обработчика (кроме 429) и
+    CommittedFailure: повтор получит тот же результат. Остальные 5xx и
+    исключения снимают захват — повтор выполнится заново (например, Forte
+    был недоступен).
+    """
+
+    def __init__(
+        self,
+        ttl: float = IDEMPOTENCY_TTL,
+        lock_ttl: float = IDEMPOTENCY_LOCK_TTL,
+        max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+    ):
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.max_entries = max_entries
+        self._inflight: dict[str, tuple[str, asyncio.Future]] = {}
+        # key → (fingerprint, status, тело ответа, expires_at)
+        self._completed: OrderedDict[str, tuple[str, int, str, float]] = OrderedDict()
+
+    async def run(
+        self,
+        scope: str,
+        key: str,
+        request_fingerprint: str,
+        handler: Callable[[], Awaitable[Any]],
+    ) -> tuple[int, str, bool]:
+        """
+        (HTTP-статус, JSON-тело, replayed). handler вызывается, только если
+        ответа с этим ключом ещё нет; его результат сериализуется в JSON,
+        исключение с status_code < 500 (HTTPException) — в {"detail": ...}.
+        """
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LEN:
+            raise InvalidKey(f"Idempotency-Key must be 1..{IDEMPOTENCY_KEY_MAX_LEN} characters")
+        full_key = f"{scope}:{key}"
+
+        completed = self._lookup(full_key)
+        if completed is not None:
+            return self._replay(scope, completed, request_fingerprint)
+
+        inflight = self._inflight.get(full_key)
+        if inflight is not None:
+            if inflight[0] != request_fingerprint:
+                raise KeyReused("Idempotency-Key was used with a different request body")
+            idempotency_requests.inc(scope, "coalesced")
+            status, body = await asyncio.shield(inflight[1])
+            return status, body, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[full_key] = (request_fingerprint, future)
+        try:
+            status, body, replayed = await self._execute(scope, full_key, request_fingerprint, handler)
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(
+                    RequestInProgress("The original request was interrupted, retry")
+                    if isinstance(e, asyncio.CancelledError) else e
+                )
+                future.exception()   # ждущих может не быть — без «never retrieved»
+            raise
+        else:
+            future.set_result((status, body))
+            return status, body, replayed
+        finally:
+            self._inflight.pop(full_key, None)
+
+    def clear(self) -> None:
+        self._completed.clear()
+
+    # ── Внутреннее ────────────────────────────────────────────────────────────
+    async def _execute(self, scope, full_key, request_fingerprint, handler) -> tuple[int, str, bool]:
+        existing = await database.claim_idempotency_key(full_key, request_fingerprint, self.lock_ttl)
+        if existing is not None:
+            if existing["status"] is None:
+                idempotency_requests.inc(scope, "conflict")
+                raise RequestInProgress("A request with this Idempotency-Key is in progress, retry later")
+            completed = (existing["fingerprint"], existing["status"], existing["response"], existing["expires_at"])
+            self._remember(full_key, completed)
+            return self._replay(scope, completed, request_fingerprint)
+
+        try:
+            status, body = 200, _dumps(await handler())
+        except Exception as e:
+            status = getattr(e, "status_code", 500)
+            if (status >= 500 or status == 429) and not isinstance(e, CommittedFailure):
+                await database.release_idempotency_key(full_key)
+                raise
+            body = _dumps({"detail": getattr(e, "detail", str(e))})
+        except BaseException:
+            await asyncio.shield(database.release_idempotency_key(full_key))
+            raise
+
+        await database.complete_idempotency_key(full_key, status, body, self.ttl)
+        self._remember(full_key, (request_fingerprint, status, body, time.time() + self.ttl))
+        idempotency_requests.inc(scope, "executed")
+        return status, body, False
+
+    def _replay(self, scope: str, completed: tuple, request_fingerprint: str) -> tuple[int, str, bool]:
+        stored_fingerprint, status, body, _ = completed
+        if stored_fingerprint != request_fingerprint:
+            raise KeyReused("Idempotency-Key was used with a different request body")
+        idempotency_requests.inc(scope, "replayed")
+        return status, body, True
+
+    def _lookup(self, full_key: str) -> tuple | None:
+        completed = self._completed.get(full_key)
+        if completed is None:
+            return None
+        if completed[3] <= time.time():
+            del self._completed[full_key]
+            return None
+        self._completed.move_to_end(full_key)
+        return completed
+
+    def _remember(self, full_key: str, completed: tuple) -> None:
+        self._completed[full_key] = completed
+        self._completed.move_to_end(full_key)
+        while len(self._completed) > self.max_entries:
+            self._completed.popitem(last=False)
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+idempotency_store = IdempotencyStore()
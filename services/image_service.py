@@ -0,0 +1,199 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# ── Настройки предобработки ───────────────────────────────────────────────────
+IMAGE_PREPROCESS   = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+IMAGE_MAX_EDGE     = int(os.getenv("IMAGE_MAX_EDGE", "1536"))     # px, длинная сторона
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_DETAIL       = os.getenv("IMAGE_DETAIL", "auto")             # auto | low | high
+IMAGE_WORKERS      = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# В режиме detail=low OpenAI всё равно сжимает картинку до 512×512
+LOW_DETAIL_EDGE = 512
+
+# dHash почти однотонной картинки — шум или одни нули: разные однотонные фото
+# совпали бы. Такие картинки в перцептивный кэш не попадают
+_DHASH_MIN_CONTRAST = 16
+SIGNATURE_SIZE = 16
+
+# Pillow отпускает GIL на декодировании/ресайзе — потоки реально параллельны
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+
+@dataclass
+class PreparedImage:
+    """Картинка, готовая к отправке в модель, и метаданные для ответа."""
+    base64: str
+    detail: str
+    bytes_before: int
+    bytes_after: int
+    width: int
+    height: int
+    dhash: int | None = None        # перцептивный хэш для кэша распознавания
+    signature: bytes | None = None  # средние цвета сетки — проверка совпадения по dHash
+
+    def meta(self) -> dict:
+        return {
+            "bytes_before": self.bytes_before,
+            "bytes_after":  self.bytes_after,
+            "width":        self.width,
+            "height":       self.height,
+            "detail":       self.detail,
+        }
+
+
+def decode_base64_image(image_base64: str) -> bytes:
+    """base64 (с префиксом data:image/...;base64, или без) → байты; ValueError если мусор."""
+    if image_base64.startswith("data:"):
+        image_base64 = image_base64.partition(",")[2]
+    try:
+        return base64.b64decode(image_base64, validate=True)
+    except binascii.Error as e:
+        raise ValueError(f"Invalid base64 image: {e}")
+
+
+def _choose_detail(width: int, height: int) -> str:
+    if IMAGE_DETAIL in ("low", "high"):
+        return IMAGE_DETAIL
+    return "low" if max(width, height) <= LOW_DETAIL_EDGE else "high"
+
+
+def dhash(img: Image.Image, size: int = 8) -> int | None:
+    """
+    Difference hash: 64 бита — ярче ли пиксель соседа справа на картинке 9×8.
+    Устойчив к пересжатию и небольшим сдвигам; похожесть — расстояние Хэмминга.
+    None — картинка почти однотонная, хэш ничего о ней не говорит.
+    """
+    small = img.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    if max(pixels) - min(pixels) < _DHASH_MIN_CONTRAST:
+        return None
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def signature(img: Image.Image, size: int = SIGNATURE_SIZE) -> bytes:
+    """
+    Средний цвет каждой ячейки сетки size×size (RGB, size² × 3 байт).
+    64 бита dHash не видят лишний товар на том же столе; сетка видит —
+    ячейки с ним меняются сильно, а при пересжатии или ретейке — слабо.
+    """
+    return img.resize((size, size), Image.Resampling.BOX).tobytes()
+
+
+def preprocess_image_bytes(data: bytes) -> PreparedImage:
+    """Предобработка картинки, уже лежащей в памяти (base64 из JSON)."""
+    # BytesIO(bytes) не копирует данные, пока в буфер не пишут
+    return preprocess_image_file(io.BytesIO(data))
+
+
+def preprocess_image_file(fp: BinaryIO) -> PreparedImage:
+    """
+    EXIF-поворот → уменьшение до IMAGE_MAX_EDGE → JPEG с IMAGE_JPEG_QUALITY.
+
+    Картинка декодируется прямо из файла (загрузка, сброшенная на диск), целиком
+    исходные байты в память не читаются; в base64 кодируется только итоговый
+    JPEG — через memoryview буфера, без лишней копии.
+    Синхронная, CPU-bound — вызывать через preprocess_image().
+    """
+    bytes_before = fp.seek(0, io.SEEK_END)
+    fp.seek(0)
+    try:
+        img = Image.open(fp)
+        source_format, source_size = img.format, img.size
+        rotated = img.getexif().get(0x0112, 1) != 1   # EXIF Orientation
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8) — в разы быстрее
+        # и в разы меньше памяти. draft берёт масштаб, при котором обе стороны не меньше
+        # запрошенных, поэтому просим итоговый размер с сохранением пропорций.
+        scale = min(1.0, IMAGE_MAX_EDGE / max(source_size))
+        img.draft("RGB", (round(source_size[0] * scale), round(source_size[1] * scale)))
+        if rotated:
+            # без поворота exif_transpose вернул бы полную копию картинки
+            img = ImageOps.exif_transpose(img)
+        # Декодируем здесь: битый или обрезанный файл — ошибка клиента (400),
+        # а не падение позже в convert/thumbnail
+        img.load()
+    except UnidentifiedImageError:
+        raise ValueError("Invalid image: unsupported or corrupt file")
+    except Exception as e:
+        raise ValueError(f"Invalid image: {e}")
+
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        img = background
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY)
+    encoded = out.getbuffer()
+
+    # Небольшой JPEG без поворота и ресайза — перекодирование только раздует его
+    if (
+        source_format == "JPEG" and not rotated
+        and img.size == source_size and len(encoded) >= bytes_before
+    ):
+        encoded.release()
+        fp.seek(0)
+        encoded = memoryview(fp.read())
+
+    with encoded:
+        return PreparedImage(
+            base64=base64.b64encode(encoded).decode("ascii"),
+            detail=_choose_detail(img.width, img.height),
+            bytes_before=bytes_before,
+            bytes_after=encoded.nbytes,
+            width=img.width,
+            height=img.height,
+            dhash=dhash(img),
+            signature=signature(img),
+        )
+
+
+def file_sha256(fp: BinaryIO) -> str:
+    """SHA-256 файла блоками через readinto в переиспользуемый буфер."""
+    fp.seek(0)
+    return hashlib.file_digest(fp, "sha256").hexdigest()
+
+
+async def upload_sha256(fp: BinaryIO) -> str:
+    """file_sha256 в пуле потоков — загрузка может лежать на диске."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, file_sha256, fp)
+
+
+async def preprocess_image(data: bytes | BinaryIO) -> PreparedImage:
+    """Предобработка (байты или файл) в пуле потоков, чтобы не блокировать event loop."""
+    loop = asyncio.get_running_loop()
+    if not IMAGE_PREPROCESS:
+        if not isinstance(data, bytes):
+            data.seek(0)
+            data = await loop.run_in_executor(_executor, data.read)
+        return PreparedImage(
+            base64=base64.b64encode(data).decode("ascii"),
+            detail="high",
+            bytes_before=len(data),
+            bytes_after=len(data),
+            width=0,
+            height=0,
+        )
+    if isinstance(data, bytes):
+        return await loop.run_in_executor(_executor, preprocess_image_bytes, data)
+    return await loop.run_in_executor(_executor, preprocess_image_file, data)
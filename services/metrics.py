@@ -0,0 +1,226 @@
+import functools
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator
+
+# Границы бакетов гистограмм, секунды
+METRICS_BUCKETS = tuple(
+    float(b) for b in os.getenv(
+        "METRICS_BUCKETS", "0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30"
+    ).split(",")
+)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.label_names = name, help, labels
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, *labels: str, value: float) -> None:
+        """Для значений, которые копятся в другом месте (например, PoolStats)."""
+        self._values[labels] = value
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {value:g}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами (кумулятивные, как ждёт Prometheus)."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = METRICS_BUCKETS,
+    ):
+        self.name, self.help, self.label_names = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple[str, ...], list] = {}   # labels → [counts по бакетам, sum, count]
+
+    def observe(self, *labels: str, value: float) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = _labels(self.label_names, labels, 'le="%g"' % bound)
+                yield f"{self.name}_bucket{le} {cumulative}"
+            le = _labels(self.label_names, labels, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {total:.6f}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {count}"
+
+
+# ── Реестр ────────────────────────────────────────────────────────────────────
+stage_seconds = Histogram(
+    "stage_duration_seconds", "Duration of an instrumented stage (recognize, db, forte)", ("stage",)
+)
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request duration by route", ("method", "route", "status")
+)
+openai_tokens = Counter(
+    "openai_tokens_total", "OpenAI token usage from response.usage", ("model", "kind")
+)
+openai_requests = Counter(
+    "openai_requests_total", "OpenAI chat completion calls", ("model",)
+)
+openai_call_tokens = Histogram(
+    "openai_call_tokens", "Tokens per OpenAI call by call type (single, stream, tools, final)", ("call", "kind"),
+    buckets=(64, 128, 256, 512, 1024, 1536, 2048, 3072, 4096, 8192),
+)
+
+_registry: list = [stage_seconds, http_request_seconds, openai_tokens, openai_requests, openai_call_tokens]
+# Функции, обновляющие метрики-снимки (gauges) перед отдачей /metrics
+_collectors: list[Callable[[], None]] = []
+
+
+def register(metric) -> None:
+    _registry.append(metric)
+
+
+def add_collector(collector: Callable[[], None]) -> None:
+    _collectors.append(collector)
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus (text/plain; version=0.0.4)."""
+    for collect in _collectors:
+        collect()
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ── Спаны и Server-Timing ─────────────────────────────────────────────────────
+# Список (stage, seconds) текущего HTTP-запроса; задачи, созданные внутри
+# запроса, наследуют контекст и пишут в тот же список
+_request_timings: ContextVar[list | None] = ContextVar("request_timings", default=None)
+
+
+def start_request() -> list:
+    timings: list = []
+    _request_timings.set(timings)
+    return timings
+
+
+def record(stage: str, seconds: float) -> None:
+    stage_seconds.observe(stage, value=seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def span(stage: str):
+    """Замер этапа: гистограмма stage_duration_seconds + строка в Server-Timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - started)
+
+
+def timed(stage: str):
+    """Декоратор для async-функций: весь вызов — один спан."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing(timings: list, total: float | None = None) -> str:
+    """
+    Значение заголовка Server-Timing: повторы одного этапа суммируются
+    (desc — число вызовов), например `db.rank_search;dur=3.1;desc="x2"`.
+    """
+    merged: dict[str, list] = {}
+    for stage, seconds in timings:
+        entry = merged.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+    parts = [
+        f'{stage};dur={seconds * 1000:.1f}' + (f';desc="x{n}"' if n > 1 else "")
+        for stage, (seconds, n) in merged.items()
+    ]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def usage_tokens(usage) -> dict:
+    """{"prompt", "completion", "cached_prompt"} из response.usage (объект SDK или dict)."""
+    get = usage.get if isinstance(usage, dict) else lambda k, d=None: getattr(usage, k, d)
+    details = get("prompt_tokens_details")
+    cached = 0
+    if details is not None:
+        cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", 0)
+    return {
+        "prompt":        get("prompt_tokens", 0) or 0,
+        "completion":    get("completion_tokens", 0) or 0,
+        "cached_prompt": cached or 0,
+    }
+
+
+def record_usage(model: str, usage, call: str | None = None) -> None:
+    """
+    Счётчики токенов из response.usage (None — пропуск); с call — ещё и
+    распределение токенов на один вызов этого типа.
+    """
+    openai_requests.inc(model)
+    if usage is None:
+        return
+    for kind, tokens in usage_tokens(usage).items():
+        openai_tokens.inc(model, kind, amount=tokens)
+        if call is not None:
+            openai_call_tokens.observe(call, kind, value=tokens)
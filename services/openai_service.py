@@ -1,10 +1,15 @@
+import asyncio
 import json
 import base64
 import os
-from openai import AsyncOpenAI
-from database import search_products
-
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+import time
+from typing import AsyncIterator
+from database import get_catalog_summary, rank_search
+from services.admission import openai_admission
+from services.http_clients import openai_client
+from services.metrics import record_usage, span
+from services.product_matcher import product_matcher
+from services.vector_index import vector_index
 
 # ── Tool definition для function calling ──────────────────────────────────────
 TOOLS = [
@@ -64,39 +69,531 @@ Rules:
 """
 
 
-async def recognize_from_image(image_base64: str) -> dict:
-    """
-    Полный цикл: изображение → OpenAI Vision → function calling → DB поиск → результат.
-    """
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{image_base64}",
-                        "detail": "high",
+# ── Режим распознавания ───────────────────────────────────────────────────────
+# single — один vision-вызов со строгой JSON-схемой; сопоставление с БД, цены
+#          и total считает сервер (модель не может ошибиться в цене)
+# legacy — прежний поток: tool call search_products + второй вызов для JSON
+RECOGNITION_MODE = os.getenv("RECOGNITION_MODE", "single")
+
+# Поиск товаров по запросам модели (после нечёткого поиска в памяти):
+# fts    — FTS5 trigram (rank_search)
+# vector — векторный индекс (services/vector_index.py, нужен numpy)
+# hybrid — FTS, а запросы без результата — векторным индексом
+SEARCH_BACKENDS = ("fts", "vector", "hybrid")
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "fts")
+
+VISION_MODEL = "gpt-5-mini-2025-08-07"
+
+# Бюджет ответа модели: список товаров / итоговый JSON legacy-режима и
+# tool call legacy-режима. Меньший бюджет — меньше списывается из ведра TPM
+# при допуске вызова, но у reasoning-модели в бюджет входят и токены
+# рассуждений: слишком малый обрежет tool call (finish_reason == "length")
+OPENAI_MAX_OUTPUT_TOKENS = int(os.getenv("OPENAI_MAX_OUTPUT_TOKENS", "1000"))
+OPENAI_TOOL_MAX_TOKENS   = int(os.getenv("OPENAI_TOOL_MAX_TOKENS", "1000"))
+
+
+class OutputTruncated(RuntimeError):
+    """Ответ модели обрезан по max_tokens (finish_reason == "length"): JSON неполный."""
+
+
+def _check_finish(finish_reason: str | None, limit: str) -> None:
+    if finish_reason == "length":
+        raise OutputTruncated(f"Model output was cut off by {limit}")
+
+
+# Оценка токенов вызова для ведра TPM (уточняется по usage ответа):
+# detail=low — 85 токенов, high — 85 + 170 на плитку 512×512 (после
+# предобработки обычно 4 плитки)
+_IMAGE_TOKENS = {"low": 85, "high": 765}
+
+SINGLE_CALL_PROMPT = """You are a smart cashier vision system for a retail store in Kazakhstan.
+
+Your task:
+1. Carefully examine the photo — it shows products placed on a table/surface
+2. Identify ALL visible products
+3. Return them in the JSON schema provided
+
+For each product:
+- name: product name as printed on the packaging (brand, type, size)
+- query: short search term for the store database — brand and product type only, e.g. "Coca-Cola", "Lays", "Milka"
+- quantity: number of identical items visible
+- confidence: 0.0-1.0 based on how clearly you see the product
+"""
+
+DETECTED_ITEMS_SCHEMA = {
+    "name": "detected_items",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name":       {"type": "string"},
+                        "query":      {"type": "string"},
+                        "quantity":   {"type": "integer"},
+                        "confidence": {"type": "number"},
                     },
+                    "required": ["name", "query", "quantity", "confidence"],
+                    "additionalProperties": False,
                 },
-                {
-                    "type": "text",
-                    "text": "Please identify all products in this photo and search for them in the database.",
-                },
-            ],
+            },
+        },
+        "required": ["items"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _user_message(image_base64: str, text: str, detail: str = "high") -> dict:
+    content = [
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:image/jpeg;base64,{image_base64}",
+                "detail": detail,
+            },
         },
     ]
+    if text:
+        content.append({"type": "text", "text": text})
+    return {"role": "user", "content": content}
 
-    # ── Шаг 1: GPT-4o анализирует фото ────────────────────────────────────────
-    response = await client.chat.completions.create(
-        model="gpt-5-mini-2025-08-07",
-        messages=messages,
-        tools=TOOLS,
-        tool_choice="required",  # обязываем вызвать tool
-        max_tokens=1000,
+
+def _estimate_tokens(messages: list, max_tokens: int = OPENAI_MAX_OUTPUT_TOKENS) -> int:
+    """Грубая оценка prompt + completion: ~4 символа текста на токен, картинка — по detail."""
+    tokens = max_tokens
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                tokens += _IMAGE_TOKENS.get(part["image_url"].get("detail"), _IMAGE_TOKENS["high"])
+            else:
+                tokens += len(part.get("text", "")) // 4
+    return tokens
+
+
+def _known_items_note(known_items: list[str] | None) -> str:
+    if not known_items:
+        return ""
+    return (
+        " These products were already identified by barcode, do NOT include them: "
+        + "; ".join(known_items)
     )
 
+
+# ── Построение промпта ────────────────────────────────────────────────────────
+# baseline — прежняя раскладка: инструкция, затем картинка и текст задачи
+# prefix   — задача в system, prompt_cache_key; в user только картинка и
+#            список найденного по штрихкоду
+# hint     — prefix + подсказка каталога (частые категории магазина; бренды —
+#            только с PROMPT_PREFIX_TOKENS)
+PROMPT_VARIANTS = ("baseline", "prefix", "hint")
+PROMPT_VARIANT         = os.getenv("PROMPT_VARIANT", "hint")
+PROMPT_HINT_CATEGORIES = int(os.getenv("PROMPT_HINT_CATEGORIES", "30"))
+PROMPT_HINT_BRANDS     = int(os.getenv("PROMPT_HINT_BRANDS", "500"))      # максимум брендов
+PROMPT_HINT_REFRESH    = float(os.getenv("PROMPT_HINT_REFRESH", "3600"))   # сек
+# Добивать неизменный префикс (схема ответа + инструкция + подсказка) брендами
+# до стольких токенов; 0 — не добивать. OpenAI кэширует префикс от 1024
+# токенов, но добивка почти удваивает входные токены вызова (и его списание
+# из ведра TPM), а экономит лишь несколько процентов стоимости. Включать,
+# если кэш реально окупается (например, 1152 — с запасом на шаг кэша 128)
+PROMPT_PREFIX_TOKENS   = int(os.getenv("PROMPT_PREFIX_TOKENS", "0"))
+
+_SINGLE_CALL_TASK = "Please identify all products in this photo."
+_TOOLS_TASK = "Please identify all products in this photo and search for them in the database."
+_HINT_MIN_BRANDS = 20
+
+
+def _text_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def _format_hint(summary: dict, budget: int) -> str:
+    """
+    Подсказка каталога: категории, а при budget > 0 и самые частые бренды —
+    столько, чтобы подсказка заняла ~budget токенов (но не меньше
+    _HINT_MIN_BRANDS брендов).
+    """
+    header = "Products sold in this store. When a product matches, use these spellings in queries."
+    lines = [header]
+    if summary["categories"]:
+        lines.append("Categories: " + ", ".join(summary["categories"]))
+    brands = []
+    used = _text_tokens("\n".join(lines)) + _text_tokens("\nBrands: ")
+    for brand in summary["brands"] if budget > 0 else ():
+        if len(brands) >= _HINT_MIN_BRANDS and used >= budget:
+            break
+        brands.append(brand)
+        used += _text_tokens(brand + ", ") or 1
+    if brands:
+        lines.append("Brands: " + ", ".join(brands))
+    return "\n".join(lines) if len(lines) > 1 else ""
+
+
+class PromptBuilder:
+    """
+    Сообщения вызова модели — от неизменного к изменчивому.
+
+    OpenAI кэширует общий префикс запросов от 1024 токенов: такие токены
+    дешевле и быстрее. Поэтому в начале то, что одинаково во всех вызовах, —
+    инструкция вместе с задачей и подсказка каталога, а в конце картинка и
+    список уже найденного по штрихкоду. По умолчанию подсказка — только
+    частые категории; с PROMPT_PREFIX_TOKENS она добирает префикс брендами
+    до порога кэша (короткий префикс не кэшируется вовсе). Каталог
+    перечитывается не чаще PROMPT_HINT_REFRESH: префикс не меняется от
+    каждой правки цены.
+    """
+
+    def __init__(self, variant: str = PROMPT_VARIANT, hint_refresh: float = PROMPT_HINT_REFRESH):
+        if variant not in PROMPT_VARIANTS:
+            raise ValueError(f"PROMPT_VARIANT must be one of {', '.join(PROMPT_VARIANTS)}")
+        self.variant = variant
+        self.hint_refresh = hint_refresh
+        self._summary: dict | None = None
+        self._hints: dict[str, str] = {}     # вызов (single | tools) → подсказка
+        self._hint_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    async def single_call(self, image_base64: str, known_items: list[str] | None, detail: str) -> list[dict]:
+        system = f"{SINGLE_CALL_PROMPT}\n{_SINGLE_CALL_TASK}"
+        hint = await self.catalog_hint("single", system, DETECTED_ITEMS_SCHEMA)
+        return self._messages(SINGLE_CALL_PROMPT, _SINGLE_CALL_TASK, hint, image_base64, known_items, detail)
+
+    async def tool_call(self, image_base64: str, known_items: list[str] | None, detail: str) -> list[dict]:
+        system = f"{SYSTEM_PROMPT}\n{_TOOLS_TASK}"
+        hint = await self.catalog_hint("tools", system, TOOLS)
+        return self._messages(SYSTEM_PROMPT, _TOOLS_TASK, hint, image_base64, known_items, detail)
+
+    def cache_params(self, call: str) -> dict:
+        """Доп. параметры create: одинаковый prompt_cache_key — запросы идут на один кэш префикса."""
+        if self.variant == "baseline":
+            return {}
+        return {"prompt_cache_key": f"recognize.{call}"}
+
+    async def catalog_hint(self, call: str, system: str, schema) -> str:
+        """Подсказка для вызова call; system и schema — остальная неизменная часть префикса."""
+        if self.variant != "hint":
+            return ""
+        if self._hint_at is None or time.monotonic() - self._hint_at >= self.hint_refresh:
+            async with self._lock:
+                if self._hint_at is None or time.monotonic() - self._hint_at >= self.hint_refresh:
+                    brands = PROMPT_HINT_BRANDS if PROMPT_PREFIX_TOKENS > 0 else 0
+                    self._summary = await get_catalog_summary(PROMPT_HINT_CATEGORIES, brands)
+                    self._hints.clear()
+                    self._hint_at = time.monotonic()
+        hint = self._hints.get(call)
+        if hint is None:
+            static = _text_tokens(system) + _text_tokens(json.dumps(schema))
+            budget = PROMPT_PREFIX_TOKENS - static if PROMPT_PREFIX_TOKENS > 0 else 0
+            hint = self._hints[call] = _format_hint(self._summary, budget)
+        return hint
+
+    def clear(self) -> None:
+        self._summary = None
+        self._hints.clear()
+        self._hint_at = None
+
+    def _messages(
+        self,
+        system: str,
+        task: str,
+        hint: str,
+        image_base64: str,
+        known_items: list[str] | None,
+        detail: str,
+    ) -> list[dict]:
+        note = _known_items_note(known_items)
+        if self.variant == "baseline":
+            return [{"role": "system", "content": system}, _user_message(image_base64, task + note, detail)]
+
+        messages = [{"role": "system", "content": f"{system}\n{task}"}]
+        if hint:
+            messages.append({"role": "system", "content": hint})
+        messages.append(_user_message(image_base64, note.strip(), detail))
+        return messages
+
+
+prompt_builder = PromptBuilder()
+
+
+async def recognize_from_image(
+    image_base64: str,
+    known_items: list[str] | None = None,
+    detail: str = "high",
+) -> dict:
+    """
+    Полный цикл: изображение → OpenAI Vision → DB поиск → результат.
+
+    known_items — названия товаров, уже опознанных по штрихкоду: модель просим
+    их пропустить, чтобы не искать и не считать их повторно.
+    detail — уровень детализации картинки для модели (low | high).
+    """
+    if RECOGNITION_MODE == "legacy":
+        return await _recognize_with_tools(image_base64, known_items, detail)
+    return await _recognize_single_call(image_base64, known_items, detail)
+
+
+async def detect_items(
+    image_base64: str,
+    known_items: list[str] | None = None,
+    detail: str = "high",
+) -> list[dict]:
+    """Только вызов модели: [{"name", "query", "quantity", "confidence"}] без сопоставления с БД."""
+    messages = await prompt_builder.single_call(image_base64, known_items, detail)
+    async with openai_admission.slot(_estimate_tokens(messages)) as permit:
+        with span("recognize.model"):
+            response = await openai_client().chat.completions.create(
+                model=VISION_MODEL,
+                messages=messages,
+                max_tokens=OPENAI_MAX_OUTPUT_TOKENS,
+                response_format={"type": "json_schema", "json_schema": DETECTED_ITEMS_SCHEMA},
+                **prompt_builder.cache_params("single"),
+            )
+        permit.record_usage(response.usage)
+    record_usage(VISION_MODEL, response.usage, call="single")
+    _check_finish(response.choices[0].finish_reason, "OPENAI_MAX_OUTPUT_TOKENS")
+
+    raw = response.choices[0].message.content
+    return json.loads(raw).get("items", [])
+
+
+async def _recognize_single_call(image_base64: str, known_items: list[str] | None, detail: str) -> dict:
+    """Один вызов модели: структурированный список товаров → сборка ответа на сервере."""
+    return await assemble_result(await detect_items(image_base64, known_items, detail))
+
+
+class ItemAssembler:
+    """
+    Накопитель результата: сопоставленные товары складываются по product_id,
+    несопоставленные названия — в unrecognized; total считается из цен БД.
+    """
+
+    def __init__(self):
+        self.items: dict[int, dict] = {}
+        self.unrecognized: list[str] = []
+
+    def add(self, detected: dict, product: dict | None) -> dict | None:
+        """Добавляет позицию; возвращает итоговую (накопленную) позицию товара или None."""
+        quantity = max(1, int(detected.get("quantity") or 1))
+        confidence = min(1.0, max(0.0, float(detected.get("confidence") or 0.0)))
+
+        if product is None:
+            self.unrecognized.append(detected.get("name") or detected.get("query") or "")
+            return None
+        item = self.items.get(product["id"])
+        if item is not None:
+            item["quantity"] += quantity
+            item["confidence"] = max(item["confidence"], confidence)
+            return item
+        item = self.items[product["id"]] = {
+            "product_id": product["id"],
+            "name":       product["name"],
+            "price":      product["price"],
+            "quantity":   quantity,
+            "confidence": confidence,
+        }
+        return item
+
+    def result(self) -> dict:
+        total = sum(i["price"] * i["quantity"] for i in self.items.values())
+        return {
+            "recognized_items": list(self.items.values()),
+            "unrecognized":     list(self.unrecognized),
+            "total":            round(total, 2),
+        }
+
+
+def _detected_queries(detected: list[dict]) -> list[str]:
+    """Для каждой позиции — сначала query, затем name (вторая половина списка)."""
+    queries = [d.get("query") or d.get("name") or "" for d in detected]
+    return queries + [d.get("name") or "" for d in detected]
+
+
+async def search_catalog(queries: list[str], limit_per_query: int = 2) -> list[dict]:
+    """
+    Товары по запросам в формате rank_search (с query_index и score) —
+    через бэкенд SEARCH_BACKEND. Без numpy vector/hybrid сводятся к FTS.
+    """
+    if SEARCH_BACKEND == "fts" or not vector_index.available:
+        return await rank_search(queries, limit_per_query)
+    if SEARCH_BACKEND == "vector":
+        return await vector_index.search_products(queries, limit_per_query)
+
+    rows = await rank_search(queries, limit_per_query)
+    found = {row["query_index"] for row in rows}
+    missing = [i for i in range(len(queries)) if i not in found and queries[i].strip()]
+    if missing:
+        for row in await vector_index.search_products([queries[i] for i in missing], limit_per_query):
+            rows.append({**row, "query_index": missing[row["query_index"]]})
+    return rows
+
+
+async def match_detected(detected: list[dict]) -> list[dict | None]:
+    """
+    Товар для каждой позиции (или None). Сначала нечёткий поиск в памяти
+    (транслитерация, опечатки, лишние слова вроде «Lays sour cream chips»),
+    для оставшихся позиций — один search_catalog (FTS и/или векторный индекс).
+    """
+    n = len(detected)
+    queries = _detected_queries(detected)
+    fuzzy = await product_matcher.match(queries, limit=1)
+    matched: list[dict | None] = []
+    for by_query, by_name in zip(fuzzy[:n], fuzzy[n:]):
+        candidates = by_query or by_name
+        matched.append(candidates[0][1] if candidates else None)
+
+    missing = [i for i in range(n) if matched[i] is None]
+    if missing:
+        rest = [queries[i] for i in missing] + [queries[n + i] for i in missing]
+        best: dict[int, dict] = {}
+        for row in await search_catalog(rest, limit_per_query=1):
+            best.setdefault(row["query_index"], row)
+        for j, i in enumerate(missing):
+            matched[i] = best.get(j) or best.get(len(missing) + j)
+    return matched
+
+
+async def assemble_result(detected: list[dict]) -> dict:
+    """
+    Сопоставляет обнаруженные моделью товары с БД и считает итог.
+
+    detected: [{"name", "query", "quantity", "confidence"}]. Для каждого товара
+    ищем сначала по query, затем по name (см. match_detected). Несколько
+    позиций, попавших в один товар, складываются по quantity.
+    """
+    with span("recognize.match"):
+        assembler = ItemAssembler()
+        for d, product in zip(detected, await match_detected(detected)):
+            assembler.add(d, product)
+        return assembler.result()
+
+
+# ── Потоковое распознавание ───────────────────────────────────────────────────
+class _ItemsStreamParser:
+    """
+    Инкрементальный разбор ответа {"items": [{...}, {...}]}, приходящего кусками:
+    каждый объект массива items возвращается, как только закрыта его скобка.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._current: list[str] = []
+
+    def feed(self, text: str) -> list[dict]:
+        done = []
+        for ch in text:
+            if self._depth >= 3:
+                self._current.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                if self._depth == 3:
+                    self._current = [ch]
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 2 and self._current:
+                    try:
+                        done.append(json.loads("".join(self._current)))
+                    except ValueError:
+                        pass
+                    self._current = []
+        return done
+
+
+async def stream_recognition(
+    image_base64: str,
+    known_items: list[str] | None = None,
+    detail: str = "high",
+) -> AsyncIterator[dict]:
+    """
+    Потоковый вариант single-call распознавания.
+
+    События:
+      {"type": "item", "item": {...}}            — товар сопоставлен (quantity накопленная,
+                                                   клиент заменяет позицию по product_id)
+      {"type": "unrecognized", "name": "..."}    — позиция не найдена в БД
+      {"type": "result", "result": {...}}         — итог, как у recognize_from_image
+    """
+    parser = _ItemsStreamParser()
+    assembler = ItemAssembler()
+    usage = None
+    finish_reason = None
+    messages = await prompt_builder.single_call(image_base64, known_items, detail)
+    with span("recognize.stream"):
+        async with openai_admission.slot(_estimate_tokens(messages)) as permit:
+            with span("recognize.model_ttfb"):
+                stream = await openai_client().chat.completions.create(
+                    model=VISION_MODEL,
+                    messages=messages,
+                    max_tokens=OPENAI_MAX_OUTPUT_TOKENS,
+                    response_format={"type": "json_schema", "json_schema": DETECTED_ITEMS_SCHEMA},
+                    # тот же префикс, что у single — и тот же кэш
+                    **prompt_builder.cache_params("single"),
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            async for chunk in stream:
+                # usage приходит отдельным последним чанком без choices
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                text = chunk.choices[0].delta.content
+                if not text:
+                    continue
+                for detected in parser.feed(text):
+                    (product,) = await match_detected([detected])
+                    item = assembler.add(detected, product)
+                    if item is None:
+                        yield {"type": "unrecognized", "name": assembler.unrecognized[-1]}
+                    else:
+                        yield {"type": "item", "item": dict(item)}
+            permit.record_usage(usage)
+    record_usage(VISION_MODEL, usage, call="stream")
+    # Уже отправленные позиции верны, но список неполный — итога не будет
+    _check_finish(finish_reason, "OPENAI_MAX_OUTPUT_TOKENS")
+
+    yield {"type": "result", "result": assembler.result()}
+
+
+async def _recognize_with_tools(image_base64: str, known_items: list[str] | None, detail: str) -> dict:
+    """Прежний поток: tool call search_products и второй вызов модели для итогового JSON."""
+    messages = await prompt_builder.tool_call(image_base64, known_items, detail)
+
+    # ── Шаг 1: GPT-4o анализирует фото ────────────────────────────────────────
+    async with openai_admission.slot(_estimate_tokens(messages, OPENAI_TOOL_MAX_TOKENS)) as permit:
+        with span("recognize.model_tools"):
+            response = await openai_client().chat.completions.create(
+                model=VISION_MODEL,
+                messages=messages,
+                tools=TOOLS,
+                tool_choice="required",  # обязываем вызвать tool
+                max_tokens=OPENAI_TOOL_MAX_TOKENS,
+                **prompt_builder.cache_params("tools"),
+            )
+        permit.record_usage(response.usage)
+    record_usage(VISION_MODEL, response.usage, call="tools")
+    # Рассуждения могли съесть бюджет: tool call пустой или с обрезанным JSON
+    _check_finish(response.choices[0].finish_reason, "OPENAI_TOOL_MAX_TOKENS")
     msg = response.choices[0].message
 
     # ── Шаг 2: Выполняем поиск в БД ───────────────────────────────────────────
@@ -105,7 +602,22 @@ async def recognize_from_image(image_base64: str) -> dict:
         for tool_call in msg.tool_calls:
             args = json.loads(tool_call.function.arguments)
             queries = args.get("queries", [])
-            db_results = await search_products(queries)
+            with span("recognize.search"):
+                # Все запросы tool call'а — одним поиском, топ-2 на запрос без дублей
+                db_results = []
+                seen_ids: set[int] = set()
+                for row in await search_catalog(queries, limit_per_query=2):
+                    if row["id"] not in seen_ids:
+                        seen_ids.add(row["id"])
+                        row.pop("query_index")
+                        row.pop("score")
+                        db_results.append(row)
+                # Нечёткие совпадения, которых поиск не нашёл (транслит, опечатки)
+                for candidates in await product_matcher.match(queries, limit=2):
+                    for _, product in candidates:
+                        if product["id"] not in seen_ids:
+                            seen_ids.add(product["id"])
+                            db_results.append(product)
 
         # Добавляем ответ модели и результат tool в messages
         messages.append(msg)
@@ -116,12 +628,17 @@ async def recognize_from_image(image_base64: str) -> dict:
         })
 
     # ── Шаг 3: GPT-4o формирует финальный ответ ───────────────────────────────
-    final_response = await client.chat.completions.create(
-        model="gpt-4o",
-        messages=messages,
-        max_tokens=1000,
-        response_format={"type": "json_object"},
-    )
+    async with openai_admission.slot(_estimate_tokens(messages)) as permit:
+        with span("recognize.model_final"):
+            final_response = await openai_client().chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=OPENAI_MAX_OUTPUT_TOKENS,
+                response_format={"type": "json_object"},
+                **prompt_builder.cache_params("final"),
+            )
+        permit.record_usage(final_response.usage)
+    record_usage("gpt-4o", final_response.usage, call="final")
 
     raw = final_response.choices[0].message.content
     return json.loads(raw)
\ No newline at end of file
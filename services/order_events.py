@@ -0,0 +1,55 @@
+import asyncio
+import os
+
+ORDER_EVENTS_MAX_SUBSCRIBERS = int(os.getenv("ORDER_EVENTS_MAX_SUBSCRIBERS", "1000"))
+ORDER_EVENTS_HEARTBEAT       = float(os.getenv("ORDER_EVENTS_HEARTBEAT", "15"))    # сек
+ORDER_EVENTS_MAX_AGE         = float(os.getenv("ORDER_EVENTS_MAX_AGE", "900"))     # сек, потом клиент переподключается
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class OrderEvents:
+    """
+    Pub/sub в памяти процесса: изменения статуса заказа → подписчики SSE/WebSocket.
+
+    У каждого подписчика своя очередь; publish не блокируется (при переполнении
+    очереди событие заменяет самое старое — важен только последний статус).
+    Общее число подписчиков ограничено ORDER_EVENTS_MAX_SUBSCRIBERS.
+    """
+
+    def __init__(self, max_subscribers: int = ORDER_EVENTS_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscribers: dict[str, set[asyncio.Queue]] = {}
+        self._count = 0
+
+    @property
+    def subscriber_count(self) -> int:
+        return self._count
+
+    def subscribe(self, our_order_id: str) -> asyncio.Queue:
+        if self._count >= self.max_subscribers:
+            raise TooManySubscribers()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=8)
+        self._subscribers.setdefault(our_order_id, set()).add(queue)
+        self._count += 1
+        return queue
+
+    def unsubscribe(self, our_order_id: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(our_order_id)
+        if queues is None or queue not in queues:
+            return
+        queues.discard(queue)
+        self._count -= 1
+        if not queues:
+            del self._subscribers[our_order_id]
+
+    def publish(self, our_order_id: str, event: dict) -> None:
+        for queue in self._subscribers.get(our_order_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+order_events = OrderEvents()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+import database
+from services.forte_service import get_order_status
+from services.order_store import order_store
+
+RECONCILER_TICK         = float(os.getenv("RECONCILER_TICK", "1"))           # сек, проверка очереди
+RECONCILER_MIN_INTERVAL = float(os.getenv("RECONCILER_MIN_INTERVAL", "2"))   # сек, первый опрос заказа
+RECONCILER_MAX_INTERVAL = float(os.getenv("RECONCILER_MAX_INTERVAL", "30"))  # сек, потолок backoff
+RECONCILER_CONCURRENCY  = int(os.getenv("RECONCILER_CONCURRENCY", "10"))     # одновременных запросов в Forte
+RECONCILER_BATCH        = int(os.getenv("RECONCILER_BATCH", "1000"))
+RECONCILER_LEASE_TTL    = float(os.getenv("RECONCILER_LEASE_TTL", "15"))
+
+FORTE_PAID_STATUSES   = ("FullyPaid",)
+FORTE_FAILED_STATUSES = ("Declined", "Expired", "Cancelled", "Refused")
+
+logger = logging.getLogger(__name__)
+
+
+def map_forte_status(forte_status: str) -> str:
+    """Статус Forte → наш: paid | failed | pending."""
+    if forte_status in FORTE_PAID_STATUSES:
+        return "paid"
+    if forte_status in FORTE_FAILED_STATUSES:
+        return "failed"
+    return "pending"
+
+
+class OrderReconciler:
+    """
+    Фоновая сверка pending-заказов с Forte.
+
+    Раз в RECONCILER_TICK берёт из БД pending-заказы, у которых подошёл срок,
+    и опрашивает Forte не более чем RECONCILER_CONCURRENCY запросами сразу.
+    Интервал опроса заказа адаптивный: от RECONCILER_MIN_INTERVAL, удваивается
+    после каждого ответа без изменений, до RECONCILER_MAX_INTERVAL.
+
+    При нескольких воркерах сверку ведёт один — тот, кто держит лизу в БД.
+    Запросы статуса одного заказа схлопываются (singleflight): конкурентные
+    вызовы ждут один и тот же запрос в Forte.
+    """
+
+    def __init__(self):
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._schedule: dict[str, tuple[float, float]] = {}   # id → (next_due, interval)
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(RECONCILER_CONCURRENCY)
+        self._task: asyncio.Task | None = None
+        self._lease_until = 0.0
+
+    # ── Singleflight ──────────────────────────────────────────────────────────
+    async def fetch_forte_status(self, order: dict) -> str:
+        """Сырой статус Forte; конкурентные вызовы по одному заказу делят один запрос."""
+        our_order_id = order["our_order_id"]
+        task = self._inflight.get(our_order_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(order))
+            self._inflight[our_order_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(our_order_id, None))
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _fetch(self, order: dict) -> str:
+        async with self._semaphore:
+            return await get_order_status(order["forte_order_id"], order["forte_password"])
+
+    async def reconcile(self, order: dict) -> str:
+        """Сверяет заказ с Forte и сохраняет статус. Возвращает наш статус."""
+        status = map_forte_status(await self.fetch_forte_status(order))
+        if status != "pending":
+            await order_store.set_status(order["our_order_id"], status)
+        return status
+
+    # ── Фоновый цикл ──────────────────────────────────────────────────────────
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        if self._lease_until:
+            await database.release_lease("order_reconciler", self.owner)
+            self._lease_until = 0.0
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                if await self._hold_lease():
+                    await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Order reconciliation failed")
+            await asyncio.sleep(RECONCILER_TICK)
+
+    async def _hold_lease(self) -> bool:
+        now = time.time()
+        # Продлеваем заранее, на середине срока, чтобы не потерять лизу
+        if self._lease_until - now > RECONCILER_LEASE_TTL / 2:
+            return True
+        if await database.acquire_lease("order_reconciler", self.owner, RECONCILER_LEASE_TTL):
+            self._lease_until = now + RECONCILER_LEASE_TTL
+            return True
+        self._lease_until = 0.0
+        self._schedule.clear()
+        return False
+
+    async def run_once(self) -> int:
+        """Один проход: опрашивает заказы, у которых подошёл срок. Возвращает их число."""
+        pending = await order_store.pending(RECONCILER_BATCH)
+        now = time.monotonic()
+
+        pending_ids = {o["our_order_id"] for o in pending}
+        for our_order_id in list(self._schedule):
+            if our_order_id not in pending_ids:
+                del self._schedule[our_order_id]
+
+        due = []
+        for order in pending:
+            next_due, _ = self._schedule.setdefault(
+                order["our_order_id"], (now + RECONCILER_MIN_INTERVAL, RECONCILER_MIN_INTERVAL)
+            )
+            if next_due <= now:
+                due.append(order)
+
+        if due:
+            await asyncio.gather(*(self._reconcile_scheduled(o) for o in due))
+        return len(due)
+
+    async def _reconcile_scheduled(self, order: dict) -> None:
+        our_order_id = order["our_order_id"]
+        _, interval = self._schedule.get(our_order_id, (0.0, RECONCILER_MIN_INTERVAL))
+        try:
+            status = await self.reconcile(order)
+        except Exception as e:
+            logger.warning("Forte status check failed for %s: %s", our_order_id, e)
+            status = "pending"
+
+        if status != "pending":
+            self._schedule.pop(our_order_id, None)
+            return
+        interval = min(RECONCILER_MAX_INTERVAL, interval * 2)
+        self._schedule[our_order_id] = (time.monotonic() + interval, interval)
+
+
+order_reconciler = OrderReconciler()
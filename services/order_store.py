@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+import database
+from services.order_events import order_events
+
+ORDER_HOT_MAX          = int(os.getenv("ORDER_HOT_MAX", "10000"))            # pending-заказов в памяти
+ORDER_ARCHIVE_AFTER    = float(os.getenv("ORDER_ARCHIVE_AFTER", str(7 * 24 * 3600)))   # сек
+ORDER_ARCHIVE_INTERVAL = float(os.getenv("ORDER_ARCHIVE_INTERVAL", "600"))  # сек
+
+logger = logging.getLogger(__name__)
+
+
+class OrderStore:
+    """
+    Репозиторий заказов поверх SQLite с write-through горячим набором.
+
+    В памяти держатся только pending-заказы (их опрашивают чаще всего):
+    позиции, суммы и id в Forte не меняются, поэтому при поллинге из БД
+    читается только статус — lookup по первичному ключу, без JOIN позиций.
+    Статус всегда берётся из БД, так что callback, обработанный другим
+    воркером, виден сразу. Завершённые заказы из горячего набора уходят.
+    """
+
+    def __init__(self, max_hot: int = ORDER_HOT_MAX):
+        self.max_hot = max_hot
+        self._hot: OrderedDict[str, dict] = OrderedDict()
+        self._archiver: asyncio.Task | None = None
+
+    # ── Репозиторий ───────────────────────────────────────────────────────────
+    async def create(self, order: dict) -> dict:
+        """Сохраняет заказ ({our_order_id, forte_order_id, forte_password, status, items, total})."""
+        order = {**order, "status": order.get("status", "pending")}
+        await database.create_order_record(order, order["items"])
+        if order["status"] == "pending":
+            self._remember(order)
+        return order
+
+    async def get(self, our_order_id: str) -> dict | None:
+        order = self._hot.get(our_order_id)
+        if order is None:
+            order = await database.get_order(our_order_id)
+            if order is not None and order["status"] == "pending":
+                self._remember(order)
+            return order
+
+        status = await database.get_order_status_value(our_order_id)
+        if status is None:
+            self._hot.pop(our_order_id, None)
+            return None
+        if status != order["status"]:
+            order = {**order, "status": status}
+            self._apply(order)
+        return order
+
+    async def set_status(self, our_order_id: str, status: str) -> bool:
+        """Записывает статус в БД, затем в горячий набор. True, если статус изменился."""
+        changed = await database.update_order_status(our_order_id, status)
+        if changed:
+            order = self._hot.get(our_order_id)
+            if order is not None:
+                self._apply({**order, "status": status})
+            # Подписчики SSE/WebSocket этого процесса узнают о смене сразу
+            order_events.publish(our_order_id, {"our_order_id": our_order_id, "status": status})
+        return changed
+
+    async def pending(self, limit: int = 1000) -> list[dict]:
+        """pending-заказы из БД (без позиций) — в том числе созданные другими воркерами."""
+        return await database.list_orders_by_status("pending", limit)
+
+    # ── Архивация ─────────────────────────────────────────────────────────────
+    def start_archiver(self) -> None:
+        if self._archiver is None:
+            self._archiver = asyncio.create_task(self._archive_loop())
+
+    async def stop_archiver(self) -> None:
+        task, self._archiver = self._archiver, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _archive_loop(self) -> None:
+        while True:
+            try:
+                archived = await database.archive_orders(ORDER_ARCHIVE_AFTER)
+                if archived:
+                    logger.info("Archived %d completed orders", archived)
+                purged = await database.purge_idempotency_keys()
+                if purged:
+                    logger.info("Purged %d expired idempotency keys", purged)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Order archival failed")
+            await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+
+    def clear(self) -> None:
+        self._hot.clear()
+
+    # ── Горячий набор ─────────────────────────────────────────────────────────
+    def _remember(self, order: dict) -> None:
+        self._hot[order["our_order_id"]] = order
+        self._hot.move_to_end(order["our_order_id"])
+        while len(self._hot) > self.max_hot:
+            self._hot.popitem(last=False)
+
+    def _apply(self, order: dict) -> None:
+        if order["status"] == "pending":
+            self._remember(order)
+        else:
+            self._hot.pop(order["our_order_id"], None)
+
+
+order_store = OrderStore()
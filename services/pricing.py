@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+
+from services.catalog_cache import catalog_cache
+from services.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Ключ подписи котировок. Без него ключ случайный на процесс: котировка,
+# выданная одним воркером, в другом не проверится и корзина будет
+# пересчитана заново — корректно, но без экономии
+PRICING_QUOTE_SECRET = os.getenv("PRICING_QUOTE_SECRET", "")
+PRICING_QUOTE_TTL    = int(os.getenv("PRICING_QUOTE_TTL", "300"))   # сек
+
+if not PRICING_QUOTE_SECRET:
+    logger.info("PRICING_QUOTE_SECRET is not set, quotes are valid only in this process")
+_secret = PRICING_QUOTE_SECRET.encode() or secrets.token_bytes(32)
+
+
+def to_tiyn(amount: float) -> int:
+    """Тенге → тиыны с округлением: int(0.29 * 100) == 28, round(...) == 29."""
+    return int(round(amount * 100))
+
+
+def _cart_quantities(items) -> dict[int, int]:
+    """product_id → количество; повторы одного товара складываются, порядок — первого появления."""
+    quantities: dict[int, int] = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+    return quantities
+
+
+def _quote(lines: list[dict], unavailable: list[int]) -> dict:
+    total_tiyn = sum(line["line_total_tiyn"] for line in lines)
+    quote = {
+        "lines":       lines,
+        "total_tiyn":  total_tiyn,
+        "total":       total_tiyn / 100,
+        "unavailable": unavailable,
+        "token":       None,
+        "expires_at":  None,
+    }
+    if not unavailable:
+        quote["expires_at"] = int(time.time()) + PRICING_QUOTE_TTL
+        quote["token"] = _sign(lines, total_tiyn, quote["expires_at"])
+    return quote
+
+
+@timed("checkout.price")
+async def price_cart(items) -> dict:
+    """
+    Серверная цена корзины. items — объекты с product_id и quantity (CartItem).
+
+    Цены берутся из каталога (LRU catalog_cache, недостающие — одним
+    WHERE id IN), а не из запроса клиента. Суммы — целые тиыны.
+    Возвращает {"lines", "total_tiyn", "total", "unavailable", "token", "expires_at"};
+    token — подписанная котировка, её принимает /checkout/create без
+    повторного чтения цен. Котировка выдаётся, только если всё в наличии.
+    """
+    quantities = _cart_quantities(items)
+    products = await catalog_cache.get_many(list(quantities))
+
+    lines = []
+    unavailable = []
+    for product_id, quantity in quantities.items():
+        product = products.get(product_id)
+        if product is None or not product["in_stock"]:
+            unavailable.append(product_id)
+            continue
+        unit_tiyn = to_tiyn(product["price"])
+        lines.append({
+            "product_id":      product_id,
+            "name":            product["name"],
+            "quantity":        quantity,
+            "unit_price_tiyn": unit_tiyn,
+            "line_total_tiyn": unit_tiyn * quantity,
+        })
+    return _quote(lines, unavailable)
+
+
+# ── Подписанная котировка ─────────────────────────────────────────────────────
+# Токен: base64url(JSON) + "." + base64url(HMAC-SHA256). Внутри всё, что нужно
+# для заказа, — повторно читать каталог при оплате не приходится.
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(lines: list[dict], total_tiyn: int, expires_at: int) -> str:
+    payload = {
+        "l": [[l["product_id"], l["quantity"], l["unit_price_tiyn"], l["name"]] for l in lines],
+        "t": total_tiyn,
+        "e": expires_at,
+    }
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+    signature = hmac.new(_secret, body, hashlib.sha256).digest()
+    return f"{_b64(body)}.{_b64(signature)}"
+
+
+def verify_quote(token: str, items) -> dict | None:
+    """
+    Котировка из токена, если подпись верна, срок не истёк и состав корзины
+    (product_id → количество) совпадает; иначе None — корзину надо пересчитать.
+    """
+    try:
+        body_b64, signature_b64 = token.split(".", 1)
+        body = _unb64(body_b64)
+        signature = _unb64(signature_b64)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(hmac.new(_secret, body, hashlib.sha256).digest(), signature):
+        return None
+
+    payload = json.loads(body)
+    if payload["e"] < time.time():
+        return None
+
+    lines = [
+        {
+            "product_id":      product_id,
+            "name":            name,
+            "quantity":        quantity,
+            "unit_price_tiyn": unit_tiyn,
+            "line_total_tiyn": unit_tiyn * quantity,
+        }
+        for product_id, quantity, unit_tiyn, name in payload["l"]
+    ]
+    if {l["product_id"]: l["quantity"] for l in lines} != _cart_quantities(items):
+        return None
+    return {
+        "lines":       lines,
+        "total_tiyn":  payload["t"],
+        "total":       payload["t"] / 100,
+        "unavailable": [],
+        "token":       token,
+        "expires_at":  payload["e"],
+    }
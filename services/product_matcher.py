@@ -0,0 +1,254 @@
+import asyncio
+import math
+import os
+import re
+import time
+import unicodedata
+
+import database
+
+# Минимальная оценка, при которой кандидат считается совпадением (0..1)
+MATCHER_MIN_SCORE     = float(os.getenv("MATCHER_MIN_SCORE", "0.35"))
+# Как часто подтягивать изменения каталога из других воркеров (0 — только свои записи)
+MATCHER_SYNC_INTERVAL = float(os.getenv("MATCHER_SYNC_INTERVAL", "30"))   # сек
+
+# Вес поля в оценке: описание — только подсказка, если в названии не нашлось
+FIELD_WEIGHTS = {"name": 1.0, "name_kz": 1.0, "description": 0.6}
+# Доля покрытия запроса в оценке (остальное — похожесть названия)
+_COVERAGE_SHARE = 0.75
+# Вес триграммы, которой нет в каталоге, относительно самой редкой
+_UNKNOWN_WEIGHT = 0.3
+# Триграмма с таким числом товаров (или 5% каталога) считается частой
+_COMMON_POSTINGS = 64
+
+# ── Нормализация ──────────────────────────────────────────────────────────────
+# Русский и казахский алфавит → латиница (упрощённая транслитерация: важно,
+# чтобы «Кока-Кола» и «Coca-Cola» давали одинаковые триграммы, а не обратимость)
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "", "ы": "i", "ь": "", "э": "e", "ю": "iu",
+    "я": "ia",
+    "ә": "a", "ғ": "g", "қ": "k", "ң": "n", "ө": "o", "ұ": "u", "ү": "u", "һ": "h", "і": "i",
+})
+# Фонетическое схлопывание латиницы: разные написания одного звука → одна буква
+_PHONETIC = [
+    (re.compile(r"ck|c(?!h)|q"), "k"),
+    (re.compile(r"ph"), "f"),
+    (re.compile(r"w"), "v"),
+    (re.compile(r"x"), "ks"),
+    (re.compile(r"y|j"), "i"),
+    (re.compile(r"(.)\1+"), r"\1"),     # удвоенные буквы
+]
+_APOSTROPHES = re.compile(r"['’`ʼ]")
+_NON_WORD = re.compile(r"[^0-9a-z]+")
+
+
+def normalize(text: str) -> str:
+    """«Lay's Сметана 150г» → «lais smetana 150g»: регистр, транслит, фонетика, пунктуация."""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _APOSTROPHES.sub("", text).translate(_TRANSLIT)
+    # диакритика латиницы (é → e)
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    text = _NON_WORD.sub(" ", text)
+    for pattern, repl in _PHONETIC:
+        text = pattern.sub(repl, text)
+    return " ".join(text.split())
+
+
+def trigrams(text: str) -> set[str]:
+    """Триграммы по словам, как в pg_trgm: слово дополняется двумя пробелами слева и одним справа."""
+    grams: set[str] = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class ProductMatcher:
+    """
+    Нечёткий поиск товаров в памяти процесса: триграммный инвертированный индекс
+    по name, name_kz и description после нормализации и транслитерации.
+
+    Оценка кандидата (0..1):
+      - покрытие — какая доля триграмм запроса есть у товара, с весом IDF
+        (редкие триграммы бренда важнее частых) и весом поля; триграммы,
+        которых нет во всём каталоге («sour cream»), весят меньше, но
+        учитываются — иначе любой мусор совпадал бы по одной букве
+      - похожесть названия — коэффициент Дайса запроса и name/name_kz, чтобы
+        «coca cola 1l» выбирал «Coca-Cola 1L», а не «Coca-Cola Zero 1.5L»
+
+    Индекс строится при старте, записи через database.py патчат его сразу
+    (колбэк add_product_listener), записи других воркеров подтягиваются по
+    журналу изменений не реже MATCHER_SYNC_INTERVAL. В индексе только товары
+    в наличии — как и в rank_search.
+    """
+
+    def __init__(self, sync_interval: float = MATCHER_SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self._products: dict[int, dict] = {}
+        self._grams_of: dict[int, dict[str, float]] = {}     # id → {триграмма: вес поля}
+        self._name_grams: dict[int, list[set[str]]] = {}     # id → триграммы name, name_kz
+        self._postings: dict[str, dict[int, float]] = {}     # триграмма → {id: вес поля}
+        self._version: int | None = None
+        self._synced_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def size(self) -> int:
+        return len(self._products)
+
+    # ── Построение ────────────────────────────────────────────────────────────
+    async def warm(self) -> None:
+        """Строит индекс по всему каталогу. Вызывается из lifespan."""
+        async with self._lock:
+            await self._load()
+
+    def clear(self) -> None:
+        self._products.clear()
+        self._grams_of.clear()
+        self._name_grams.clear()
+        self._postings.clear()
+        self._version = None
+
+    def on_product_change(self, kind: str, product_id: int, row: dict | None) -> None:
+        """Колбэк database.add_product_listener: перестраивает только этот товар."""
+        if kind == "reload":
+            self.clear()    # индекс строится заново при следующем match
+            return
+        self._remove(product_id)
+        if kind == "upsert" and row is not None:
+            self._add(row)
+
+    async def _sync(self) -> None:
+        """Изменения каталога, сделанные другими воркерами, — по журналу product_changes."""
+        if self._version is None:
+            async with self._lock:
+                if self._version is None:
+                    await self._load()
+            return
+        if self.sync_interval <= 0 or time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            changes = await database.get_changes_since(self._version)
+            if changes["full_resync"]:
+                await self._load()
+                return
+            for product_id in changes["deleted"]:
+                self._remove(product_id)
+            for row in changes["upserted"]:
+                self._remove(row["id"])
+                self._add(row)
+            self._version = changes["version"]
+            self._synced_at = time.monotonic()
+
+    async def _load(self) -> None:
+        version, products = await database.get_catalog_snapshot()
+        self.clear()
+        for row in products:
+            self._add(row)
+        self._version = version
+        self._synced_at = time.monotonic()
+
+    def _add(self, row: dict) -> None:
+        if not row.get("in_stock", 1):
+            return
+        grams: dict[str, float] = {}
+        names = []
+        for field, weight in FIELD_WEIGHTS.items():
+            field_grams = trigrams(row.get(field) or "")
+            if field != "description":
+                names.append(field_grams)
+            for gram in field_grams:
+                if weight > grams.get(gram, 0.0):
+                    grams[gram] = weight
+        if not grams:
+            return
+
+        product_id = row["id"]
+        self._products[product_id] = row
+        self._grams_of[product_id] = grams
+        self._name_grams[product_id] = names
+        for gram, weight in grams.items():
+            self._postings.setdefault(gram, {})[product_id] = weight
+
+    def _remove(self, product_id: int) -> None:
+        if self._products.pop(product_id, None) is None:
+            return
+        self._name_grams.pop(product_id, None)
+        for gram in self._grams_of.pop(product_id, {}):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.pop(product_id, None)
+                if not postings:
+                    del self._postings[gram]
+
+    # ── Поиск ─────────────────────────────────────────────────────────────────
+    def candidates(
+        self,
+        query: str,
+        limit: int = 3,
+        min_score: float = MATCHER_MIN_SCORE,
+    ) -> list[tuple[float, dict]]:
+        """[(оценка, товар)] по убыванию оценки, не ниже min_score."""
+        grams = trigrams(query)
+        if not grams or not self._products:
+            return []
+
+        n = len(self._products)
+        unknown_idf = _UNKNOWN_WEIGHT * math.log(1 + n)
+        total = 0.0
+        known = []
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings:
+                idf = math.log(1 + n / len(postings))
+                known.append((len(postings), idf, gram, postings))
+                total += idf
+            else:
+                total += unknown_idf
+
+        # Редкие триграммы набирают кандидатов, частые («  k», «a  ») только
+        # добавляют вес уже найденным: товар, совпавший лишь по частым
+        # триграммам, порог всё равно не пройдёт, а обход их списков — это
+        # основная цена запроса на тысячах SKU
+        known.sort(key=lambda k: k[0])
+        common = max(_COMMON_POSTINGS, n // 20)
+        matched: dict[int, float] = {}
+        for df, idf, gram, postings in known:
+            if df <= common or not matched:
+                for product_id, weight in postings.items():
+                    matched[product_id] = matched.get(product_id, 0.0) + idf * weight
+            else:
+                for product_id in matched:
+                    weight = self._grams_of[product_id].get(gram)
+                    if weight:
+                        matched[product_id] += idf * weight
+
+        scored = []
+        for product_id, weight in matched.items():
+            coverage = weight / total
+            # Даже при полном совпадении названия оценка не дотянет до порога
+            if _COVERAGE_SHARE * coverage + (1 - _COVERAGE_SHARE) < min_score:
+                continue
+            dice = max(
+                (2 * len(grams & name) / (len(grams) + len(name)) for name in self._name_grams[product_id] if name),
+                default=0.0,
+            )
+            score = _COVERAGE_SHARE * coverage + (1 - _COVERAGE_SHARE) * dice
+            if score >= min_score:
+                scored.append((round(score, 4), self._products[product_id]))
+
+        scored.sort(key=lambda c: c[0], reverse=True)
+        return scored[:limit]
+
+    async def match(self, queries: list[str], limit: int = 3) -> list[list[tuple[float, dict]]]:
+        """Кандидаты для каждого запроса (тот же порядок); индекс при необходимости досинхронизируется."""
+        await self._sync()
+        return [self.candidates(q, limit) for q in queries]
+
+
+product_matcher = ProductMatcher()
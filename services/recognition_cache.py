@@ -0,0 +1,198 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+# ── Настройки кэша распознавания ──────────────────────────────────────────────
+RECOGNITION_CACHE_TTL       = float(os.getenv("RECOGNITION_CACHE_TTL", "600"))        # сек
+RECOGNITION_CACHE_MAX_BYTES = int(os.getenv("RECOGNITION_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+# Максимальное расстояние Хэмминга между dHash, при котором фото считаются одинаковыми
+# (из 64 бит; 0 — только точное совпадение хэша, <0 — перцептивный поиск выключен)
+RECOGNITION_CACHE_HAMMING   = int(os.getenv("RECOGNITION_CACHE_HAMMING", "1"))
+# Совпадение по dHash подтверждается сеткой средних цветов: максимальная
+# разница ячейки (0..255). Лишний товар на том же столе даёт ~100, ретейк — <30
+RECOGNITION_CACHE_MAX_CELL_DIFF = int(os.getenv("RECOGNITION_CACHE_MAX_CELL_DIFF", "32"))
+
+
+@dataclass
+class _Entry:
+    digest: str
+    dhash: int | None
+    signature: bytes | None
+    known: tuple[str, ...]
+    result: dict
+    prices: dict[int, float]   # product_id → цена на момент распознавания
+    size: int
+    expires_at: float
+
+    @property
+    def key(self) -> tuple[str, tuple[str, ...]]:
+        return self.digest, self.known
+
+
+class RecognitionCache:
+    """
+    Кэш результатов recognize_from_image.
+
+    Ключи:
+      - SHA-256 исходных байт — точный повтор, проверяется до предобработки
+      - dHash предобработанной картинки — «почти то же фото» (ретейк, пересжатие),
+        совпадение при расстоянии Хэмминга <= RECOGNITION_CACHE_HAMMING. Результат
+        уходит в корзину и к оплате, поэтому совпадение ещё проверяется сеткой
+        средних цветов (image_service.signature): без неё или при разнице ячейки
+        больше RECOGNITION_CACHE_MAX_CELL_DIFF — промах, распознаём заново
+
+    Запись хранится по (digest, known_items после штрихкодов): одно и то же
+    фото с найденными по штрихкоду товарами и без них — разные записи.
+
+    Вытеснение: TTL + LRU при превышении лимита в байтах (размер считается
+    по сериализованному результату). Запись сбрасывается, если у любого
+    распознанного в ней товара изменилась цена или наличие.
+    """
+
+    def __init__(
+        self,
+        ttl: float = RECOGNITION_CACHE_TTL,
+        max_bytes: int = RECOGNITION_CACHE_MAX_BYTES,
+        hamming: int = RECOGNITION_CACHE_HAMMING,
+        max_cell_diff: int = RECOGNITION_CACHE_MAX_CELL_DIFF,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hamming = hamming
+        self.max_cell_diff = max_cell_diff
+        # (digest, known) → запись
+        self._entries: OrderedDict[tuple[str, tuple[str, ...]], _Entry] = OrderedDict()
+        self._by_product: dict[int, set[tuple[str, tuple[str, ...]]]] = {}
+        self._bytes = 0
+
+    # ── Чтение ────────────────────────────────────────────────────────────────
+    def get_exact(self, digest: str, known_items: list[str] | None = None) -> dict | None:
+        entry = self._entries.get((digest, self._known_key(known_items)))
+        return self._touch(entry) if entry else None
+
+    def get_similar(
+        self,
+        dhash: int | None,
+        known_items: list[str] | None = None,
+        signature: bytes | None = None,
+    ) -> dict | None:
+        if dhash is None or signature is None or self.hamming < 0:
+            return None
+
+        known = self._known_key(known_items)
+        best: _Entry | None = None
+        best_distance = self.hamming + 1
+        now = time.monotonic()
+        expired = []
+        for entry in self._entries.values():
+            if entry.dhash is None or entry.known != known:
+                continue
+            if entry.expires_at <= now:
+                # истёкшая запись не должна заслонять следующего кандидата
+                expired.append(entry.key)
+                continue
+            distance = (entry.dhash ^ dhash).bit_count()
+            if distance < best_distance and self._same_scene(entry.signature, signature):
+                best, best_distance = entry, distance
+                if distance == 0:
+                    break
+        for key in expired:
+            self._remove(key)
+        return self._touch(best) if best else None
+
+    # ── Запись ────────────────────────────────────────────────────────────────
+    def put(
+        self,
+        digest: str,
+        dhash: int | None,
+        known_items: list[str] | None,
+        result: dict,
+        signature: bytes | None = None,
+    ) -> None:
+        size = len(json.dumps(result, ensure_ascii=False, default=str).encode())
+        if size > self.max_bytes:
+            return
+
+        known = self._known_key(known_items)
+        self._remove((digest, known))
+        prices = {
+            item["product_id"]: item.get("price")
+            for item in result.get("recognized_items", [])
+            if item.get("product_id") is not None
+        }
+        entry = _Entry(
+            digest=digest,
+            dhash=dhash,
+            signature=signature,
+            known=known,
+            result=result,
+            prices=prices,
+            size=size,
+            expires_at=time.monotonic() + self.ttl,
+        )
+        self._entries[entry.key] = entry
+        self._bytes += size
+        for product_id in prices:
+            self._by_product.setdefault(product_id, set()).add(entry.key)
+
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_product.clear()
+        self._bytes = 0
+
+    def on_product_change(self, kind: str, product_id: int, row: dict | None) -> None:
+        """Колбэк database.add_product_listener: сброс записей при смене цены/наличия."""
+        if kind == "reload":
+            self.clear()
+            return
+        keys = self._by_product.get(product_id)
+        if not keys:
+            return
+        for key in list(keys):
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if (
+                kind == "delete" or row is None
+                or row["price"] != entry.prices.get(product_id)
+                or not row["in_stock"]
+            ):
+                self._remove(key)
+
+    # ── Внутреннее ────────────────────────────────────────────────────────────
+    def _same_scene(self, cached: bytes | None, signature: bytes) -> bool:
+        if cached is None or len(cached) != len(signature):
+            return False
+        return max(abs(a - b) for a, b in zip(cached, signature)) <= self.max_cell_diff
+
+    @staticmethod
+    def _known_key(known_items: list[str] | None) -> tuple[str, ...]:
+        return tuple(sorted(known_items or ()))
+
+    def _touch(self, entry: _Entry) -> dict | None:
+        if entry.expires_at <= time.monotonic():
+            self._remove(entry.key)
+            return None
+        self._entries.move_to_end(entry.key)
+        return entry.result
+
+    def _remove(self, key: tuple[str, tuple[str, ...]]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for product_id in entry.prices:
+            keys = self._by_product.get(product_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_product[product_id]
+
+
+recognition_cache = RecognitionCache()
@@ -0,0 +1,416 @@
+import asyncio
+import importlib
+import json
+import logging
+import math
+import os
+import shutil
+import time
+import zlib
+
+import database
+from services.catalog_cache import catalog_cache
+from services.metrics import span
+from services.product_matcher import normalize
+
+try:
+    import numpy as np
+except ImportError:     # есть в requirements.txt; без него SEARCH_BACKEND=vector|hybrid работает как fts
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Каталог с файлами индекса (по умолчанию рядом с БД)
+VECTOR_INDEX_DIR = os.getenv(
+    "VECTOR_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(database.DB_PATH)), "vector_index")
+)
+# hashing — встроенный эмбеддер; иначе "модуль:фабрика" (см. load_embedder)
+VECTOR_EMBEDDER      = os.getenv("VECTOR_EMBEDDER", "hashing")
+VECTOR_DIM           = int(os.getenv("VECTOR_DIM", "512"))
+# Минимальное косинусное сходство запроса и товара
+VECTOR_MIN_SCORE     = float(os.getenv("VECTOR_MIN_SCORE", "0.4"))
+VECTOR_SYNC_INTERVAL = float(os.getenv("VECTOR_SYNC_INTERVAL", "30"))   # сек
+
+# Вес поля в векторе товара: описание — только подсказка
+FIELD_WEIGHTS = {"name": 1.0, "name_kz": 1.0, "description": 0.4}
+_MIN_CAPACITY = 1024
+_GROWTH = 1.5
+_EMBED_BATCH = 2048
+_META_FILE = "current.json"
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+class HashingEmbedder:
+    """
+    Эмбеддер без модели: слова и n-граммы символов после normalize()
+    (транслит, фонетика — как в product_matcher) хэшируются со знаком в dim
+    корзин (feature hashing); вес — 1 + log(tf), вектор L2-нормирован.
+    Детерминирован между процессами (crc32, а не hash()).
+    """
+
+    def __init__(self, dim: int = VECTOR_DIM, ngrams: tuple[int, ...] = (3, 4)):
+        self.dim = dim
+        self.ngrams = ngrams
+        self.name = f"hashing-v1-{dim}-{''.join(map(str, ngrams))}"
+
+    def features(self, text: str) -> list[str]:
+        features = []
+        for word in normalize(text).split():
+            features.append(f"w:{word}")
+            padded = f" {word} "
+            for n in self.ngrams:
+                features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+        return features
+
+    def embed(self, texts: list[str]):
+        """(len(texts), dim) float32, строки L2-нормированы (пустой текст — нулевой вектор)."""
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            counts: dict[int, int] = {}
+            for feature in self.features(text):
+                h = zlib.crc32(feature.encode())
+                counts[h] = counts.get(h, 0) + 1
+            for h, count in counts.items():
+                rows.append(row)
+                cols.append(h % self.dim)
+                values.append((1.0 + math.log(count)) * (1.0 if (h // self.dim) & 1 else -1.0))
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if rows:
+            np.add.at(matrix, (np.array(rows), np.array(cols)), np.array(values, dtype=np.float32))
+        return _normalize_rows(matrix)
+
+
+def load_embedder(spec: str = VECTOR_EMBEDDER):
+    """
+    hashing — HashingEmbedder; иначе "модуль:фабрика": фабрика() возвращает
+    объект с name (меняется вместе с моделью — индекс перестроится), dim и
+    embed(texts) → float32-матрица (len(texts), dim) с L2-нормированными строками.
+    """
+    if spec == "hashing":
+        return HashingEmbedder()
+    module, _, factory = spec.partition(":")
+    if not factory:
+        raise ValueError("VECTOR_EMBEDDER must be 'hashing' or 'module:factory'")
+    return getattr(importlib.import_module(module), factory)()
+
+
+class VectorIndex:
+    """
+    Векторный поиск товаров: по эмбеддингу на товар в наличии, все запросы
+    tool call'а — одним умножением матриц и top-k.
+
+    Матрица лежит в VECTOR_INDEX_DIR (.npy) и отображается в память в режиме
+    copy-on-write: воркеры делят страницы файла, правки каждого — в его
+    памяти. Файл пишется целиком при первой сборке, смене эмбеддера,
+    полной пересинхронизации и росте ёмкости (новая сборка в своём каталоге,
+    current.json подменяется атомарно). При старте читается готовая сборка
+    и догоняется по журналу product_changes — товары заново не считаются.
+
+    Записи через database.py попадают в очередь (add_product_listener) и
+    считаются одним батчем перед ближайшим поиском; записи других воркеров —
+    по журналу не реже VECTOR_SYNC_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        directory: str = VECTOR_INDEX_DIR,
+        embedder=None,
+        sync_interval: float = VECTOR_SYNC_INTERVAL,
+    ):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self._embedder = embedder
+        self._matrix = None                         # (capacity, dim) float32, memmap или в памяти
+        self._ids = None                            # (capacity,) int64, -1 — свободная строка
+        self._rows = 0                              # занятая часть матрицы (с дырами)
+        self._row_of: dict[int, int] = {}           # product_id → строка
+        self._free: list[int] = []
+        self._pending: dict[int, dict | None] = {}  # product_id → строка товара | None (удалить)
+        self._build: str | None = None
+        self._dirty = False                         # матрица выросла — сохранить новой сборкой
+        self._version: int | None = None
+        self._synced_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def available(self) -> bool:
+        return np is not None
+
+    @property
+    def size(self) -> int:
+        return len(self._row_of)
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            self._embedder = load_embedder()
+        return self._embedder
+
+    # ── Жизненный цикл ────────────────────────────────────────────────────────
+    async def warm(self) -> None:
+        """Открывает сохранённую сборку (или собирает заново). Вызывается из lifespan."""
+        if not self.available:
+            logger.warning(
+                "SEARCH_BACKEND asks for vector search, but numpy cannot be imported: "
+                "falling back to FTS (pip install -r requirements.txt)"
+            )
+            return
+        async with self._lock:
+            await self._load()
+
+    def clear(self) -> None:
+        self._matrix = None
+        self._ids = None
+        self._rows = 0
+        self._row_of.clear()
+        self._free.clear()
+        self._pending.clear()
+        self._build = None
+        self._dirty = False
+        self._version = None
+
+    def on_product_change(self, kind: str, product_id: int, row: dict | None) -> None:
+        """Колбэк database.add_product_listener: товар пересчитается перед следующим поиском."""
+        if kind == "reload":
+            self._pending.clear()
+            self._version = None    # полная синхронизация по журналу при следующем поиске
+            return
+        self._pending[product_id] = row if kind == "upsert" else None
+
+    # ── Поиск ─────────────────────────────────────────────────────────────────
+    async def search(
+        self,
+        queries: list[str],
+        limit: int = 2,
+        min_score: float = VECTOR_MIN_SCORE,
+    ) -> list[list[tuple[float, int]]]:
+        """[(сходство, product_id)] для каждого запроса (тот же порядок), по убыванию сходства."""
+        if not queries or not self.available:
+            return [[] for _ in queries]
+        await self._sync()
+        if not self._row_of:
+            return [[] for _ in queries]
+
+        with span("vector.search"):
+            embedded = self.embedder.embed(queries)                     # (n, dim)
+            # (rows, dim) @ (dim, n), затем построчно по запросам для top-k
+            scores = np.ascontiguousarray((self._matrix[:self._rows] @ embedded.T).T)
+            k = min(limit, self._rows)
+            top = np.argpartition(scores, -k, axis=1)[:, -k:]           # (n, k), без сортировки
+            results = []
+            for j, rows in enumerate(top):
+                found = [
+                    (round(float(scores[j, r]), 4), int(self._ids[r]))
+                    for r in rows[np.argsort(-scores[j, rows])]
+                    if scores[j, r] >= min_score and self._ids[r] >= 0
+                ]
+                results.append(found)
+        return results
+
+    async def search_products(self, queries: list[str], limit_per_query: int = 2) -> list[dict]:
+        """
+        Как database.rank_search: товары по порядку запросов, с query_index и
+        score (здесь — сходство, больше — лучше).
+        """
+        hits = await self.search(queries, limit_per_query)
+        products = await catalog_cache.get_many(list({pid for found in hits for _, pid in found}))
+        results = []
+        for query_index, found in enumerate(hits):
+            for score, product_id in found:
+                product = products.get(product_id)
+                if product is not None:
+                    results.append({**product, "query_index": query_index, "score": score})
+        return results
+
+    # ── Синхронизация ─────────────────────────────────────────────────────────
+    async def _sync(self) -> None:
+        stale = self._version is None or (
+            self.sync_interval > 0 and time.monotonic() - self._synced_at >= self.sync_interval
+        )
+        if not stale and not self._pending and not self._dirty:
+            return
+        async with self._lock:
+            if self._version is None:
+                await self._load()
+            elif self.sync_interval > 0 and time.monotonic() - self._synced_at >= self.sync_interval:
+                changes = await database.get_changes_since(self._version)
+                if changes["full_resync"]:
+                    await self._rebuild()
+                else:
+                    self._queue_changes(changes)
+                    self._version = changes["version"]
+                    self._synced_at = time.monotonic()
+            self._apply_pending()
+            if self._dirty:
+                await self._persist()
+
+    async def _load(self) -> None:
+        meta = self._read_meta()
+        if meta is not None and meta["embedder"] == self.embedder.name and meta["dim"] == self.embedder.dim:
+            try:
+                self._open(meta)
+            except (OSError, ValueError) as e:
+                logger.warning("Vector index %s is unreadable, rebuilding: %s", meta["build"], e)
+            else:
+                changes = await database.get_changes_since(meta["version"])
+                if not changes["full_resync"]:
+                    self._queue_changes(changes)
+                    self._apply_pending()
+                    self._version = changes["version"]
+                    self._synced_at = time.monotonic()
+                    return
+        await self._rebuild()
+
+    def _queue_changes(self, changes: dict) -> None:
+        for product_id in changes["deleted"]:
+            self._pending[product_id] = None
+        for row in changes["upserted"]:
+            self._pending[row["id"]] = row
+
+    def _apply_pending(self) -> None:
+        """Очередь изменений → матрица: удаления сразу, новые векторы — одним батчем."""
+        if not self._pending or self._matrix is None:
+            return
+        pending, self._pending = self._pending, {}
+        rows = []
+        for product_id, row in pending.items():
+            if row is None or not row.get("in_stock", 1):
+                self._remove(product_id)
+            else:
+                rows.append(row)
+        for i in range(0, len(rows), _EMBED_BATCH):
+            batch = rows[i:i + _EMBED_BATCH]
+            for row, vector in zip(batch, self._embed_products(batch)):
+                self._put(row["id"], vector)
+
+    def _put(self, product_id: int, vector) -> None:
+        row = self._row_of.get(product_id)
+        if row is None:
+            if self._free:
+                row = self._free.pop()
+            else:
+                if self._rows == len(self._ids):
+                    self._grow()
+                row = self._rows
+                self._rows += 1
+            self._row_of[product_id] = row
+            self._ids[row] = product_id
+        self._matrix[row] = vector
+
+    def _remove(self, product_id: int) -> None:
+        row = self._row_of.pop(product_id, None)
+        if row is None:
+            return
+        self._matrix[row] = 0.0
+        self._ids[row] = -1
+        self._free.append(row)
+
+    def _grow(self) -> None:
+        """Ёмкость кончилась: матрица копируется в память, файл перепишется при следующем _sync."""
+        capacity = max(_MIN_CAPACITY, int(len(self._ids) * _GROWTH))
+        matrix = np.zeros((capacity, self.embedder.dim), dtype=np.float32)
+        matrix[:self._rows] = self._matrix[:self._rows]
+        ids = np.full(capacity, -1, dtype=np.int64)
+        ids[:self._rows] = self._ids[:self._rows]
+        self._matrix, self._ids = matrix, ids
+        self._dirty = True
+
+    def _embed_products(self, rows: list[dict]):
+        """Вектор товара — взвешенная сумма векторов полей, L2-нормированная."""
+        vectors = np.zeros((len(rows), self.embedder.dim), dtype=np.float32)
+        for field, weight in FIELD_WEIGHTS.items():
+            vectors += weight * self.embedder.embed([row.get(field) or "" for row in rows])
+        return _normalize_rows(vectors)
+
+    # ── Файлы ─────────────────────────────────────────────────────────────────
+    async def _rebuild(self) -> None:
+        version, products = await database.get_catalog_snapshot()
+        products = [p for p in products if p.get("in_stock", 1)]
+        self.clear()
+        meta = await asyncio.to_thread(self._write_build, version, products, None)
+        self._open(meta)
+        self._version = version
+        self._synced_at = time.monotonic()
+        logger.info("Vector index built: %d products, %s", len(products), meta["build"])
+
+    async def _persist(self) -> None:
+        """Текущая матрица (после роста) → новая сборка, открытая снова как memmap."""
+        meta = await asyncio.to_thread(
+            self._write_build, self._version, None, (self._matrix[:self._rows], self._ids[:self._rows])
+        )
+        self._open(meta)
+        self._dirty = False
+
+    def _write_build(self, version: int, products: list[dict] | None, current) -> dict:
+        """
+        Пишет сборку в новый каталог и атомарно переключает current.json.
+        products — собрать с нуля; current — (матрица, ids) сохранить как есть.
+        Открытые другими воркерами файлы прежней сборки остаются валидны до закрытия.
+        """
+        rows = len(products) if products is not None else len(current[1])
+        capacity = max(_MIN_CAPACITY, int(rows * _GROWTH))
+        build = f"build-{version}-{os.getpid()}-{int(time.time() * 1000)}"
+        path = os.path.join(self.directory, build)
+        os.makedirs(path, exist_ok=True)
+
+        matrix = np.lib.format.open_memmap(
+            os.path.join(path, "vectors.npy"), mode="w+", dtype=np.float32, shape=(capacity, self.embedder.dim)
+        )
+        ids = np.full(capacity, -1, dtype=np.int64)
+        if products is not None:
+            for i in range(0, rows, _EMBED_BATCH):
+                batch = products[i:i + _EMBED_BATCH]
+                matrix[i:i + len(batch)] = self._embed_products(batch)
+                ids[i:i + len(batch)] = [p["id"] for p in batch]
+        else:
+            matrix[:rows] = current[0]
+            ids[:rows] = current[1]
+        matrix.flush()
+        del matrix
+        np.save(os.path.join(path, "ids.npy"), ids)
+
+        meta = {
+            "build":    build,
+            "embedder": self.embedder.name,
+            "dim":      self.embedder.dim,
+            "version":  version,
+            "rows":     rows,
+        }
+        tmp = os.path.join(self.directory, f".{build}.json")
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.directory, _META_FILE))
+        self._remove_old_builds(build)
+        return meta
+
+    def _remove_old_builds(self, keep: str) -> None:
+        for name in os.listdir(self.directory):
+            if name.startswith("build-") and name != keep:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def _read_meta(self) -> dict | None:
+        try:
+            with open(os.path.join(self.directory, _META_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _open(self, meta: dict) -> None:
+        path = os.path.join(self.directory, meta["build"])
+        # mode="c": страницы файла общие, запись — копия в памяти процесса
+        matrix = np.load(os.path.join(path, "vectors.npy"), mmap_mode="c")
+        ids = np.load(os.path.join(path, "ids.npy"))
+        if matrix.shape[1] != meta["dim"] or len(ids) != len(matrix):
+            raise ValueError("vector index files do not match current.json")
+        rows = meta["rows"]
+        self._matrix, self._ids, self._rows, self._build = matrix, ids, rows, meta["build"]
+        self._row_of = {int(pid): r for r, pid in enumerate(ids[:rows]) if pid >= 0}
+        self._free = [r for r in range(rows) if ids[r] < 0]
+
+
+vector_index = VectorIndex()